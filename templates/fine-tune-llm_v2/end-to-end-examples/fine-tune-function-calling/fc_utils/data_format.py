@@ -6,6 +6,8 @@ from enum import Enum
 from typing import NamedTuple, Dict, Union, Any, List
 from dataclasses import dataclass
 
+import pyarrow as pa
+
 GLAIVEAI_SYSTEM_NO_TOOLS = (
     "SYSTEM: You are a helpful assistant, with no access to external functions."
 )
@@ -52,6 +54,33 @@ class DatasetFormat(Enum):
     OPENAI = "openai"
 
 
+# Arrow types for conversations shared by the dataset mappers. The "arguments" field of a tool call and the tool list are
+# kept as JSON strings, since function schemas and arguments have no fixed structure.
+TOOL_CALL_ARROW_TYPE = pa.struct(
+    [
+        ("type", pa.string()),
+        ("function", pa.struct([("name", pa.string()), ("arguments", pa.string())])),
+    ]
+)
+OPENAI_MESSAGE_ARROW_TYPE = pa.struct(
+    [
+        ("role", pa.string()),
+        ("content", pa.string()),
+        ("tool_calls", pa.list_(TOOL_CALL_ARROW_TYPE)),
+        ("name", pa.string()),
+        ("tool_call_id", pa.string()),
+    ]
+)
+ANYSCALE_MESSAGE_ARROW_TYPE = pa.struct(
+    [("role", pa.string()), ("content", pa.string())]
+)
+OPENAI_CONVERSATION_SCHEMA = pa.schema(
+    [("messages", pa.list_(OPENAI_MESSAGE_ARROW_TYPE)), ("tools", pa.string())]
+)
+ANYSCALE_CONVERSATION_SCHEMA = pa.schema(
+    [("messages", pa.list_(ANYSCALE_MESSAGE_ARROW_TYPE))]
+)
+
 TOOL_CALL_TAGS = IndicatorTags(start="[TOOL_CALLS]", end="[/TOOL_CALLS]")
 TOOL_RESULT_TAGS = IndicatorTags(start="[TOOL_RESULT]", end="[/TOOL_RESULT]")
 TOOL_LIST_TAGS = IndicatorTags(start="[TOOL_LIST]", end="[/TOOL_LIST]")
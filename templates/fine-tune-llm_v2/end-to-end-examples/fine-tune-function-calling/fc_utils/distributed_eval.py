@@ -0,0 +1,211 @@
+"""
+Distributed evaluation with Ray Data. Each actor holds its own response parser and evaluates conversations with `parse_and_eval`, or turn by turn with `evaluate_model_by_turn`.
+"""
+
+import json
+from typing import Dict, Any, Tuple, Type, Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import ray.data
+
+from fc_utils.response_parsers import ResponseParser, _to_json_default
+from fc_utils.eval_core import (
+    Mistakes,
+    Model,
+    Result,
+    _evaluate_example,
+    evaluate_model_by_turn,
+)
+from fc_utils.eval_data_utils import get_test_data_mapper
+from fc_utils.eval_metrics import EvalMetrics, merge_metrics
+from fc_utils.data_format import IndicatorTags
+
+
+def result_to_record(result: Result) -> Dict[str, Any]:
+    """Converts a Result into a flat record. Conversations are stringified for compatibility with PyArrow."""
+    return {
+        "is_correct": bool(result.is_correct),
+        "is_valid": result.is_valid,
+        "mistake_type": result.mistake_type.value if result.mistake_type else "",
+        "generated_conv": json.dumps(result.generated_conv, default=_to_json_default),
+        "ground_truth_conv": json.dumps(
+            result.ground_truth_conv, default=_to_json_default
+        ),
+    }
+
+
+class EvalActor:
+    """Ray Data actor that evaluates a batch of test examples against a model endpoint.
+
+    Each actor instantiates its own response parser (and hence its own client or model), and evaluates the conversations in a batch concurrently.
+    If `by_turn` is True, the batch is evaluated with `evaluate_model_by_turn` instead, which suits parsers that batch requests natively such as `VLLMResponseParser`.
+    """
+
+    def __init__(
+        self,
+        parser_cls: Type[ResponseParser],
+        parser_kwargs: Dict[str, Any],
+        test_data_mapper: Callable[[Dict[str, Any]], Dict[str, Any]],
+        model: Model,
+        max_concurrency: int = 8,
+        by_turn: bool = False,
+    ):
+        self.parser = parser_cls(**parser_kwargs)
+        self.test_data_mapper = test_data_mapper
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.by_turn = by_turn
+
+    def _evaluate(self, example: Dict[str, Any]) -> Dict[str, Any]:
+        # Preprocess the example in the actor, since the evaluation format is not supported by PyArrow
+        example = self.test_data_mapper(example)
+        return result_to_record(_evaluate_example(self.parser, example))
+
+    def __call__(self, batch: pd.DataFrame) -> pd.DataFrame:
+        if self.by_turn:
+            examples = [
+                self.test_data_mapper(example)
+                for example in batch.to_dict(orient="records")
+            ]
+            results, _ = evaluate_model_by_turn(examples, self.parser, self.model)
+            return pd.DataFrame.from_records(
+                [result_to_record(result) for result in results]
+            )
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            records = list(
+                executor.map(self._evaluate, batch.to_dict(orient="records"))
+            )
+        return pd.DataFrame.from_records(records)
+
+
+def evaluate_model_ds(
+    test_ds: ray.data.Dataset,
+    parser_cls: Type[ResponseParser],
+    parser_kwargs: Dict[str, Any],
+    tool_call_tags: IndicatorTags,
+    tool_result_tags: IndicatorTags,
+    tool_list_tags: IndicatorTags,
+    model: Model,
+    num_actors: int = 4,
+    max_concurrency_per_actor: int = 8,
+    batch_size: int = 32,
+    by_turn: bool = False,
+    num_gpus_per_actor: float = 0,
+) -> ray.data.Dataset:
+    """
+    Evaluates the given model on the test dataset with Ray Data.
+
+    Args:
+        test_ds: The test dataset in the Anyscale format
+        parser_cls: The ResponseParser class to instantiate in each actor
+        parser_kwargs: Keyword arguments for the response parser (api_key, api_base, model, tool_call_tags)
+        tool_call_tags: Tuple containing the start and end tags for the tool call
+        tool_result_tags: Tuple containing the start and end tags for the tool result
+        tool_list_tags: Tuple containing the start and end tags for the tool list
+        model: Model enum indicating the model type to evaluate
+        num_actors: Number of evaluation actors
+        max_concurrency_per_actor: Number of conversations evaluated in parallel by each actor
+        batch_size: Number of examples per batch
+        by_turn: Whether to evaluate each batch turn by turn with `evaluate_model_by_turn`
+        num_gpus_per_actor: Number of GPUs per actor, e.g. 1 for `VLLMResponseParser`
+
+    Returns:
+        results_ds: Dataset of result records with columns is_correct, is_valid, mistake_type, generated_conv and ground_truth_conv
+    """
+    test_data_mapper = get_test_data_mapper(
+        tool_call_tags, tool_result_tags, tool_list_tags, model
+    )
+    return test_ds.map_batches(
+        EvalActor,
+        fn_constructor_kwargs=dict(
+            parser_cls=parser_cls,
+            parser_kwargs=parser_kwargs,
+            test_data_mapper=test_data_mapper,
+            model=model,
+            max_concurrency=max_concurrency_per_actor,
+            by_turn=by_turn,
+        ),
+        batch_size=batch_size,
+        batch_format="pandas",
+        concurrency=num_actors,
+        num_cpus=0,
+        num_gpus=num_gpus_per_actor,
+    )
+
+
+def _count_outcomes(batch: pd.DataFrame) -> pd.DataFrame:
+    """Counts outcomes in a block."""
+    counts = batch.groupby(["is_valid", "is_correct", "mistake_type"]).size()
+    return counts.rename("count").reset_index()
+
+
+def get_eval_summary(
+    results_ds: ray.data.Dataset,
+) -> Tuple[float, Dict[Mistakes, int]]:
+    """
+    Computes the accuracy and mistake histogram with a distributed aggregation.
+
+    Outcome counts are computed per block in parallel and then summed, so only a handful of rows reach the driver.
+
+    Args:
+        results_ds: Dataset of result records from `evaluate_model_ds`
+
+    Returns:
+        accuracy: Accuracy over valid results
+        count_by_flag: Count of incorrect results by mistake type, as returned by `plot_utils.get_count_by_flag`
+    """
+    block_counts = results_ds.map_batches(_count_outcomes, batch_format="pandas")
+    counts = (
+        block_counts.to_pandas()
+        .groupby(["is_valid", "is_correct", "mistake_type"])["count"]
+        .sum()
+        .reset_index()
+    )
+    valid = counts[counts["is_valid"]]
+    num_valid = valid["count"].sum()
+    accuracy = (
+        valid[valid["is_correct"]]["count"].sum() / num_valid if num_valid else 0.0
+    )
+
+    incorrect = valid[~valid["is_correct"]].groupby("mistake_type")["count"].sum()
+    count_by_flag = {
+        flag: int(incorrect.get(flag.value, 0)) for flag in Mistakes.instances()
+    }
+    return float(accuracy), count_by_flag
+
+
+def record_to_result(record: Dict[str, Any]) -> Result:
+    """Converts a record from `result_to_record` back into a Result."""
+    return Result(
+        is_correct=record["is_correct"],
+        is_valid=record["is_valid"],
+        mistake_type=Mistakes(record["mistake_type"]),
+        generated_conv=json.loads(record["generated_conv"]),
+        ground_truth_conv=json.loads(record["ground_truth_conv"]),
+    )
+
+
+def _get_block_metrics(batch: pd.DataFrame) -> pd.DataFrame:
+    """Aggregates the metrics of a block into a single serialized row."""
+    metrics = EvalMetrics()
+    metrics.update_all(
+        record_to_result(record) for record in batch.to_dict(orient="records")
+    )
+    return pd.DataFrame({"metrics": [json.dumps(metrics.to_dict())]})
+
+
+def get_eval_metrics(results_ds: ray.data.Dataset) -> EvalMetrics:
+    """
+    Computes `EvalMetrics`, including per-tool error rates, by aggregating each block in parallel and merging the partial aggregates on the driver.
+    """
+    block_metrics = results_ds.map_batches(_get_block_metrics, batch_format="pandas")
+    return merge_metrics(
+        EvalMetrics.from_dict(json.loads(row["metrics"]))
+        for row in block_metrics.iter_rows()
+    )
+
+
+def write_results(results_ds: ray.data.Dataset, path: str) -> None:
+    """Writes the result records to Parquet."""
+    results_ds.write_parquet(path)
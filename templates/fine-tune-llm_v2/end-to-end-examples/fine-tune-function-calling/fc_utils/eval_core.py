@@ -2,10 +2,12 @@
 Evaluation utilities
 """
 
-from typing import Union, Tuple, List, Dict, Any
+import json
+from typing import Union, Tuple, List, Dict, Any, Callable, Optional
 from tqdm import tqdm
 from enum import Enum
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from fc_utils.response_parsers import (
     ERROR_OUTPUT,
@@ -51,6 +53,14 @@ class Model(Enum):
     BASE = "base"
 
 
+# Display names used in progress bars
+PBAR_MODEL_NAMES = {
+    Model.GPT: "GPT4",
+    Model.FINETUNED: "Finetuned Model",
+    Model.BASE: "Base Model",
+}
+
+
 @dataclass
 class Result:
     """Dataclass to store the evaluation results."""
@@ -192,6 +202,99 @@ def get_matching_tool_call_id(
     return tool_call_id
 
 
+def _to_result(
+    outcome: Tuple[List[MessageType], bool, Mistakes], example: Dict[str, Any]
+) -> Result:
+    """Converts the output of the parse and eval loop into a Result."""
+    conv, is_correct, mistake_type = outcome
+    return Result(
+        is_correct=is_correct,
+        # Entry is invalid if the api call failed
+        is_valid=conv is not None,
+        mistake_type=mistake_type,
+        generated_conv=conv,
+        ground_truth_conv=example["messages"],
+    )
+
+
+class ConversationEvaluator:
+    """
+    Step-wise parse and eval state for a single conversation.
+
+    `next_turn` walks the ground truth conversation up to the next assistant message, and `add_response` evaluates the
+    model's response for that turn. This lets callers decide how the requests for each turn are issued, e.g. one
+    conversation at a time in `parse_and_eval` or all conversations' turn-k requests together in `evaluate_model_by_turn`.
+    """
+
+    def __init__(self, example: Dict[str, Any]):
+        self.example = example
+        self.messages = example["messages"]
+        # Use safe indexing since this entry is optional
+        self.tools = example.get("tools", None)
+        self.generated_conv = []
+        self.previous_assistant_tool_calls = None
+        self.is_match = True
+        self.mistake_type = Mistakes.NONE
+        self.done = False
+        self.outcome = None
+        self._idx = 0
+
+    def _finish(
+        self,
+        generated_conv: List[MessageType],
+        is_match: bool,
+        mistake_type: Mistakes,
+    ) -> None:
+        self.done = True
+        self.outcome = (generated_conv, is_match, mistake_type)
+
+    def next_turn(self) -> bool:
+        """Advances to the next assistant message. Returns False if the conversation is done."""
+        while not self.done and self._idx < len(self.messages):
+            message = self.messages[self._idx]
+            if message["role"] == "assistant":
+                return True
+            self._idx += 1
+            if message["role"] == "tool":
+                # This is only in the case of the OpenAI format.
+                # We need to replace the dummy tool call id with the actual tool call id from the model response
+                try:
+                    message["tool_call_id"] = get_matching_tool_call_id(
+                        message, self.previous_assistant_tool_calls
+                    )
+                except ToolResponseIDNotFoundError as e:
+                    self._finish(None, None, Mistakes.NO_FUNCTION_CALL)
+                    return False
+            self.generated_conv.append(message)
+        if not self.done:
+            self._finish(self.generated_conv, self.is_match, self.mistake_type)
+        return False
+
+    def add_response(self, parsed_response: ParsedResponse) -> None:
+        """Evaluates the model's response for the current assistant message."""
+        message = self.messages[self._idx]
+        self._idx += 1
+        if parsed_response.content == ERROR_OUTPUT:
+            # Return None if there's an error
+            self._finish(None, None, None)
+            return
+
+        # Evaluate against the ground truth/ the current message
+        _match, self.mistake_type = check_match(parsed_response, message)
+        self.is_match = self.is_match and _match
+        # Convert response object to dict and append to the current conversation
+        original_assistant_response = dict(parsed_response.original_response)
+        self.generated_conv.append(original_assistant_response)
+        self.previous_assistant_tool_calls = parsed_response.tool_calls
+        # Return right away if model output is incorrect
+        if not self.is_match:
+            self._finish(self.generated_conv, self.is_match, self.mistake_type)
+
+    def get_result(self) -> Result:
+        """Returns the evaluation result once the conversation is done."""
+        return _to_result(self.outcome, self.example)
+
+
 def parse_and_eval(
     parser: ResponseParser, example: Dict[str, Any]
 ) -> Tuple[List[MessageType], bool, Mistakes]:
@@ -209,49 +312,33 @@ def parse_and_eval(
         match: Boolean indicating if the generated conversation matches the ground truth
         mistake_type: Mistake enum indicating the type of mistake made by the model if any
     """
-    messages = example["messages"]
-    # Use safe indexing since this entry is optional
-    tools = example.get("tools", None)
-    is_match = True
-    generated_conv = []
-    previous_assistant_tool_calls = None
-    for message in messages:
-        if message["role"] == "tool":
-            # This is only in the case of the OpenAI format.
-            # We need to replace the dummy tool call id with the actual tool call id from the model response
-            try:
-                message["tool_call_id"] = get_matching_tool_call_id(
-                    message, previous_assistant_tool_calls
-                )
-            except ToolResponseIDNotFoundError as e:
-                return None, None, Mistakes.NO_FUNCTION_CALL
-            generated_conv.append(message)
-        elif message["role"] != "assistant":
-            generated_conv.append(message)
-        else:
-            # Get the model's response
-            parsed_response = parser.get_parsed_response(generated_conv, tools)
+    evaluator = ConversationEvaluator(example)
+    while evaluator.next_turn():
+        # Get the model's response
+        evaluator.add_response(
+            parser.get_parsed_response(evaluator.generated_conv, evaluator.tools)
+        )
+    return evaluator.outcome
+
 
-            if parsed_response.content == ERROR_OUTPUT:
-                # Return None if there's an error
-                return None, None, None
+def _evaluate_example(parser: ResponseParser, example: Dict[str, Any]) -> Result:
+    """Evaluates a single conversation. Turns within the conversation are evaluated sequentially."""
+    # Query the model, parse and evaluate the generated responses
+    return _to_result(parse_and_eval(parser, example), example)
 
-            # Evaluate against the ground truth/ the current message
-            _match, mistake_type = check_match(parsed_response, message)
-            is_match = is_match and _match
-            # Convert response object to dict and append to the current conversation
-            original_assistant_response = dict(parsed_response.original_response)
-            generated_conv.append(original_assistant_response)
-            previous_assistant_tool_calls = parsed_response.tool_calls
-            # Return right away if model output is incorrect
-            if not is_match:
-                return generated_conv, is_match, mistake_type
 
-    return generated_conv, is_match, mistake_type
+def _get_accuracy(results: List[Result]) -> float:
+    """Returns the accuracy over valid results."""
+    corrects = [result.is_correct for result in results if result.is_valid]
+    return sum(corrects) / len(corrects) if corrects else 0.0
 
 
 def evaluate_model(
-    dataset: List[Dict[str, Any]], parser: ResponseParser, model: Model
+    dataset: List[Dict[str, Any]],
+    parser: ResponseParser,
+    model: Model,
+    max_concurrency: int = 1,
+    on_result: Optional[Callable[[Model, Result], None]] = None,
 ) -> Tuple[List[Result], float]:
     """
     Evaluates the given model on the test dataset. The function returns a list of results and the accuracy.
@@ -267,43 +354,117 @@ def evaluate_model(
         dataset: List of examples to evaluate
         parser: ResponseParser object
         model: Model enum indicating the model type to evaluate.
+        max_concurrency: Maximum number of conversations evaluated in parallel. Results are returned in dataset order.
+        on_result: Optional callback invoked with the model type and each result as soon as it is available, e.g. `eval_metrics.MetricsTracker`
 
     Returns:
         results: List of results
         accuracy: Float indicating the accuracy of the model
     """
-    # Initialize lists to store results
-    results = []
-    # Stores list of matches for valid results
-    corrects = []
-    if model == Model.GPT:
-        pbar_desc = "Evaluating GPT4..."
-    elif model == Model.FINETUNED:
-        pbar_desc = "Evaluating Finetuned Model..."
-    else:
-        pbar_desc = "Evaluating Base Model..."
-    pbar = tqdm(total=len(dataset), desc=pbar_desc)
-    for example in dataset:
-        # Entry is valid by default
-        is_valid = True
-
-        # Query the model, parse and evaluate the generated responses
-        conv, is_correct, mistake_type = parse_and_eval(parser, example)
-
-        is_valid = conv is not None
-        if is_valid:
-            corrects.append(is_correct)
-
-        result = Result(
-            is_correct=is_correct,
-            is_valid=is_valid,
-            mistake_type=mistake_type,
-            generated_conv=conv,
-            ground_truth_conv=example["messages"],
+    results = evaluate_models(
+        {model: dataset},
+        {model: parser},
+        max_concurrency=max_concurrency,
+        on_result=on_result,
+    )
+    return results[model]
+
+
+def evaluate_models(
+    datasets: Dict[Model, List[Dict[str, Any]]],
+    parsers: Dict[Model, ResponseParser],
+    max_concurrency: int = 8,
+    on_result: Optional[Callable[[Model, Result], None]] = None,
+) -> Dict[Model, Tuple[List[Result], float]]:
+    """
+    Evaluates several models at the same time, sharing a thread pool across all of them.
+
+    Conversations are evaluated in parallel (up to `max_concurrency` at a time), while the turns within each
+    conversation remain sequential. Results for each model are returned in dataset order.
+
+    Args:
+        datasets: Mapping from model type to the list of examples to evaluate
+        parsers: Mapping from model type to the ResponseParser object for that model
+        max_concurrency: Maximum number of conversations evaluated in parallel
+        on_result: Optional callback invoked with the model type and each result in completion order. It runs on the calling thread.
+
+    Returns:
+        results: Mapping from model type to the list of results and the accuracy
+    """
+    futures = {}
+    future_to_model = {}
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for model, dataset in datasets.items():
+            futures[model] = [
+                executor.submit(_evaluate_example, parsers[model], example)
+                for example in dataset
+            ]
+            future_to_model.update({future: model for future in futures[model]})
+        pbar = tqdm(
+            total=len(future_to_model),
+            desc=f"Evaluating {', '.join(PBAR_MODEL_NAMES[model] for model in futures)}...",
+        )
+        for future in as_completed(future_to_model):
+            if on_result is not None:
+                on_result(future_to_model[future], future.result())
+            pbar.update(1)
+        pbar.close()
+
+    all_results = {}
+    for model, model_futures in futures.items():
+        results = [future.result() for future in model_futures]
+        all_results[model] = (results, _get_accuracy(results))
+    return all_results
+
+
+def _prefix_sort_key(evaluator: ConversationEvaluator) -> str:
+    """Sort key that places requests with shared prefixes (tools, system prompt, earlier turns) next to each other."""
+    return json.dumps(evaluator.tools, sort_keys=True) + json.dumps(
+        evaluator.generated_conv, default=str
+    )
+
+
+def evaluate_model_by_turn(
+    dataset: List[Dict[str, Any]], parser: ResponseParser, model: Model
+) -> Tuple[List[Result], float]:
+    """
+    Evaluates the given model on the test dataset one turn at a time across all conversations.
+
+    The turn-k requests of all conversations still in progress are sent together with `parser.get_parsed_responses`,
+    sorted so that requests sharing a prefix (tool list, system prompt and earlier turns) are adjacent. With a backend
+    that supports prefix caching, such as a vLLM engine with prefix caching enabled, shared
+    prefixes are computed once, so the evaluation cost scales with new tokens rather than total context.
+
+    Args:
+        dataset: List of examples to evaluate
+        parser: ResponseParser object
+        model: Model enum indicating the model type to evaluate.
+
+    Returns:
+        results: List of results, in dataset order
+        accuracy: Float indicating the accuracy of the model
+    """
+    evaluators = [ConversationEvaluator(example) for example in dataset]
+    pending = [evaluator for evaluator in evaluators if evaluator.next_turn()]
+    # The progress bar counts finished conversations
+    pbar = tqdm(total=len(evaluators), initial=len(evaluators) - len(pending))
+    turn = 1
+    while pending:
+        pending.sort(key=_prefix_sort_key)
+        pbar.set_description(
+            f"Evaluating {PBAR_MODEL_NAMES[model]} (turn {turn}, {len(pending)} requests)..."
+        )
+        parsed_responses = parser.get_parsed_responses(
+            [evaluator.generated_conv for evaluator in pending],
+            [evaluator.tools for evaluator in pending],
         )
-        results.append(result)
-        pbar.update(1)
+        for evaluator, parsed_response in zip(pending, parsed_responses):
+            evaluator.add_response(parsed_response)
+        num_pending = len(pending)
+        pending = [evaluator for evaluator in pending if evaluator.next_turn()]
+        pbar.update(num_pending - len(pending))
+        turn += 1
     pbar.close()
 
-    accuracy = sum(corrects) / len(corrects) if corrects else 0.0
-    return results, accuracy
+    results = [evaluator.get_result() for evaluator in evaluators]
+    return results, _get_accuracy(results)
@@ -3,7 +3,7 @@ Preprocessing utilities for evaluation.
 """
 
 import re
-from typing import Tuple, Dict, Any, List
+from typing import Tuple, Dict, Any, List, Callable
 from functools import partial
 
 import ray.data
@@ -192,27 +192,24 @@ def test_mapper_base(
     return processed_example
 
 
-def get_evaluation_dataset(
-    test_ds: ray.data.Dataset,
+def get_test_data_mapper(
     tool_call_tags: IndicatorTags,
     tool_result_tags: IndicatorTags,
     tool_list_tags: IndicatorTags,
     model: Model,
-) -> List[Dict[str, Any]]:
+) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
     """
-    Handles the preprocessing of the test dataset for evaluation.
+    Returns the mapper that preprocesses a test example for evaluation of the given model.
 
     Args:
-        test_ds: The test dataset to preprocess
         tool_call_tags: Tuple containing the start and end tags for the tool call
         tool_result_tags: Tuple containing the start and end tags for the tool result
         tool_list_tags: Tuple containing the start and end tags for the tool list
-        format: The expected output data format. OpenAI and Anyscale are supported
+        model: The model type to evaluate
 
     Returns:
-        modified_ds: The preprocessed test dataset
+        test_data_mapper: Function mapping a test example to an evaluation example
     """
-    # Converts test_ds to a list of dicts because the nested structure of the modified dataset is not supported by PyArrow
     if model == Model.FINETUNED:
         test_data_mapper = partial(test_mapper_anyscale, tool_call_tags=tool_call_tags)
     elif model == Model.GPT:
@@ -230,6 +227,33 @@ def get_evaluation_dataset(
         )
     else:
         raise NotImplementedError(f"Model {model} is not supported for evaluation")
+    return test_data_mapper
+
+
+def get_evaluation_dataset(
+    test_ds: ray.data.Dataset,
+    tool_call_tags: IndicatorTags,
+    tool_result_tags: IndicatorTags,
+    tool_list_tags: IndicatorTags,
+    model: Model,
+) -> List[Dict[str, Any]]:
+    """
+    Handles the preprocessing of the test dataset for evaluation.
+
+    Args:
+        test_ds: The test dataset to preprocess
+        tool_call_tags: Tuple containing the start and end tags for the tool call
+        tool_result_tags: Tuple containing the start and end tags for the tool result
+        tool_list_tags: Tuple containing the start and end tags for the tool list
+        format: The expected output data format. OpenAI and Anyscale are supported
+
+    Returns:
+        modified_ds: The preprocessed test dataset
+    """
+    # Converts test_ds to a list of dicts because the nested structure of the modified dataset is not supported by PyArrow
+    test_data_mapper = get_test_data_mapper(
+        tool_call_tags, tool_result_tags, tool_list_tags, model
+    )
     modified_ds = []
     for example in test_ds.iter_rows():
         modified_ds.append(test_data_mapper(example))
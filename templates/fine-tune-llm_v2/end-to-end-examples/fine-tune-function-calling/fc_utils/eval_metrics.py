@@ -0,0 +1,202 @@
+"""
+Incremental evaluation metrics. Results are folded into running counts as they stream in, so metrics are available before an evaluation finishes.
+"""
+
+import os
+import json
+import tempfile
+from collections import Counter
+from typing import Dict, Any, Iterable, List, Optional
+
+from fc_utils.eval_core import Mistakes, Model, Result, PBAR_MODEL_NAMES
+from fc_utils.data_format import MessageType
+
+
+def _get_tool_names(message: MessageType) -> List[str]:
+    """Returns the names of the tool calls in a ground truth assistant message."""
+    tool_calls = message.get("tool_calls", None) or []
+    return [tool_call["function"]["name"] for tool_call in tool_calls]
+
+
+class EvalMetrics:
+    """
+    Running accuracy, mistake histogram and per-tool error rates for a single model.
+
+    Tool error rates are computed over the ground truth assistant turns that call the tool: a turn counts as an error
+    if the evaluation stopped at that turn. Aggregates from different workers can be combined with `merge`, and
+    partial aggregates can be checkpointed to disk with `save` and restored with `load`.
+    """
+
+    def __init__(self):
+        self.num_results = 0
+        self.num_valid = 0
+        self.num_correct = 0
+        self.mistake_counts = Counter()
+        self.tool_call_counts = Counter()
+        self.tool_error_counts = Counter()
+
+    def update(self, result: Result) -> None:
+        """Adds a single result to the running counts."""
+        self.num_results += 1
+        # Invalid entries are skipped, as in the accuracy calculation
+        if not result.is_valid:
+            return
+        self.num_valid += 1
+        if result.is_correct:
+            self.num_correct += 1
+        else:
+            self.mistake_counts[result.mistake_type.value] += 1
+
+        # The generated conversation mirrors the ground truth up to the last evaluated turn
+        num_evaluated = len(result.generated_conv)
+        for idx, message in enumerate(result.ground_truth_conv[:num_evaluated]):
+            if message["role"] != "assistant":
+                continue
+            is_error = not result.is_correct and idx == num_evaluated - 1
+            for tool_name in _get_tool_names(message):
+                self.tool_call_counts[tool_name] += 1
+                if is_error:
+                    self.tool_error_counts[tool_name] += 1
+
+    def update_all(self, results: Iterable[Result]) -> None:
+        """Adds a sequence of results to the running counts."""
+        for result in results:
+            self.update(result)
+
+    def merge(self, other: "EvalMetrics") -> "EvalMetrics":
+        """Returns a new aggregate combining the counts of both aggregates."""
+        merged = EvalMetrics()
+        for metrics in (self, other):
+            merged.num_results += metrics.num_results
+            merged.num_valid += metrics.num_valid
+            merged.num_correct += metrics.num_correct
+            merged.mistake_counts.update(metrics.mistake_counts)
+            merged.tool_call_counts.update(metrics.tool_call_counts)
+            merged.tool_error_counts.update(metrics.tool_error_counts)
+        return merged
+
+    @property
+    def accuracy(self) -> float:
+        """Accuracy over valid results."""
+        return self.num_correct / self.num_valid if self.num_valid else 0.0
+
+    def get_count_by_flag(self) -> Dict[Mistakes, int]:
+        """Returns the count of incorrect results by mistake type, in the format of `plot_utils.get_count_by_flag`."""
+        return {flag: self.mistake_counts[flag.value] for flag in Mistakes.instances()}
+
+    def get_tool_error_rates(self) -> Dict[str, float]:
+        """Returns the error rate for each tool name, sorted by decreasing error rate."""
+        error_rates = {
+            tool_name: self.tool_error_counts[tool_name] / count
+            for tool_name, count in self.tool_call_counts.items()
+        }
+        return dict(sorted(error_rates.items(), key=lambda item: -item[1]))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "num_results": self.num_results,
+            "num_valid": self.num_valid,
+            "num_correct": self.num_correct,
+            "mistake_counts": dict(self.mistake_counts),
+            "tool_call_counts": dict(self.tool_call_counts),
+            "tool_error_counts": dict(self.tool_error_counts),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "EvalMetrics":
+        metrics = cls()
+        metrics.num_results = data["num_results"]
+        metrics.num_valid = data["num_valid"]
+        metrics.num_correct = data["num_correct"]
+        metrics.mistake_counts = Counter(data["mistake_counts"])
+        metrics.tool_call_counts = Counter(data["tool_call_counts"])
+        metrics.tool_error_counts = Counter(data["tool_error_counts"])
+        return metrics
+
+    def save(self, path: str) -> None:
+        """Checkpoints the aggregate to a JSON file. Writes are atomic so a crash never leaves a partial checkpoint."""
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=dirname, suffix=".tmp", delete=False
+        ) as f:
+            json.dump(self.to_dict(), f)
+        os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path: str) -> "EvalMetrics":
+        """Loads an aggregate from a checkpoint written with `save`."""
+        with open(path, "r") as f:
+            return cls.from_dict(json.load(f))
+
+    def __repr__(self) -> str:
+        return (
+            f"EvalMetrics(num_results={self.num_results}, num_valid={self.num_valid}, "
+            f"accuracy={self.accuracy:.4f})"
+        )
+
+
+def merge_metrics(metrics_list: Iterable[EvalMetrics]) -> EvalMetrics:
+    """Merges aggregates from several workers into one."""
+    merged = EvalMetrics()
+    for metrics in metrics_list:
+        merged = merged.merge(metrics)
+    return merged
+
+
+class MetricsTracker:
+    """
+    Result callback for `evaluate_model`/`evaluate_models` that maintains `EvalMetrics` per model.
+
+    Metrics are checkpointed to `{checkpoint_dir}/{model}_metrics.json` every `checkpoint_every` results, so a partial
+    evaluation can be inspected with `EvalMetrics.load`, and the mistake histograms are re-plotted every `plot_every`
+    results if set.
+    """
+
+    def __init__(
+        self,
+        checkpoint_dir: Optional[str] = None,
+        checkpoint_every: int = 100,
+        plot_every: Optional[int] = None,
+    ):
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.plot_every = plot_every
+        self.metrics: Dict[Model, EvalMetrics] = {}
+        self._num_updates = 0
+
+    def _get_checkpoint_path(self, model: Model) -> str:
+        return os.path.join(self.checkpoint_dir, f"{model.value}_metrics.json")
+
+    def get_metrics(self, model: Model) -> EvalMetrics:
+        """Returns the running metrics for the model."""
+        if model not in self.metrics:
+            self.metrics[model] = EvalMetrics()
+        return self.metrics[model]
+
+    def __call__(self, model: Model, result: Result) -> None:
+        self.get_metrics(model).update(result)
+        self._num_updates += 1
+        if self.checkpoint_dir is not None and (
+            self._num_updates % self.checkpoint_every == 0
+        ):
+            self.checkpoint()
+        if self.plot_every is not None and self._num_updates % self.plot_every == 0:
+            self.plot()
+
+    def checkpoint(self) -> None:
+        """Writes the metrics for all models to the checkpoint directory."""
+        for model, metrics in self.metrics.items():
+            metrics.save(self._get_checkpoint_path(model))
+
+    def plot(self) -> None:
+        """Plots the current mistake histograms for all models."""
+        # Imported here since plot_utils depends on this module
+        from fc_utils.plot_utils import plot_metrics
+
+        plot_metrics(
+            {
+                PBAR_MODEL_NAMES[model]: metrics
+                for model, metrics in self.metrics.items()
+            }
+        )
@@ -4,9 +4,19 @@ Function call json extraction utils.
 
 import json
 import re
-from typing import List, Dict, Any, Tuple, Union, Optional
+import functools
+from typing import List, Dict, Any, Tuple, Union, Optional, Pattern
 from enum import Enum
 
+try:
+    # orjson is considerably faster than the standard library for decoding and raises
+    # orjson.JSONDecodeError, a subclass of json.JSONDecodeError
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 from fc_utils.data_format import (
     IndicatorTags,
     ToolCallType,
@@ -39,6 +49,15 @@ class FunctionFormatError(Exception):
     pass
 
 
+@functools.lru_cache(maxsize=None)
+def _get_tag_patterns(indicator_tags: IndicatorTags) -> Tuple[Pattern, Pattern]:
+    """Returns compiled patterns for content between the tags, without and with a prefix. Cached per tag pair."""
+    escaped_tags = [re.escape(tag) for tag in indicator_tags]
+    no_prefix_pattern = re.compile(r"{}([\s\S]*?){}".format(*escaped_tags))
+    prefix_pattern = re.compile(r"([\s\S]*?){}([\s\S]*?){}".format(*escaped_tags))
+    return no_prefix_pattern, prefix_pattern
+
+
 def extract_segment_between_tags(
     string: str, indicator_tags: IndicatorTags
 ) -> Tuple[Optional[str], str]:
@@ -56,16 +75,18 @@ def extract_segment_between_tags(
         special_content: The content between the tags
     """
     string = string.strip()
-    escaped_tags = [re.escape(tag) for tag in indicator_tags]
+    no_prefix_pattern, prefix_pattern = _get_tag_patterns(
+        IndicatorTags(*indicator_tags)
+    )
 
     if string.startswith(indicator_tags.start):
-        pattern = r"{}([\s\S]*?){}".format(*escaped_tags)
+        pattern = no_prefix_pattern
         extract_prefix = False
     else:
-        pattern = r"([\s\S]*?){}([\s\S]*?){}".format(*escaped_tags)
+        pattern = prefix_pattern
         extract_prefix = True
 
-    pattern_match = re.search(pattern, string)
+    pattern_match = pattern.search(string)
     if not pattern_match:
         raise PatternNotFoundError(
             f"No content found in the string {string} with the given tags {indicator_tags}"
@@ -80,8 +101,34 @@ def extract_segment_between_tags(
     return prefix, special_content
 
 
+_JSON_DECODER = json.JSONDecoder()
+
+
+def scan_json_objects(string: str) -> List[Dict[str, Any]]:
+    """Scans a string for consecutive JSON objects and decodes them in a single pass.
+
+    Each object is decoded from its opening brace with `JSONDecoder.raw_decode`, so nested objects and braces inside strings are handled correctly. Text outside of the objects is skipped.
+
+    Args:
+        string: The input string
+
+    Returns:
+        json_objects: List of decoded JSON objects in the order they appear
+
+    Raises:
+        json.JSONDecodeError: If an object is not valid JSON
+    """
+    json_objects = []
+    start = string.find("{")
+    while start != -1:
+        json_obj, end = _JSON_DECODER.raw_decode(string, start)
+        json_objects.append(json_obj)
+        start = string.find("{", end)
+    return json_objects
+
+
 def _extract_functions_from_system_msg_glaive(system_str: str) -> List[Dict[str, Any]]:
-    """Extracts the functions from the system message with a simple regex pattern.
+    """Extracts the functions from the system message with a brace-balanced JSON scanner.
 
     If the function is not a valid JSON, an error is raised
 
@@ -91,20 +138,14 @@ def _extract_functions_from_system_msg_glaive(system_str: str) -> List[Dict[str,
     Returns:
         functions: List of functions successfully extracted from the system message in the OpenAI format
     """
-    # Extracting the functions using regex
-    functions_match = re.findall(r"\{.*?\}(?=\s*\{|\s*$)", system_str, re.DOTALL)
-    functions = []
-
-    for fn in functions_match:
-        try:
-            # Convert string representation of dictionary to actual dictionary
-            fn_dict = json.loads(fn)
-            functions.append(fn_dict)
-        except json.JSONDecodeError:
-            # In case the string is not a valid JSON, raise an error
-            raise FunctionFormatError(
-                f"Tool list not in the correct format in : {system_str}"
-            )
+    try:
+        # Convert string representation of each dictionary to actual dictionary
+        functions = scan_json_objects(system_str)
+    except json.JSONDecodeError:
+        # In case the string is not a valid JSON, raise an error
+        raise FunctionFormatError(
+            f"Tool list not in the correct format in : {system_str}"
+        )
 
     # Some functions may not have parameters. Fix them
     for fn in functions:
@@ -132,7 +173,7 @@ def _extract_functions_from_system_msg_anyscale(
         tools: The list of tools extracted from the system message
     """
     _, tool_list_str = extract_segment_between_tags(system_msg, tool_list_tags)
-    tools = json.loads(tool_list_str)
+    tools = json_loads(tool_list_str)
     if not isinstance(tools, list):
         tools = [tools]
     return tools
@@ -170,7 +211,7 @@ def _parse_function_calls_glaive(string: str) -> List[Dict[str, Any]]:
     # Remove single quotes used for the arguments field.
     string = string.replace("'", "")
     # Parse the string into a list of JSONs
-    json_list = json.loads(string)
+    json_list = json_loads(string)
     if isinstance(json_list, dict):
         json_list = [json_list]
     return json_list
@@ -190,7 +231,7 @@ def _parse_function_calls_openai(string: str) -> List[Dict[str, Any]]:
         json_list: List of JSONs representing the function calls.
     """
     # Parse the string into a list of JSONs
-    json_list = json.loads(string)
+    json_list = json_loads(string)
     if isinstance(json_list, dict):
         json_list = [json_list]
     for json_obj in json_list:
@@ -198,7 +239,7 @@ def _parse_function_calls_openai(string: str) -> List[Dict[str, Any]]:
             raise FunctionCallFormatError(
                 f"Function call not in the correct format in : {string}"
             )
-        json_obj["function"]["arguments"] = json.loads(
+        json_obj["function"]["arguments"] = json_loads(
             json_obj["function"]["arguments"]
         )
     return json_list
@@ -264,7 +305,7 @@ def parse_tool_result(string: str, tool_result_tags: Tuple[str, str]) -> Dict[st
     """
     try:
         _, tool_result_str = extract_segment_between_tags(string, tool_result_tags)
-        result = json.loads(tool_result_str)
+        result = json_loads(tool_result_str)
     except (PatternNotFoundError, json.JSONDecodeError) as e:
         # Propagate a custom exception for use later
         raise FunctionResponseFormatError(f"Tool result could not be found : {e}")
@@ -5,8 +5,10 @@ Plot utils for visualizing the results of the finetuned model and GPT-4.
 import numpy as np
 import matplotlib.pyplot as plt
 from typing import List, Dict
+from IPython.display import clear_output
 
 from fc_utils.eval_core import Mistakes, Result
+from fc_utils.eval_metrics import EvalMetrics
 
 # Colors for the different mistake types
 COLORS = {
@@ -61,47 +63,81 @@ def plot_results(
     counts_finetuned = get_count_by_flag(results_finetuned, flags)
     counts_gpt = get_count_by_flag(results_gpt, flags)
 
-    # Data for stacked bars
-    mistakes_by_flag_base = [counts_base[flag] for flag in flags]
-    mistakes_by_flag_finetuned = [counts_finetuned[flag] for flag in flags]
-    mistakes_by_flag_gpt = [counts_gpt[flag] for flag in flags]
+    _plot_mistake_counts(
+        {
+            "Base Model": counts_base,
+            "Finetuned Model": counts_finetuned,
+            "GPT-4": counts_gpt,
+        },
+        max_incorrect=max(
+            total_incorrect_base, total_incorrect_finetuned, total_incorrect_gpt
+        ),
+        total_count=total_count,
+    )
+
+
+def plot_metrics(
+    metrics_by_name: Dict[str, EvalMetrics],
+    clear: bool = True,
+):
+    """
+    Plots the mistake histograms of incremental metrics, e.g. while an evaluation is still running.
+
+    Args:
+        metrics_by_name: Mapping from display name (e.g. "Finetuned Model") to the metrics for that model
+        clear: Whether to replace the previous plot in the notebook output, so that repeated calls update a single live plot
+    """
+    if clear:
+        clear_output(wait=True)
+    counts_by_name = {
+        name: metrics.get_count_by_flag() for name, metrics in metrics_by_name.items()
+    }
+    for name, metrics in metrics_by_name.items():
+        print(
+            f"{name}: accuracy {metrics.accuracy:.4f} over {metrics.num_valid} valid results"
+        )
+    _plot_mistake_counts(
+        counts_by_name,
+        max_incorrect=max(
+            metrics.num_valid - metrics.num_correct
+            for metrics in metrics_by_name.values()
+        ),
+        total_count=max(metrics.num_results for metrics in metrics_by_name.values()),
+    )
+
+
+def _plot_mistake_counts(
+    counts_by_name: Dict[str, Dict[Mistakes, int]],
+    max_incorrect: int,
+    total_count: int,
+):
+    """Plots one stacked bar of mistake counts per model."""
+    flags = Mistakes.instances()
+    names = list(counts_by_name)
 
     # Bar positions
-    positions = np.arange(3)
+    positions = np.arange(len(names))
 
     # Create the plot
     fig, ax = plt.subplots()
 
     # Create stacked bars
-    bottom_base = np.zeros(1)
-    bottom_finetuned = np.zeros(1)
-    bottom_gpt = np.zeros(1)
-
-    for i, flag in enumerate(flags):
-        if (
-            mistakes_by_flag_base[i] == 0
-            and mistakes_by_flag_finetuned[i] == 0
-            and mistakes_by_flag_gpt[i] == 0
-        ):
+    bottoms = [np.zeros(1) for _ in names]
+
+    for flag in flags:
+        if all(counts_by_name[name][flag] == 0 for name in names):
             # Skip if no mistakes of this type
             continue
-        ax.bar(
-            0,
-            mistakes_by_flag_base[i],
-            bottom=bottom_base,
-            color=COLORS[flag],
-            label=f"{flag.value}",
-        )
-        ax.bar(
-            1,
-            mistakes_by_flag_finetuned[i],
-            bottom=bottom_finetuned,
-            color=COLORS[flag],
-        )
-        ax.bar(2, mistakes_by_flag_gpt[i], bottom=bottom_gpt, color=COLORS[flag])
-        bottom_base += mistakes_by_flag_base[i]
-        bottom_finetuned += mistakes_by_flag_finetuned[i]
-        bottom_gpt += mistakes_by_flag_gpt[i]
+        for position, name in enumerate(names):
+            ax.bar(
+                position,
+                counts_by_name[name][flag],
+                bottom=bottoms[position],
+                color=COLORS[flag],
+                # Only label the first bar to avoid duplicate legend entries
+                label=f"{flag.value}" if position == 0 else None,
+            )
+            bottoms[position] += counts_by_name[name][flag]
 
     # Add labels and title
     ax.set_xlabel("Results")
@@ -109,9 +145,7 @@ def plot_results(
     ax.set_title("Error Analysis")
     ax.set_xticks(positions)
     # add 5 to the max count for a nicer plot
-    max_count = (
-        max(total_incorrect_base, total_incorrect_finetuned, total_incorrect_gpt) + 5
-    )
+    max_count = max_incorrect + 5
     ax.set_ylim(
         # Set the y-axis limit to be at least 20% of the total count for a better plot
         ymax=max(
@@ -119,7 +153,7 @@ def plot_results(
             0.2 * total_count,
         )
     )
-    ax.set_xticklabels(["Base Model", "Finetuned Model", "GPT-4"])
+    ax.set_xticklabels(names)
     ax.legend()
 
     # Display the chart
@@ -2,14 +2,20 @@
 Preprocessing utils for Glaive AI's function calling dataset
 """
 
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Iterator, Optional, Tuple, Callable
 
-import re
 import json
 import logging
+import shutil
+import tempfile
 from pathlib import Path
+from enum import Enum
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import ray.data
+from ray.data import SaveMode
 
 from fc_utils.function_extraction_utils import (
     get_tool_calls_from_response,
@@ -30,6 +36,8 @@ from fc_utils.data_format import (
     TOOL_CALL_TAGS,
     TOOL_RESULT_TAGS,
     TOOL_LIST_TAGS,
+    OPENAI_CONVERSATION_SCHEMA,
+    ANYSCALE_CONVERSATION_SCHEMA,
 )
 
 
@@ -91,19 +99,83 @@ def combine_multiple_entries(assistant_content: str) -> str:
         or GLAIVEAI_TOOL_CALL_PREFIX not in assistant_content
     ):
         return assistant_content
-    else:
-        assistant_tag = GlaiveAIRoleTags.ASSISTANT.value
-        fn_call_pattern = r"([\s\S]*?){}\s+{}([\s\S]*)".format(
-            re.escape(assistant_tag), re.escape(GLAIVEAI_TOOL_CALL_PREFIX)
-        )
-        function_call_match = re.search(fn_call_pattern, assistant_content, re.DOTALL)
-        if function_call_match:
-            content1 = function_call_match.group(1).strip()
-            content2 = function_call_match.group(2).strip()
-            assistant_content = content1 + GLAIVEAI_TOOL_CALL_PREFIX + content2
+    assistant_tag = GlaiveAIRoleTags.ASSISTANT.value
+    # Find the first assistant tag followed by whitespace and a function call
+    tag_idx = assistant_content.find(assistant_tag)
+    while tag_idx != -1:
+        content_start = tag_idx + len(assistant_tag)
+        fn_call_idx = content_start
+        while (
+            fn_call_idx < len(assistant_content)
+            and assistant_content[fn_call_idx].isspace()
+        ):
+            fn_call_idx += 1
+        if fn_call_idx > content_start and assistant_content.startswith(
+            GLAIVEAI_TOOL_CALL_PREFIX, fn_call_idx
+        ):
+            content1 = assistant_content[:tag_idx].strip()
+            content2 = assistant_content[
+                fn_call_idx + len(GLAIVEAI_TOOL_CALL_PREFIX) :
+            ].strip()
+            return content1 + GLAIVEAI_TOOL_CALL_PREFIX + content2
+        tag_idx = assistant_content.find(assistant_tag, content_start)
     return assistant_content
 
 
+class _TagScanner:
+    """Finds the next occurrence of each role tag in a chat string.
+
+    Queries must be made at non-decreasing positions, so each tag is searched for at most once per occurrence and a full scan is linear in the length of the chat.
+    """
+
+    def __init__(self, chat: str, tags: List[str]):
+        self.chat = chat
+        # Index of the next occurrence of each tag at or after the last queried position
+        self.next_idx = {tag: -1 for tag in tags}
+
+    def find(self, tag: str, pos: int) -> int:
+        """Returns the index of the first occurrence of the tag at or after pos, or the length of the chat if not found."""
+        if self.next_idx[tag] < pos:
+            idx = self.chat.find(tag, pos)
+            self.next_idx[tag] = idx if idx != -1 else len(self.chat)
+        return self.next_idx[tag]
+
+    def find_first(self, tags: List[str], pos: int) -> Tuple[int, Optional[str]]:
+        """Returns the index and value of the earliest tag at or after pos."""
+        first_idx, first_tag = len(self.chat), None
+        for tag in tags:
+            idx = self.find(tag, pos)
+            if idx < first_idx:
+                first_idx, first_tag = idx, tag
+        return first_idx, first_tag
+
+
+def _scan_chat_segments(chat: str) -> Iterator[Tuple[GlaiveAIRoleTags, str]]:
+    """Splits a chat string in the Glaive format into (role tag, content) segments in a single pass.
+
+    A user message runs until the next assistant tag, an assistant message until the next user or tool tag, and a tool message until the next tool or assistant tag. Text before the first tag is ignored.
+    """
+    user_tag = GlaiveAIRoleTags.USER.value
+    assistant_tag = GlaiveAIRoleTags.ASSISTANT.value
+    tool_tag = GlaiveAIRoleTags.TOOL.value
+    end_tags = {
+        user_tag: [assistant_tag],
+        assistant_tag: [tool_tag, user_tag],
+        tool_tag: [tool_tag, assistant_tag],
+    }
+    scanner = _TagScanner(chat, [user_tag, assistant_tag, tool_tag])
+    pos = 0
+    while True:
+        tag_idx, tag = scanner.find_first([user_tag, assistant_tag, tool_tag], pos)
+        if tag is None:
+            return
+        content_start = tag_idx + len(tag)
+        while content_start < len(chat) and chat[content_start].isspace():
+            content_start += 1
+        pos, _ = scanner.find_first(end_tags[tag], content_start)
+        yield GlaiveAIRoleTags(tag), chat[content_start:pos].rstrip()
+
+
 def chat_str_to_messages(chat: str) -> List[MessageType]:
     """Helper function to convert the chat string in the Glaive format into a list of messages in the OpenAI format.
 
@@ -114,29 +186,20 @@ def chat_str_to_messages(chat: str) -> List[MessageType]:
     Returns:
         messages: List of messages in the OpenAI format
     """
-    user_tag = GlaiveAIRoleTags.USER.value
-    assistant_tag = GlaiveAIRoleTags.ASSISTANT.value
-    tool_tag = GlaiveAIRoleTags.TOOL.value
-    # Regex pattern to extract user, assistant and tool messages.
-    tag_pattern = re.compile(
-        rf"(?:{user_tag}\s*(?P<user>.*?)\s*(?={assistant_tag}|$)|{assistant_tag}\s*(?P<assistant>.*?)\s*(?={tool_tag}|{user_tag}|$)|{tool_tag}\s*(?P<function_response>.*?)\s*(?={tool_tag}|{assistant_tag}|$))",
-        re.DOTALL,
-    )
-
-    matches = tag_pattern.finditer(chat)
-    # If no matches found, raise an error
-    if not matches:
-        raise TagsNotFoundError(f"No user/assistant/tool message found in {chat}")
     messages = []
     # Keep track of the tool call ids and function names in the previous assistant response
     previous_tool_calls_info = []
-    # Loop through all matches and extract the respective roles and content
-    for match in matches:
-        if match.group("user"):
-            user_content = match.group("user").strip()
+    # Loop through all segments and extract the respective roles and content
+    for role_tag, content in _scan_chat_segments(chat):
+        if not content:
+            # Sometimes, the input can be malformed with no content for a role.
+            # Example: 'USER: \n'. Skip these entries
+            continue
+        if role_tag == GlaiveAIRoleTags.USER:
+            user_content = content.strip()
             msg = {"role": "user", "content": user_content}
-        elif match.group("assistant"):
-            assistant_content = match.group("assistant").strip()
+        elif role_tag == GlaiveAIRoleTags.ASSISTANT:
+            assistant_content = content.strip()
             assistant_content = combine_multiple_entries(assistant_content)
 
             # Glaive dataset is full of single function calls.
@@ -181,8 +244,8 @@ def chat_str_to_messages(chat: str) -> List[MessageType]:
                 previous_tool_calls_info.append(
                     (f"call_{i+1}", tool_call["function"]["name"])
                 )
-        elif match.group("function_response"):
-            function_response = match.group("function_response").strip()
+        else:
+            function_response = content.strip()
             role = "tool"
             # Get the previous tool call id. Raise an error if no tool call id is found
             if not len(previous_tool_calls_info):
@@ -196,10 +259,6 @@ def chat_str_to_messages(chat: str) -> List[MessageType]:
                 "name": tool_call_name,
                 "tool_call_id": tool_call_id,
             }
-        else:
-            # Sometimes, the input can be malformed with no content in the captured group.
-            # Example: 'USER: \n'. Skip these entries
-            continue
         messages.append(msg)
     return messages
 
@@ -214,15 +273,13 @@ def _openai_to_anyscale(example: Dict[str, Any]) -> Dict[str, Any]:
     ), "First message must be from system"
     anyscale_messages = []
     openai_messages = example["messages"]
-    tools = example["tools"]
-    # Convert the stringified tools to a list of jsons
-    tools = json.loads(tools) if tools else []
+    # The tools are already stringified, so they can be added to the system message as is
+    tools_str = example["tools"]
     for message in openai_messages:
         if message["role"] == "system":
             anyscale_message = {"role": "system", "content": message["content"]}
-            if len(tools):
-                # Convert to string and add tool list tags
-                tools_str = json.dumps(tools)
+            if tools_str and tools_str != "[]":
+                # Add tool list tags
                 tools_str_with_tags = (
                     f"{TOOL_LIST_TAGS.start} {tools_str} {TOOL_LIST_TAGS.end}"
                 )
@@ -230,9 +287,11 @@ def _openai_to_anyscale(example: Dict[str, Any]) -> Dict[str, Any]:
         elif message["role"] == "assistant":
             tool_calls = message["tool_calls"]
             anyscale_message = {"role": "assistant", "content": message["content"]}
-            if isinstance(tool_calls, list) and len(tool_calls):
+            if tool_calls is not None and len(tool_calls):
                 # Convert list of tool_calls to string and add tool call tags
-                tool_calls_str = json.dumps(tool_calls)
+                tool_calls_str = json.dumps(
+                    [dict(tool_call) for tool_call in tool_calls]
+                )
                 tool_calls_str_with_tags = (
                     f"{TOOL_CALL_TAGS.start} {tool_calls_str} {TOOL_CALL_TAGS.end}"
                 )
@@ -285,26 +344,174 @@ def filter_func(example: Dict[str, Any]) -> bool:
     return is_good_entry
 
 
+class InvalidReason(Enum):
+    """Reason codes for invalid examples found during batch validation."""
+
+    NONE = ""
+    PARSE_ERROR = "parse_error"
+    CONSECUTIVE_ROLES = "consecutive_roles"
+    EMBEDDED_ASSISTANT_TAG = "embedded_assistant_tag"
+    INVALID_TOOL_CALL = "invalid_tool_call"
+
+
+def _parents_matching(
+    parent_indices: np.ndarray, mask: pa.Array, num_rows: int
+) -> np.ndarray:
+    """Returns a per-row boolean array that is True for rows with at least one matching child element."""
+    matched = np.zeros(num_rows, dtype=bool)
+    matched[parent_indices[mask.to_numpy(zero_copy_only=False)]] = True
+    return matched
+
+
+def validate_batch(batch: pa.Table) -> pa.Table:
+    """Validates a batch of examples in the OpenAI format on the whole Arrow block at once.
+
+    Applies the checks of `filter_func` (consecutive messages from the same role, assistant tags embedded in a message)
+    along with a schema check of the tool calls, and adds an `is_valid` mask and an `invalid_reason` column with
+    `InvalidReason` values. If an example fails several checks, the first reason in the order above is reported.
+    """
+    num_rows = batch.num_rows
+    messages = batch.column("messages").combine_chunks()
+    parent_indices = pc.list_parent_indices(messages).to_numpy()
+    flat_messages = pc.list_flatten(messages)
+    roles = pc.struct_field(flat_messages, "role")
+    contents = pc.fill_null(pc.struct_field(flat_messages, "content"), "")
+    # The last message of each example is excluded from the embedded tag check, as in `filter_func`
+    same_parent_as_next = parent_indices[:-1] == parent_indices[1:]
+
+    # Two consecutive messages from the same role
+    consecutive_roles = np.zeros(len(parent_indices), dtype=bool)
+    consecutive_roles[:-1] = same_parent_as_next & (
+        pc.equal(roles[:-1], roles[1:]).to_numpy(zero_copy_only=False)
+    )
+    # Assistant tag embedded in a message
+    embedded_tag = np.zeros(len(parent_indices), dtype=bool)
+    embedded_tag[:-1] = same_parent_as_next & pc.match_substring(
+        contents[:-1], GlaiveAIRoleTags.ASSISTANT.value
+    ).to_numpy(zero_copy_only=False)
+
+    # Tool calls should be function calls with a name and stringified JSON object arguments
+    tool_calls = pc.struct_field(flat_messages, "tool_calls")
+    tool_call_parents = parent_indices[pc.list_parent_indices(tool_calls).to_numpy()]
+    flat_tool_calls = pc.list_flatten(tool_calls)
+    functions = pc.struct_field(flat_tool_calls, "function")
+    arguments = pc.utf8_trim_whitespace(pc.struct_field(functions, "arguments"))
+    is_valid_tool_call = pc.and_kleene(
+        pc.and_kleene(
+            pc.equal(pc.struct_field(flat_tool_calls, "type"), "function"),
+            pc.is_valid(pc.struct_field(functions, "name")),
+        ),
+        pc.and_kleene(pc.starts_with(arguments, "{"), pc.ends_with(arguments, "}")),
+    )
+    invalid_tool_call = pc.invert(pc.fill_null(is_valid_tool_call, False))
+
+    reasons = np.full(num_rows, InvalidReason.NONE.value, dtype=object)
+    # Assign reasons from the lowest to the highest priority so that the first failing check wins
+    for reason, matched in [
+        (
+            InvalidReason.INVALID_TOOL_CALL,
+            _parents_matching(tool_call_parents, invalid_tool_call, num_rows),
+        ),
+        (
+            InvalidReason.EMBEDDED_ASSISTANT_TAG,
+            _parents_matching(parent_indices, pa.array(embedded_tag), num_rows),
+        ),
+        (
+            InvalidReason.CONSECUTIVE_ROLES,
+            _parents_matching(parent_indices, pa.array(consecutive_roles), num_rows),
+        ),
+        (
+            InvalidReason.PARSE_ERROR,
+            pc.is_null(messages).to_numpy(zero_copy_only=False),
+        ),
+    ]:
+        reasons[matched] = reason.value
+
+    return batch.append_column(
+        "is_valid", pa.array(reasons == InvalidReason.NONE.value)
+    ).append_column("invalid_reason", pa.array(reasons, type=pa.string()))
+
+
+def _drop_invalid(batch: pa.Table) -> pa.Table:
+    """Drops invalid examples along with the validation columns."""
+    return batch.filter(batch.column("is_valid")).drop(["is_valid", "invalid_reason"])
+
+
+def get_validation_report(ray_ds: ray.data.Dataset) -> Dict[str, int]:
+    """Returns the number of examples per `InvalidReason` for a dataset returned by `glaive_to_openai(..., keep_invalid=True)`."""
+    counts = ray_ds.groupby("invalid_reason").count().take_all()
+    return {row["invalid_reason"]: row["count()"] for row in counts}
+
+
+def _map_to_arrow(
+    batch: pa.Table,
+    mapper: Callable[[Dict[str, Any]], Dict[str, Any]],
+    schema: pa.Schema,
+) -> pa.Table:
+    """Applies a row mapper to an Arrow batch and returns a table with the given schema."""
+    return pa.Table.from_pylist(
+        [mapper(row) for row in batch.to_pylist()], schema=schema
+    )
+
+
 def openai_to_anyscale(ray_ds: ray.data.Dataset) -> ray.data.Dataset:
     """Preprocesses the input dataset into an Anyscale compatible format .
 
     The input dataset is expected to be in the OpenAI messages format.
     """
-    ray_ds = ray_ds.map(_openai_to_anyscale)
+    ray_ds = ray_ds.map_batches(
+        _map_to_arrow,
+        batch_format="pyarrow",
+        fn_kwargs=dict(mapper=_openai_to_anyscale, schema=ANYSCALE_CONVERSATION_SCHEMA),
+    )
     return ray_ds
 
 
-def glaive_to_openai(ray_ds: ray.data.Dataset) -> ray.data.Dataset:
-    """Preprocesses the input GlaiveAI dataset into the OpenAI format"""
-    ray_ds = ray_ds.map(_glaive_to_openai)
-    ray_ds = ray_ds.filter(lambda x: x["messages"] is not None)
-    ray_ds = ray_ds.filter(filter_func)
+def glaive_to_openai(
+    ray_ds: ray.data.Dataset, keep_invalid: bool = False
+) -> ray.data.Dataset:
+    """Preprocesses the input GlaiveAI dataset into the OpenAI format
+
+    Examples are validated per block with `validate_batch` and invalid ones are dropped. If `keep_invalid` is True,
+    all examples are kept along with the `is_valid` and `invalid_reason` columns, e.g. for `get_validation_report`.
+    """
+    ray_ds = ray_ds.map_batches(
+        _map_to_arrow,
+        batch_format="pyarrow",
+        fn_kwargs=dict(mapper=_glaive_to_openai, schema=OPENAI_CONVERSATION_SCHEMA),
+    )
+    ray_ds = ray_ds.map_batches(validate_batch, batch_format="pyarrow")
+    if not keep_invalid:
+        ray_ds = ray_ds.map_batches(_drop_invalid, batch_format="pyarrow")
     return ray_ds
 
 
-def save_to_jsonl(ds: ray.data.Dataset, filepath: str) -> None:
-    """Saves a Ray dataset to a jsonl file."""
+def save_to_jsonl(
+    ds: ray.data.Dataset, filepath: str, concatenate: bool = True
+) -> None:
+    """Saves a Ray dataset to a jsonl file.
 
-    Path(filepath).parent.mkdir(parents=True, exist_ok=True)
-    df = ds.to_pandas()
-    df.to_json(filepath, orient="records", lines=True)
+    Blocks are written in parallel as jsonl shards. If `concatenate` is True, the shards are written to a fresh temporary
+    directory next to `filepath`, streamed into a single file at `filepath` and removed. Otherwise, `filepath` is a
+    directory of shards and any existing shards in it are overwritten. Row order is not preserved, since shards are
+    named by write task rather than by position in the dataset.
+    """
+    filepath = Path(filepath)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    if not concatenate:
+        ds.write_json(str(filepath), mode=SaveMode.OVERWRITE)
+        return
+    shard_dir = Path(tempfile.mkdtemp(prefix=f"{filepath.name}.", dir=filepath.parent))
+    try:
+        ds.write_json(str(shard_dir), mode=SaveMode.OVERWRITE)
+        with open(filepath, "wb") as f:
+            for shard_path in sorted(shard_dir.glob("*.json")):
+                with open(shard_path, "rb") as shard:
+                    shutil.copyfileobj(shard, f)
+                    # Make sure every shard ends with a newline before appending the next one
+                    if shard.tell() > 0:
+                        shard.seek(-1, 2)
+                        if shard.read(1) != b"\n":
+                            f.write(b"\n")
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
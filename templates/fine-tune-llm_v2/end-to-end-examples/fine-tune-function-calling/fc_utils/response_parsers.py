@@ -1,15 +1,24 @@
 """
 Response parsers for Anyscale and OpenAI models. We define two parser classes `AnyscaleResponseParser` and
-`OpenAIResponseParser` below to send messages to the respective endpoints and parse the result.
+`OpenAIResponseParser` below to send messages to the respective endpoints and parse the result. `VLLMResponseParser`
+runs a model (and LoRA adapter) offline with vLLM instead of querying an endpoint.
 """
 
 import json
 import time
+import os
+import hashlib
+import logging
+import tempfile
+import uuid
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABC, abstractmethod
 from typing import Dict, Any, List, Tuple, Optional
 from dataclasses import dataclass
 import openai
 from openai import OpenAI
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
 
 from fc_utils.function_extraction_utils import (
     FunctionCallFormatError,
@@ -63,9 +72,102 @@ def get_completion(
     return ERROR_OUTPUT
 
 
+def _to_json_default(obj: Any) -> Any:
+    """Serializes OpenAI response objects (pydantic models) that can be part of the messages."""
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump()
+    return str(obj)
+
+
+class ResponseCache:
+    """
+    On-disk cache of raw chat completions.
+
+    Completions are keyed by a hash of the model, messages, tools, temperature and max_tokens, and stored as one JSON file each.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def get_key(
+        model: str,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]],
+        temperature: float,
+        max_tokens: int,
+    ) -> str:
+        """Returns the cache key for a completion request."""
+        request = {
+            "model": model,
+            "messages": messages,
+            "tools": tools,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+        request_str = json.dumps(request, sort_keys=True, default=_to_json_default)
+        return hashlib.sha256(request_str.encode()).hexdigest()
+
+    def _get_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[ChatCompletion]:
+        """Returns the cached completion for the key, or None if not present."""
+        path = self._get_path(key)
+        if not path.exists():
+            return None
+        return ChatCompletion.model_validate_json(path.read_text())
+
+    def put(self, key: str, completion: ChatCompletion) -> None:
+        """Stores a completion. Writes are atomic so that concurrent evaluators can share a cache."""
+        path = self._get_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=path.parent, suffix=".tmp", delete=False
+        ) as f:
+            f.write(completion.model_dump_json())
+        os.replace(f.name, path)
+
+
+def parse_tagged_response(
+    response_message: "ChatCompletionMessage", tool_call_tags: IndicatorTags
+) -> ParsedResponse:
+    """
+    Parses a response message with tool calls formatted between tool_call_tags in the message content.
+    """
+    response_message_content = response_message.content
+    processed_response = ParsedResponse(
+        content=response_message_content,
+        tool_calls=None,
+        original_response=response_message,
+    )
+
+    # Check if the content includes tool call tags
+    if response_message_content and tool_call_tags.start in response_message_content:
+        try:
+            response_message_content, tool_calls = get_tool_calls_from_response(
+                response_message_content,
+                tool_call_tags,
+                format=DatasetFormat.ANYSCALE,
+            )
+            processed_response.content = response_message_content
+            processed_response.tool_calls = tool_calls
+        except FunctionCallFormatError:
+            # This handles either a function call not being found or the json not being decoded properly.
+            # One example for the second case can be missed commas/quotes in the arguments field.
+            processed_response.content = response_message_content
+            processed_response.tool_calls = INCORRECT_FORMAT
+
+    return processed_response
+
+
 class ResponseParser(ABC):
     """
     Abstract base class for response parsers.
+
+    If `cache_dir` is provided, raw completions are cached on disk. In `replay` mode, completions are only read from
+    the cache and no network calls are made. Requests missing from the cache are treated as failed api calls.
     """
 
     def __init__(
@@ -74,10 +176,58 @@ class ResponseParser(ABC):
         api_base: str,
         model: str,
         tool_call_tags: Optional[IndicatorTags] = None,
+        cache_dir: Optional[str] = None,
+        replay: bool = False,
     ):
-        self.client = OpenAI(api_key=api_key, base_url=api_base)
+        if replay and cache_dir is None:
+            raise ValueError("A cache directory is required in replay mode")
+        self.client = None if replay else self._create_client(api_key, api_base)
         self.model = model
         self.tool_call_tags = tool_call_tags
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.replay = replay
+
+    def _create_client(self, api_key: str, api_base: str) -> Optional[OpenAI]:
+        """Creates the client used to query the endpoint."""
+        return OpenAI(api_key=api_key, base_url=api_base)
+
+    def _get_completion(
+        self,
+        messages: List[Dict[str, str]],
+        tools: List[Dict[str, Any]] = None,
+        temperature: float = 0.0,
+        max_tokens: int = 256,
+    ) -> "ChatCompletion":
+        """Gets completion from the cache if available, else from the endpoint."""
+        if self.cache is None:
+            return get_completion(
+                client=self.client,
+                model=self.model,
+                messages=messages,
+                tools=tools,
+                temperature=temperature,
+                max_tokens=max_tokens,
+            )
+        key = ResponseCache.get_key(
+            self.model, messages, tools, temperature, max_tokens
+        )
+        response = self.cache.get(key)
+        if response is not None:
+            return response
+        if self.replay:
+            logging.warning(f"No cached completion found for key {key}")
+            return ERROR_OUTPUT
+        response = get_completion(
+            client=self.client,
+            model=self.model,
+            messages=messages,
+            tools=tools,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+        if response != ERROR_OUTPUT:
+            self.cache.put(key, response)
+        return response
 
     @abstractmethod
     def get_parsed_response(
@@ -96,6 +246,23 @@ class ResponseParser(ABC):
         """
         pass
 
+    def get_parsed_responses(
+        self,
+        messages_list: List[List[Dict[str, str]]],
+        tools_list: List[List[Dict[str, Any]]],
+        max_concurrency: int = 1,
+    ) -> List[ParsedResponse]:
+        """
+        Gets processed responses for a batch of requests, in the same order as the inputs.
+
+        The default implementation sends the requests to the endpoint, up to `max_concurrency` at a time.
+        Parsers with a native batch interface can override this.
+        """
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            return list(
+                executor.map(self.get_parsed_response, messages_list, tools_list)
+            )
+
 
 class AnyscaleResponseParser(ResponseParser):
     """Response parser for models hosted on Anyscale.
@@ -107,54 +274,25 @@ class AnyscaleResponseParser(ResponseParser):
         self, messages, tools=None, temperature=0.0, max_tokens=256
     ):
         # Tools is ignored as the tool list would be included in the system prompt
-        response = get_completion(
-            client=self.client,
-            model=self.model,
+        response = self._get_completion(
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
         )
 
-        # Default error output
-        processed_response = ParsedResponse(
-            content=ERROR_OUTPUT, tool_calls=None, original_response=response
-        )
         if response == ERROR_OUTPUT:
-            return processed_response
-
-        response_message_content = response.choices[0].message.content
-        processed_response.content = response_message_content
-        processed_response.original_response = response.choices[0].message
-
-        # Check if the content includes tool call tags
-        if (
-            response_message_content
-            and self.tool_call_tags.start in response_message_content
-        ):
-            try:
-                response_message_content, tool_calls = get_tool_calls_from_response(
-                    response_message_content,
-                    self.tool_call_tags,
-                    format=DatasetFormat.ANYSCALE,
-                )
-                processed_response.content = response_message_content
-                processed_response.tool_calls = tool_calls
-            except FunctionCallFormatError:
-                # This handles either a function call not being found or the json not being decoded properly.
-                # One example for the second case can be missed commas/quotes in the arguments field.
-                processed_response.content = response_message_content
-                processed_response.tool_calls = INCORRECT_FORMAT
-
-        return processed_response
+            # Default error output
+            return ParsedResponse(
+                content=ERROR_OUTPUT, tool_calls=None, original_response=response
+            )
+        return parse_tagged_response(response.choices[0].message, self.tool_call_tags)
 
 
 class OpenAIResponseParser(ResponseParser):
     """Response parser for OpenAI models."""
 
     def get_parsed_response(self, messages, tools, temperature=0.0, max_tokens=256):
-        response = get_completion(
-            client=self.client,
-            model=self.model,
+        response = self._get_completion(
             messages=messages,
             tools=tools if len(tools) else None,
             temperature=temperature,
@@ -192,3 +330,165 @@ class OpenAIResponseParser(ResponseParser):
                     processed_response.tool_calls = INCORRECT_FORMAT
                     break
         return processed_response
+
+
+class VLLMResponseParser(ResponseParser):
+    """Response parser that runs a model offline with vLLM, optionally with a LoRA adapter.
+
+    Like `AnyscaleResponseParser`, assumes that the tool list is in the system prompt and that the model response has
+    tool calls formatted between tool_call_tags. All pending requests passed to `get_parsed_responses` are formatted
+    with the model's chat template and generated in a single `LLM.generate` call. Prefix caching is enabled so that
+    requests sharing a prefix reuse the computed KV cache.
+
+    An `llm` object with the `generate` and `get_tokenizer` methods of `vllm.LLM` can be passed instead of loading the
+    model, e.g. a mock model for running the evaluation without a GPU. In that case, `sampling_params` should be
+    passed as well if vLLM is not installed.
+
+    Caching and replay work as for the other parsers: only requests missing from the cache are generated, and in
+    `replay` mode no model is loaded.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        tool_call_tags: IndicatorTags,
+        lora_path: Optional[str] = None,
+        llm: Optional[Any] = None,
+        sampling_params: Optional[Any] = None,
+        temperature: float = 0.0,
+        max_tokens: int = 256,
+        cache_dir: Optional[str] = None,
+        replay: bool = False,
+        **engine_kwargs,
+    ):
+        super().__init__(
+            api_key=None,
+            api_base=None,
+            model=model,
+            tool_call_tags=tool_call_tags,
+            cache_dir=cache_dir,
+            replay=replay,
+        )
+        self.lora_path = lora_path
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        # No model is loaded in replay mode, as all completions are read from the cache
+        if llm is None and not replay:
+            from vllm import LLM
+
+            llm = LLM(
+                model=model,
+                enable_lora=lora_path is not None,
+                enable_prefix_caching=True,
+                **engine_kwargs,
+            )
+        self.llm = llm
+        self.tokenizer = llm.get_tokenizer() if llm is not None else None
+        if sampling_params is None and not replay:
+            from vllm import SamplingParams
+
+            sampling_params = SamplingParams(
+                temperature=temperature, max_tokens=max_tokens
+            )
+        self.sampling_params = sampling_params
+        self.lora_request = None
+        if lora_path is not None and not replay:
+            from vllm.lora.request import LoRARequest
+
+            self.lora_request = LoRARequest("adapter", 1, lora_path)
+
+    def _create_client(self, api_key, api_base):
+        # Completions are generated locally, so there is no endpoint to query
+        return None
+
+    def _get_cache_key(self, messages: List[Dict[str, Any]]) -> str:
+        # The adapter is part of the key so that base model and adapter completions are cached separately
+        model = (
+            self.model if self.lora_path is None else f"{self.model}:{self.lora_path}"
+        )
+        return ResponseCache.get_key(
+            model, messages, None, self.temperature, self.max_tokens
+        )
+
+    def _to_prompt(self, messages: List[Dict[str, Any]]) -> str:
+        # Only keep the fields used by the chat template
+        messages = [
+            {"role": message["role"], "content": message["content"] or ""}
+            for message in messages
+        ]
+        return self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True
+        )
+
+    def _generate(self, messages_list: List[List[Dict[str, Any]]]) -> List[str]:
+        """Generates completions for all requests in a single `LLM.generate` call."""
+        prompts = [self._to_prompt(messages) for messages in messages_list]
+        outputs = self.llm.generate(
+            prompts, self.sampling_params, lora_request=self.lora_request
+        )
+        return [output.outputs[0].text for output in outputs]
+
+    def get_parsed_responses(self, messages_list, tools_list, max_concurrency=1):
+        # Tools are ignored as the tool list would be included in the system prompt
+        if self.cache is None:
+            completions = self._generate(messages_list)
+        else:
+            keys = [self._get_cache_key(messages) for messages in messages_list]
+            completions = []
+            for key in keys:
+                response = self.cache.get(key)
+                completions.append(
+                    response.choices[0].message.content if response else None
+                )
+            missing = [
+                i for i, completion in enumerate(completions) if completion is None
+            ]
+            if self.replay:
+                for i in missing:
+                    logging.warning(f"No cached completion found for key {keys[i]}")
+            elif missing:
+                generated = self._generate([messages_list[i] for i in missing])
+                for i, text in zip(missing, generated):
+                    completions[i] = text
+                    self.cache.put(keys[i], self._to_chat_completion(text))
+
+        responses = []
+        for completion in completions:
+            if completion is None:
+                # Default error output
+                responses.append(
+                    ParsedResponse(
+                        content=ERROR_OUTPUT,
+                        tool_calls=None,
+                        original_response=ERROR_OUTPUT,
+                    )
+                )
+            else:
+                responses.append(
+                    parse_tagged_response(
+                        ChatCompletionMessage(role="assistant", content=completion),
+                        self.tool_call_tags,
+                    )
+                )
+        return responses
+
+    def _to_chat_completion(self, text: str) -> ChatCompletion:
+        """Wraps generated text in a chat completion, the format stored in the cache."""
+        return ChatCompletion.model_validate(
+            {
+                "id": f"vllm-{uuid.uuid4().hex}",
+                "created": int(time.time()),
+                "model": self.model,
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": text},
+                    }
+                ],
+            }
+        )
+
+    def get_parsed_response(self, messages, tools=None):
+        return self.get_parsed_responses([messages], [tools])[0]
@@ -5,13 +5,18 @@ Script to generate training data for DPO based on the generated summaries and sc
 import argparse
 import os
 import re
-from typing import Any, Dict, Literal
+from typing import Any, Dict, Literal, Optional, Tuple
 
+import numpy as np
 import pandas as pd
+import pyarrow.fs as pafs
 import ray
 from pydantic import Field
+from ray.data import SaveMode
+from ray.data.aggregate import Count, Max, Mean, Min, Std
 
 from src.utils.common import check_num_bad_chars
+from src.utils.grouping import map_groups_local
 from src.utils.models import BaseModelExtended, DataSchema
 from src.utils.prompt_templates import PROMPT_TEMPLATE_SUMMARY
 
@@ -21,6 +26,13 @@ MIN_LENGTH_DIFFERENCE = 3
 MIN_NUM_WORDS_IN_SUMMARY = 5
 MAX_NUM_WORDS_IN_SUMMARY = 200
 
+SPLIT_COL = "split"
+TRAIN_SPLIT = "train"
+VAL_SPLIT = "val"
+# Bucket width, in words, for the summary length distributions
+NUM_WORDS_BUCKET_SIZE = 25
+CONCATENATE_CHUNK_BYTES = 64 * 1024**2
+
 
 class TrainingDataGenerationConfig(BaseModelExtended):
     input_folder: str = Field(
@@ -37,9 +49,21 @@ class TrainingDataGenerationConfig(BaseModelExtended):
         default=3,
         description="Score threshold to classify chosen and rejected samples.",
     )
+    local_grouping: bool = Field(
+        default=True,
+        description="Whether to pair summaries within each block when all generations for an article are in the same block, skipping the global shuffle. Falls back to a shuffle-based group-by otherwise.",
+    )
+    seed: Optional[int] = Field(
+        default=None,
+        description="Random seed for sampling pairs per article. If `None`, sampling is not reproducible.",
+    )
     output_folder: str = Field(
         description="Output folder path for train and validation files, relative to the base artifact storage path."
     )
+    concatenate_shards: bool = Field(
+        default=True,
+        description="Whether to concatenate the JSONL shards written for each split into `train.jsonl` and `val.jsonl`. The shards are written to the `train` and `val` subfolders, replacing any previous shards, and are removed after concatenation.",
+    )
 
 
 def is_row_valid(row: Dict[str, Any]) -> bool:
@@ -115,81 +139,213 @@ def compare_summaries(
     return 0
 
 
+def compare_summaries_matrix(
+    accuracies: np.ndarray, num_words: np.ndarray, *, accuracy_threshold
+) -> np.ndarray:
+    """
+    Vectorized version of `compare_summaries` over all pairs of summaries for an article.
+
+    Args:
+        accuracies: Accuracy (of judge responses) for each summary
+        num_words: Number of words in each summary
+
+    Returns:
+        An `(n, n)` matrix where entry `(i, j)` is `compare_summaries(row_i, row_j)`.
+    """
+    accuracy_diff = accuracies[:, None] - accuracies[None, :]
+    length_diff = num_words[:, None] - num_words[None, :]
+    # If atleast one summary is worse than the threshold, choose based on the higher accuracy
+    below_threshold = (
+        np.minimum(accuracies[:, None], accuracies[None, :]) <= accuracy_threshold - 1
+    )
+    # Else prefer the shorter summary, if lengths differ enough
+    length_comp = np.where(
+        np.abs(length_diff) >= MIN_LENGTH_DIFFERENCE, -np.sign(length_diff), 0
+    )
+    return np.where(below_threshold, np.sign(accuracy_diff), length_comp)
+
+
+PAIR_COLUMNS = [
+    "chosen",
+    "rejected",
+    "num_words_chosen",
+    "num_words_rejected",
+    "accuracy_chosen",
+    "accuracy_rejected",
+]
+
+
 def make_pairs(
-    examples: pd.DataFrame, max_pairs_per_article: int, accuracy_threshold: int
+    examples: pd.DataFrame,
+    max_pairs_per_article: int,
+    accuracy_threshold: int,
+    seed: Optional[int] = None,
 ) -> pd.DataFrame:
     """Makes training input pairs for DPO for the given DataFrame.
 
+    All pairwise comparisons are computed at once, and only the sampled pairs are materialized. Pairs are enumerated
+    in the same order as a nested loop over `(i, j)` with `i < j`, and sampled in the same way as
+    `DataFrame.sample(max_pairs_per_article, random_state=seed)`.
+
     Args:
         examples: Input DataFrame
         max_pairs_per_article: Maximum number of training data pairs to sample for one article.
         accuracy_threshold: Score threshold to classify chosen and rejected samples.
+        seed: Random seed for sampling pairs.
     Returns:
         result: Output DataFrame in the preference tuning format.
     """
-    pairs = []
+    accuracies = examples[DataSchema.ACCURACY].to_numpy()
+    num_words = examples[DataSchema.NUM_WORDS].to_numpy()
+    comp = compare_summaries_matrix(
+        accuracies, num_words, accuracy_threshold=accuracy_threshold
+    )
+    row_idxs, col_idxs = np.triu_indices(len(examples), k=1)
+    pair_comp = comp[row_idxs, col_idxs]
+    is_distinct = pair_comp != 0
+    row_idxs, col_idxs, pair_comp = (
+        row_idxs[is_distinct],
+        col_idxs[is_distinct],
+        pair_comp[is_distinct],
+    )
+
+    if len(pair_comp) == 0:
+        # return empty dataframe
+        return pd.DataFrame(columns=PAIR_COLUMNS)
+
+    if len(pair_comp) > max_pairs_per_article:
+        # With `seed=None`, RandomState is seeded from OS entropy
+        sampled = np.random.RandomState(seed).choice(
+            len(pair_comp), size=max_pairs_per_article, replace=False
+        )
+        row_idxs, col_idxs, pair_comp = (
+            row_idxs[sampled],
+            col_idxs[sampled],
+            pair_comp[sampled],
+        )
+
+    chosen_idxs = np.where(pair_comp == 1, row_idxs, col_idxs)
+    rejected_idxs = np.where(pair_comp == 1, col_idxs, row_idxs)
+
     prompt = {
         "content": PROMPT_TEMPLATE_SUMMARY.format(**examples.iloc[0]),
         "role": "user",
     }
-    for i in range(len(examples)):
-        for j in range(i + 1, len(examples)):
-            comp = compare_summaries(
-                examples.iloc[i],
-                examples.iloc[j],
-                accuracy_threshold=accuracy_threshold,
-            )
-            if comp == 0:
-                continue
-            pair = (
-                [examples.iloc[i], examples.iloc[j]]
-                if comp == 1
-                else [examples.iloc[j], examples.iloc[i]]
-            )
-            pairs.append(
-                dict(
-                    chosen=[
-                        prompt,
-                        {
-                            "content": pair[0][
-                                DataSchema.SUMMARY_GENERATION_RAW_OUTPUT
-                            ].strip(),
-                            "role": "assistant",
-                        },
-                    ],
-                    rejected=[
-                        prompt,
-                        {
-                            "content": pair[1][
-                                DataSchema.SUMMARY_GENERATION_RAW_OUTPUT
-                            ].strip(),
-                            "role": "assistant",
-                        },
-                    ],
-                    num_words_chosen=pair[0][DataSchema.NUM_WORDS],
-                    num_words_rejected=pair[1][DataSchema.NUM_WORDS],
-                    accuracy_chosen=pair[0][DataSchema.ACCURACY],
-                    accuracy_rejected=pair[1][DataSchema.ACCURACY],
-                )
-            )
+    summaries = examples[DataSchema.SUMMARY_GENERATION_RAW_OUTPUT].to_numpy()
+
+    def to_messages(idxs):
+        return [
+            [prompt, {"content": summaries[idx].strip(), "role": "assistant"}]
+            for idx in idxs
+        ]
+
+    return pd.DataFrame(
+        {
+            "chosen": to_messages(chosen_idxs),
+            "rejected": to_messages(rejected_idxs),
+            "num_words_chosen": num_words[chosen_idxs],
+            "num_words_rejected": num_words[rejected_idxs],
+            "accuracy_chosen": accuracies[chosen_idxs],
+            "accuracy_rejected": accuracies[rejected_idxs],
+        }
+    )
 
-    if len(pairs) == 0:
-        # return empty dataframe
-        return pd.DataFrame(
-            columns=[
-                "chosen",
-                "rejected",
-                "num_words_chosen",
-                "num_words_rejected",
-                "accuracy_chosen",
-                "accuracy_rejected",
-            ]
+
+def assign_split(batch: pd.DataFrame, key: str, train_val_split: float) -> pd.DataFrame:
+    """Assigns each row to the train or validation split based on a hash of `key`.
+
+    All rows with the same key land in the same split, and the assignment does not depend on how rows are split into
+    blocks, so the split is deterministic and can be computed while streaming.
+    """
+    hashes = pd.util.hash_pandas_object(batch[key], index=False).to_numpy()
+    draws = hashes / np.float64(np.iinfo(np.uint64).max)
+    batch[SPLIT_COL] = np.where(draws < train_val_split, VAL_SPLIT, TRAIN_SPLIT)
+    return batch
+
+
+def make_pairs_with_split(examples: pd.DataFrame, **kwargs) -> pd.DataFrame:
+    """Makes training input pairs for an article with `make_pairs`, keeping the article's split"""
+    pairs = make_pairs(examples, **kwargs)
+    pairs[SPLIT_COL] = examples[SPLIT_COL].iloc[0]
+    return pairs
+
+
+def _filter_split(batch: pd.DataFrame, split: str) -> pd.DataFrame:
+    return batch[batch[SPLIT_COL] == split].drop(columns=[SPLIT_COL])
+
+
+def _add_num_words_bucket(batch: pd.DataFrame) -> pd.DataFrame:
+    batch = batch[[SPLIT_COL, "num_words_chosen"]].copy()
+    batch["num_words_bucket"] = (
+        batch["num_words_chosen"] // NUM_WORDS_BUCKET_SIZE * NUM_WORDS_BUCKET_SIZE
+    )
+    return batch
+
+
+def get_summary_stats(ds: ray.data.Dataset) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Computes summary statistics of the pairs per split with distributed aggregations.
+
+    Returns:
+        stats_df: Number of pairs and statistics of lengths and accuracies of the chosen and rejected summaries
+        num_words_df: Number of pairs per bucket of the chosen summary length
+    """
+    stats_df = (
+        ds.groupby(SPLIT_COL)
+        .aggregate(
+            Count(),
+            *[
+                agg(col)
+                for col in ("num_words_chosen", "num_words_rejected")
+                for agg in (Mean, Std, Min, Max)
+            ],
+            Mean("accuracy_chosen"),
+            Mean("accuracy_rejected"),
         )
+        .to_pandas()
+        .set_index(SPLIT_COL)
+    )
+    num_words_df = (
+        ds.map_batches(_add_num_words_bucket, batch_format="pandas", num_cpus=0)
+        .groupby([SPLIT_COL, "num_words_bucket"])
+        .count()
+        .to_pandas()
+        .pivot(index="num_words_bucket", columns=SPLIT_COL, values="count()")
+        .fillna(0)
+        .astype(int)
+    )
+    return stats_df, num_words_df
+
+
+def concatenate_files(input_folder: str, output_path: str):
+    """Streams the files in `input_folder` into a single file, in order of their names.
+
+    Works with local paths and remote storage URIs. A newline is added between files that don't end with one.
+    """
+    fs, folder_path = pafs.FileSystem.from_uri(input_folder)
+    _, output_file_path = pafs.FileSystem.from_uri(output_path)
+    file_infos = sorted(
+        (
+            info
+            for info in fs.get_file_info(pafs.FileSelector(folder_path))
+            if info.type == pafs.FileType.File
+        ),
+        key=lambda info: info.path,
+    )
+    with fs.open_output_stream(output_file_path) as output_file:
+        for info in file_infos:
+            last_chunk = b""
+            with fs.open_input_stream(info.path) as input_file:
+                while chunk := input_file.read(CONCATENATE_CHUNK_BYTES):
+                    output_file.write(chunk)
+                    last_chunk = chunk
+            if last_chunk and not last_chunk.endswith(b"\n"):
+                output_file.write(b"\n")
 
-    result = pd.DataFrame.from_records(pairs)
-    if len(result) > max_pairs_per_article:
-        result = result.sample(max_pairs_per_article)
-    return result
+
+def delete_folder(folder: str):
+    """Deletes a folder and its contents. Works with local paths and remote storage URIs."""
+    fs, folder_path = pafs.FileSystem.from_uri(folder)
+    fs.delete_dir(folder_path)
 
 
 if __name__ == "__main__":
@@ -211,6 +367,13 @@ if __name__ == "__main__":
     ds = ray.data.read_parquet(input_folder, file_extensions=["parquet"])
 
     ds = ds.filter(is_row_valid, num_cpus=0)
+    # Split by article, so that no article has pairs in both splits
+    ds = ds.map_batches(
+        assign_split,
+        fn_kwargs=dict(key="id", train_val_split=config.train_val_split),
+        batch_format="pandas",
+        num_cpus=0,
+    )
     ds = ds.map(eval_row, num_cpus=0)
     ds = ds.filter(
         lambda row: MIN_NUM_WORDS_IN_SUMMARY
@@ -219,29 +382,41 @@ if __name__ == "__main__":
         num_cpus=0,
     )
 
-    ds = ds.groupby("id").map_groups(
-        make_pairs,
-        fn_kwargs=dict(
-            max_pairs_per_article=config.max_pairs_per_article,
-            accuracy_threshold=config.accuracy_threshold,
-        ),
-        num_cpus=0,
-        batch_format="pandas",
+    pair_kwargs = dict(
+        max_pairs_per_article=config.max_pairs_per_article,
+        accuracy_threshold=config.accuracy_threshold,
+        seed=config.seed,
     )
+    if config.local_grouping:
+        ds = map_groups_local(ds, "id", make_pairs_with_split, fn_kwargs=pair_kwargs)
+    else:
+        ds = ds.groupby("id").map_groups(
+            make_pairs_with_split,
+            fn_kwargs=pair_kwargs,
+            num_cpus=0,
+            batch_format="pandas",
+        )
 
-    train_ds, val_ds = ds.train_test_split(config.train_val_split)
-
-    train_df = train_ds.to_pandas()
-    val_df = val_ds.to_pandas()
-
-    print(f"Number of train examples: {len(train_df)}")
-    print(f"Number of eval examples: {len(val_df)}")
-
-    train_df.to_json(
-        os.path.join(output_folder, "train.jsonl"), orient="records", lines=True
-    )
-    val_df.to_json(
-        os.path.join(output_folder, "val.jsonl"), orient="records", lines=True
-    )
+    # Pairs are kept in the object store, so that statistics and both splits are computed from a single pass
+    ds = ds.materialize()
+
+    stats_df, num_words_df = get_summary_stats(ds)
+    print(f"Pair statistics:\n{stats_df.T.to_string()}")
+    print(f"Chosen summary length distribution:\n{num_words_df.to_string()}")
+
+    for split in (TRAIN_SPLIT, VAL_SPLIT):
+        shard_folder = os.path.join(output_folder, split)
+        ds.map_batches(
+            _filter_split,
+            fn_kwargs=dict(split=split),
+            batch_format="pandas",
+            num_cpus=0,
+        ).write_json(shard_folder, mode=SaveMode.OVERWRITE)
+        if config.concatenate_shards:
+            concatenate_files(
+                shard_folder, os.path.join(output_folder, f"{split}.jsonl")
+            )
+            # Remove the shards, so that they can't be picked up by a later run
+            delete_folder(shard_folder)
 
     print(f"All files are saved to {output_folder}")
@@ -9,18 +9,22 @@ import re
 import datasets
 import ray
 from pydantic import Field
-from transformers import AutoTokenizer
 
 from src.utils.common import init_logger, MODEL_HOME
-from src.utils.models import (
-    BaseModelExtended, DataSchema, OfflineInferenceConfig
-)
+from src.utils.models import BaseModelExtended, DataSchema, OfflineInferenceConfig
 from src.utils.prompt_templates import PROMPT_TEMPLATE_QUESTION_GENERATION
 from src.utils.synthetic_data_utils import (
-    format_into_prompt_rawtext,
-    shuffle_qa,
+    ParseFailure,
+    count_parse_failures,
+    format_prompts_on_dataset,
+    shuffle_qa_batch,
 )
 from src.utils.predictors import get_predictions_on_dataset
+from src.utils.prefetch import (
+    get_model_ids_or_paths,
+    prefetch_models,
+    report_prefetch_times,
+)
 
 logger = init_logger()
 
@@ -42,6 +46,9 @@ class QuestionGenerationConfig(BaseModelExtended):
     train_test_split: float = Field(
         default=0.01, description="Percentage of articles to use for the test set"
     )
+    seed: int = Field(
+        default=0, description="Random seed for shuffling questions and choices"
+    )
 
 
 def get_full_output_folder_path(output_folder: str) -> str:
@@ -86,6 +93,8 @@ if __name__ == "__main__":
     ds = ray.data.from_huggingface(hf_ds)
 
     model_config: OfflineInferenceConfig = config.model_inference_config
+    # Start pulling weights on every node while the dataset is prepared
+    prefetch_refs = prefetch_models(get_model_ids_or_paths(model_config))
     scaling_config = model_config.scaling_config
     # By default, a HF dataset is converted to a Materialized dataset and the number of blocks can be low
     num_blocks = (
@@ -95,14 +104,13 @@ if __name__ == "__main__":
     )
     ds = ds.repartition(num_blocks)
 
-    ds = ds.map(
-        format_into_prompt_rawtext,
-        fn_kwargs=dict(
-            template=PROMPT_TEMPLATE_QUESTION_GENERATION,
-            tokenizer=AutoTokenizer.from_pretrained(model_config.model_id_or_path),
-            col_name=DataSchema.QA_GENERATION_PROMPT,
-        ),
-        num_cpus=0,
+    ds = format_prompts_on_dataset(
+        ds,
+        tokenizer_id_or_path=model_config.get_tokenizer_id_or_path(),
+        template=PROMPT_TEMPLATE_QUESTION_GENERATION,
+        col_name=DataSchema.QA_GENERATION_PROMPT,
+        concurrency=scaling_config.concurrency,
+        return_token_ids=model_config.pretokenize_prompts,
     )
     ds = get_predictions_on_dataset(
         ds,
@@ -111,15 +119,24 @@ if __name__ == "__main__":
         col_out=DataSchema.QA_GENERATION_RAW_OUTPUT,
     )
 
-    ds = ds.flat_map(
-        shuffle_qa,
+    ds = ds.map_batches(
+        shuffle_qa_batch,
         fn_kwargs=dict(
             col_in=DataSchema.QA_GENERATION_RAW_OUTPUT,
             col_out_prompt=DataSchema.MCQ_QUESTIONS,
             col_out_answers=DataSchema.GROUND_TRUTH_MCQ_ANSWERS,
+            col_out_failure=DataSchema.QA_PARSE_FAILURE,
+            seed=config.seed,
         ),
+        batch_format="pandas",
         num_cpus=0,
     )
+    # Materialize to count parse failures without running inference again
+    ds = ds.materialize()
+    logger.info(
+        f"Question parse failures: {count_parse_failures(ds, DataSchema.QA_PARSE_FAILURE)}"
+    )
+    ds = ds.filter(lambda row: row[DataSchema.QA_PARSE_FAILURE] == ParseFailure.NONE)
 
     train_ds, test_ds = ds.train_test_split(test_size=config.train_test_split)
     train_split_path = os.path.join(output_folder, "train")
@@ -128,3 +145,4 @@ if __name__ == "__main__":
     test_ds.write_parquet(test_split_path)
     logger.info(f"Train split have been saved to: {train_split_path}")
     logger.info(f"Test split have been saved to: {test_split_path}")
+    report_prefetch_times(prefetch_refs)
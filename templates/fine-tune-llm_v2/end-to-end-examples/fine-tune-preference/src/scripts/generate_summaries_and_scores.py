@@ -12,7 +12,6 @@ from typing import Union
 
 import ray
 from pydantic import Field, model_validator
-from transformers import AutoTokenizer
 
 from src.utils.common import init_logger
 from src.utils.models import (
@@ -27,13 +26,23 @@ from src.utils.prompt_templates import (
 )
 from src.utils.synthetic_data_utils import (
     InferenceType,
+    count_parse_failures,
     dump_jsonl_to_string,
     duplicate_rows,
-    extract_answers,
-    format_into_prompt,
-    format_into_prompt_rawtext,
+    extract_answers_batch,
+    format_into_prompt_openai,
+    format_prompts_on_dataset,
+    split_adapter_outputs,
+)
+from src.utils.predictors import (
+    get_fused_predictions_on_dataset,
+    get_predictions_on_dataset,
+)
+from src.utils.prefetch import (
+    get_model_ids_or_paths,
+    prefetch_models,
+    report_prefetch_times,
 )
-from src.utils.predictors import get_predictions_on_dataset
 
 logger = init_logger()
 
@@ -64,6 +73,10 @@ class SummaryGenerationConfig(BaseModelExtended):
         default=5,
         description="Number of MCQ questions in the provided input dataset. Note that only those input dataset samples with `num_mcq_questions` questions will be used in evaluation.",
     )
+    fuse_judge: bool = Field(
+        default=False,
+        description="Whether to run summary generation and judge scoring on a single vLLM engine per actor. Requires offline inference with the same base model for both, each optionally with a LoRA adapter. The scaling config of `model_inference_config` is used.",
+    )
 
     @model_validator(mode="after")
     def validate_model_config_and_type(self):
@@ -71,15 +84,25 @@ class SummaryGenerationConfig(BaseModelExtended):
             assert isinstance(self.model_inference_config, OfflineInferenceConfig)
         else:
             assert isinstance(self.model_inference_config, OnlineInferenceConfig)
+        if self.fuse_judge:
+            assert (
+                self.inference_type == InferenceType.OFFLINE
+            ), "Fused summary generation and judging requires offline inference"
+            assert (
+                self.model_inference_config.model_id_or_path
+                == self.judge_inference_config.model_id_or_path
+            ), "Fused summary generation and judging requires the same base model for both"
+            assert (
+                len(self.model_inference_config.get_adapters()) <= 1
+            ), "Fused summary generation and judging supports at most one adapter for the model being evaluated"
         return self
 
 
 def get_output_folder_path(model_config) -> str:
     if isinstance(model_config, OfflineInferenceConfig):
+        adapters = model_config.get_adapters()
         output_model_name = (
-            model_config.adapter_id_or_path
-            if model_config.adapter_id_or_path is not None
-            else model_config.model_id_or_path
+            "+".join(adapters) if adapters else model_config.model_id_or_path
         )
     elif isinstance(model_config, OnlineInferenceConfig):
         output_model_name = model_config.model_id
@@ -91,7 +114,12 @@ def get_output_folder_path(model_config) -> str:
     output_model_name = output_model_name.replace("/", "_")
     user_name = re.sub(r"\s+", "__", os.environ.get("ANYSCALE_USERNAME", "user"))
     folder_name = f"summary_{config.mode.value}_generation_{output_model_name}_temp_{model_config.temperature}_judge_{judge_config.model_id_or_path.replace('/', '_')}"
-    folder_path = os.path.join(os.environ.get('ANYSCALE_ARTIFACT_STORAGE'), user_name, "preference_tuning_summarization_example", folder_name)
+    folder_path = os.path.join(
+        os.environ.get("ANYSCALE_ARTIFACT_STORAGE"),
+        user_name,
+        "preference_tuning_summarization_example",
+        folder_name,
+    )
     return folder_path
 
 
@@ -130,6 +158,12 @@ if __name__ == "__main__":
 
     logger.info(f"OUTPUT FOLDER: {output_folder}")
 
+    # Start pulling weights on every node while the dataset is prepared
+    offline_configs = [judge_config]
+    if config.inference_type == InferenceType.OFFLINE:
+        offline_configs.insert(0, model_config)
+    prefetch_refs = prefetch_models(get_model_ids_or_paths(*offline_configs))
+
     ds = ray.data.read_parquet(config.input_folder, file_extensions=["parquet"])
 
     ds = ds.filter(
@@ -137,24 +171,23 @@ if __name__ == "__main__":
         and len(row[DataSchema.GROUND_TRUTH_MCQ_ANSWERS]) == config.num_mcq_questions,
     )
 
-    tokenizer = None
     if config.inference_type == InferenceType.OFFLINE:
-        tokenizer_id_or_path = (
-            model_config.tokenizer_id_or_path
-            if model_config.tokenizer_id_or_path
-            else model_config.model_id_or_path
-        )
-        tokenizer = AutoTokenizer.from_pretrained(tokenizer_id_or_path)
-
-    ds = ds.map(
-        format_into_prompt,
-        fn_kwargs=dict(
+        ds = format_prompts_on_dataset(
+            ds,
+            tokenizer_id_or_path=model_config.get_tokenizer_id_or_path(),
             template=PROMPT_TEMPLATE_SUMMARY,
-            type=config.inference_type,
-            tokenizer=tokenizer,
             col_name=DataSchema.SUMMARY_GENERATION_INPUT,
-        ),
-    )
+            concurrency=model_config.scaling_config.concurrency,
+            return_token_ids=model_config.pretokenize_prompts,
+        )
+    else:
+        ds = ds.map(
+            format_into_prompt_openai,
+            fn_kwargs=dict(
+                template=PROMPT_TEMPLATE_SUMMARY,
+                col_name=DataSchema.SUMMARY_GENERATION_INPUT,
+            ),
+        )
 
     if config.num_generations > 1:
         ds = ds.flat_map(
@@ -164,43 +197,71 @@ if __name__ == "__main__":
                 id_col="response_num",
             ),
         )
-    ds = get_predictions_on_dataset(
-        ds,
-        model_config,
-        col_in=DataSchema.SUMMARY_GENERATION_INPUT,
-        col_out=DataSchema.SUMMARY_GENERATION_RAW_OUTPUT,
-    )
+    if config.fuse_judge:
+        # Generate summaries and get scores with the same engine
+        ds = get_fused_predictions_on_dataset(
+            ds,
+            model_config,
+            judge_config,
+            second_template=PROMPT_TEMPLATE_MCQ_ANSWERING,
+            col_in=DataSchema.SUMMARY_GENERATION_INPUT,
+            col_out=DataSchema.SUMMARY_GENERATION_RAW_OUTPUT,
+            second_col_in=DataSchema.JUDGE_MCQ_INPUT,
+            second_col_out=DataSchema.JUDGE_MCQ_RAW_OUTPUT,
+            group_size=config.num_generations,
+        )
+    else:
+        ds = get_predictions_on_dataset(
+            ds,
+            model_config,
+            col_in=DataSchema.SUMMARY_GENERATION_INPUT,
+            col_out=DataSchema.SUMMARY_GENERATION_RAW_OUTPUT,
+            # Keep all generations for an article in the same block
+            group_size=config.num_generations,
+        )
+        group_size = config.num_generations
+        if (
+            config.inference_type == InferenceType.OFFLINE
+            and len(model_config.get_adapters()) > 1
+        ):
+            # Score the summaries of each adapter as separate rows
+            ds = ds.flat_map(
+                split_adapter_outputs,
+                fn_kwargs=dict(
+                    col_out=DataSchema.SUMMARY_GENERATION_RAW_OUTPUT,
+                    adapters=model_config.get_adapters(),
+                    adapter_col=DataSchema.ADAPTER,
+                ),
+            )
+            group_size *= len(model_config.get_adapters())
 
-    # Input pre-processing for the judge model
-    tokenizer_id_or_path = (
-        judge_config.tokenizer_id_or_path
-        if judge_config.tokenizer_id_or_path
-        else judge_config.model_id_or_path
-    )
-    tokenizer = AutoTokenizer.from_pretrained(tokenizer_id_or_path)
-    ds = ds.map(
-        format_into_prompt_rawtext,
-        fn_kwargs=dict(
+        # Input pre-processing for the judge model
+        ds = format_prompts_on_dataset(
+            ds,
+            tokenizer_id_or_path=judge_config.get_tokenizer_id_or_path(),
             template=PROMPT_TEMPLATE_MCQ_ANSWERING,
-            tokenizer=tokenizer,
             col_name=DataSchema.JUDGE_MCQ_INPUT,
-        ),
-    )
-    # Get scores
-    ds = get_predictions_on_dataset(
-        ds,
-        judge_config,
-        col_in=DataSchema.JUDGE_MCQ_INPUT,
-        col_out=DataSchema.JUDGE_MCQ_RAW_OUTPUT,
-    )
+            concurrency=judge_config.scaling_config.concurrency,
+            return_token_ids=judge_config.pretokenize_prompts,
+        )
+        # Get scores
+        ds = get_predictions_on_dataset(
+            ds,
+            judge_config,
+            col_in=DataSchema.JUDGE_MCQ_INPUT,
+            col_out=DataSchema.JUDGE_MCQ_RAW_OUTPUT,
+            group_size=group_size,
+        )
 
-    ds = ds.map(
-        extract_answers,
+    ds = ds.map_batches(
+        extract_answers_batch,
         fn_kwargs=dict(
             col_in=DataSchema.JUDGE_MCQ_RAW_OUTPUT,
             col_out=DataSchema.JUDGE_MCQ_ANSWERS,
+            col_out_failure=DataSchema.JUDGE_PARSE_FAILURE,
             num_questions=config.num_mcq_questions,
         ),
+        batch_format="pandas",
     )
     if config.inference_type == InferenceType.ONLINE:
         # Dumps input prompt in Openai jsonl format to string. This is because pyarrow might not support this dtype
@@ -211,3 +272,9 @@ if __name__ == "__main__":
     ds.write_parquet(output_folder)
 
     logger.info(f"Dataset saved at: {output_folder}")
+    # Count on the saved outputs, since counting `ds` would run inference again
+    saved_ds = ray.data.read_parquet(output_folder, file_extensions=["parquet"])
+    logger.info(
+        f"Judge output parse failures: {count_parse_failures(saved_ds, DataSchema.JUDGE_PARSE_FAILURE)}"
+    )
+    report_prefetch_times(prefetch_refs)
@@ -3,7 +3,8 @@ Get evaluation statistics based on scores for the model-generated summaries
 """
 
 import argparse
-from typing import Any, Dict, Optional, Tuple
+import json
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
@@ -41,45 +42,115 @@ parser.add_argument(
     type=int,
     help="Score threshold to classify chosen and rejected samples.",
 )
+parser.add_argument(
+    "--num-bootstrap",
+    default=1000,
+    type=int,
+    help="Number of bootstrap resamples for confidence intervals. Set to 0 to disable.",
+)
+parser.add_argument(
+    "--confidence",
+    default=0.95,
+    type=float,
+    help="Confidence level of the bootstrap confidence intervals.",
+)
+parser.add_argument(
+    "--seed",
+    default=0,
+    type=int,
+    help="Seed for bootstrap resampling.",
+)
 
-
-def is_row_valid(row: Dict[str, Any]):
-    """Checks if the row is valid.
-
-    Returns whether the row is a valid entry with expected non-null value and valid judge output.
+# Numeric columns computed per row by `eval_batch`
+ARTICLE_HASH = "article_hash"
+ARTICLE_NUM_WORDS = "article_num_words"
+ARTICLE_NUM_CHARS = "article_num_chars"
+SUMMARY_NUM_CHARS = "summary_num_chars"
+NUM_BAD_CHARS = "num_bad_chars"
+# Rows for the same article are matched on these columns, in place of the article text
+MERGE_KEYS = [ARTICLE_HASH, ARTICLE_NUM_WORDS, ARTICLE_NUM_CHARS]
+EVAL_COLUMNS = [
+    DataSchema.ACCURACY,
+    DataSchema.NUM_WORDS,
+    SUMMARY_NUM_CHARS,
+    NUM_BAD_CHARS,
+]
+SOURCE_COL = "source"
+
+MODEL_STATS = [
+    "Accuracy >=3",
+    "Accuracy >=4",
+    "Median Compression",
+    "Mean Compression",
+    "Summary Too Long",
+    "Contains Invalid Characters",
+]
+WIN_RATE_STATS = ["Win Rate", "Win", "Tie", "Loss"]
+# Compression ratios are bucketed to locate the median, with larger ratios in the last bucket
+COMPRESSION_BINS = np.linspace(0, 2, 2001)
+# Bootstrap weights are drawn for this many rows at a time, which bounds the memory used per block
+BOOTSTRAP_CHUNK_ROWS = 4096
+
+
+def eval_batch(batch: pd.DataFrame) -> pd.DataFrame:
+    """Evaluates a batch of rows
+
+    Drops invalid rows, i.e. rows with a missing summary or MCQ answers, or without a judge output. For the remaining
+    rows, computes the length of the summary and the accuracy of judge responses based on the summary, along with the
+    article statistics needed to compare summaries for the same article.
     """
-    return not (
-        row[DataSchema.SUMMARY_GENERATION_RAW_OUTPUT] is None
-        or row[DataSchema.GROUND_TRUTH_MCQ_ANSWERS] is None
-        or row[DataSchema.JUDGE_MCQ_ANSWERS] is None
-        or "No Judge Output" in row[DataSchema.JUDGE_MCQ_ANSWERS]
+    batch = batch[
+        batch[DataSchema.SUMMARY_GENERATION_RAW_OUTPUT].notna()
+        & batch[DataSchema.GROUND_TRUTH_MCQ_ANSWERS].notna()
+        & batch[DataSchema.JUDGE_MCQ_ANSWERS].notna()
+    ]
+    # Answer lists are padded into 2D arrays, with missing answers as NaN
+    ground_truth = pd.DataFrame(
+        batch[DataSchema.GROUND_TRUTH_MCQ_ANSWERS].tolist(), index=batch.index
     )
-
-
-def eval_row(row: Dict[str, Any]) -> Dict[str, Any]:
-    """Evaluates a row
-
-    Computes length of the summary and accuracy of judge responses based on the summary.
-    """
-    return dict(
-        **row,
-        num_words=len(row[DataSchema.SUMMARY_GENERATION_RAW_OUTPUT].split()),
-        accuracy=sum(
-            row[DataSchema.GROUND_TRUTH_MCQ_ANSWERS][i]
-            == row[DataSchema.JUDGE_MCQ_ANSWERS][i]
-            for i in range(len(row[DataSchema.GROUND_TRUTH_MCQ_ANSWERS]))
-        ),
-        num_bad_chars=check_num_bad_chars(
-            row[DataSchema.SUMMARY_GENERATION_RAW_OUTPUT], normalize=True
-        ),
+    judge = pd.DataFrame(
+        batch[DataSchema.JUDGE_MCQ_ANSWERS].tolist(), index=batch.index
+    ).reindex(columns=ground_truth.columns)
+    is_valid = ~(judge == "No Judge Output").any(axis=1)
+    batch = batch[is_valid]
+    accuracy = (
+        (ground_truth[is_valid] == judge[is_valid]) & ground_truth[is_valid].notna()
+    ).sum(axis=1)
+
+    summaries = batch[DataSchema.SUMMARY_GENERATION_RAW_OUTPUT]
+    articles = batch[DataSchema.ARTICLE]
+    return pd.DataFrame(
+        {
+            ARTICLE_HASH: pd.util.hash_pandas_object(articles, index=False).to_numpy(),
+            ARTICLE_NUM_WORDS: articles.str.split().str.len().to_numpy(),
+            ARTICLE_NUM_CHARS: articles.str.len().to_numpy(),
+            DataSchema.ACCURACY: accuracy.to_numpy(),
+            DataSchema.NUM_WORDS: summaries.str.split().str.len().to_numpy(),
+            SUMMARY_NUM_CHARS: summaries.str.len().to_numpy(),
+            NUM_BAD_CHARS: summaries.map(
+                lambda text: check_num_bad_chars(text, normalize=True)
+            ).to_numpy(),
+            **(
+                {DataSchema.ADAPTER: batch[DataSchema.ADAPTER].to_numpy()}
+                if DataSchema.ADAPTER in batch.columns
+                else {}
+            ),
+        }
     )
 
 
 def compare(
-    acc1: float, num1: int, acc2: float, num2: int, *, accuracy_threshold
-) -> bool:
+    acc1: Union[float, np.ndarray],
+    num1: Union[int, np.ndarray],
+    acc2: Union[float, np.ndarray],
+    num2: Union[int, np.ndarray],
+    *,
+    accuracy_threshold,
+) -> Union[bool, np.ndarray]:
     """Compare two summaries based on accuracy (of judge responses) and length (of model summary) for evaluation.
 
+    Works elementwise on arrays of summaries.
+
     Args:
         acc1: Accuracy (of judge responses based on the summary) for the first summary
         num1: Number of words in the first summary
@@ -89,10 +160,57 @@ def compare(
     Returns:
         Whether the first summary is preferred or not.
     """
-    if min(acc1, acc2) <= accuracy_threshold - 1:
-        if acc1 != acc2:
-            return acc1 > acc2
-    return num1 < num2
+    acc1, num1, acc2, num2 = map(np.asarray, (acc1, num1, acc2, num2))
+    decided_by_accuracy = (np.minimum(acc1, acc2) <= accuracy_threshold - 1) & (
+        acc1 != acc2
+    )
+    return np.where(decided_by_accuracy, acc1 > acc2, num1 < num2)
+
+
+def get_compression(merged_results: pd.DataFrame, suffix: str) -> np.ndarray:
+    """Returns the ratio of summary length to article length, in words"""
+    return (
+        merged_results[f"{DataSchema.NUM_WORDS}{suffix}"].to_numpy()
+        / merged_results[ARTICLE_NUM_WORDS].to_numpy()
+    )
+
+
+def get_model_row_values(
+    merged_results: pd.DataFrame, suffix: str
+) -> Dict[str, np.ndarray]:
+    """Returns the per-row values whose means are the statistics for the model with the given suffix label.
+
+    The median compression is not a mean, and is computed separately from `get_compression`.
+    """
+    accuracy = merged_results[f"{DataSchema.ACCURACY}{suffix}"].to_numpy()
+    return {
+        "Accuracy >=3": accuracy >= 3,
+        "Accuracy >=4": accuracy >= 4,
+        "Mean Compression": get_compression(merged_results, suffix),
+        "Summary Too Long": merged_results[f"{SUMMARY_NUM_CHARS}{suffix}"].to_numpy()
+        >= merged_results[ARTICLE_NUM_CHARS].to_numpy(),
+        "Contains Invalid Characters": merged_results[
+            f"{NUM_BAD_CHARS}{suffix}"
+        ].to_numpy()
+        > 0,
+    }
+
+
+def get_win_tie_loss(
+    merged_results: pd.DataFrame, suffix1: str, suffix2: str, accuracy_threshold: int
+) -> Dict[str, np.ndarray]:
+    """Returns per-row indicators of a win, tie or loss of the first model against the second model.
+
+    The win rate counts a tie as half a win.
+    """
+    acc1 = merged_results[f"{DataSchema.ACCURACY}{suffix1}"].to_numpy()
+    num1 = merged_results[f"{DataSchema.NUM_WORDS}{suffix1}"].to_numpy()
+    acc2 = merged_results[f"{DataSchema.ACCURACY}{suffix2}"].to_numpy()
+    num2 = merged_results[f"{DataSchema.NUM_WORDS}{suffix2}"].to_numpy()
+    wins = compare(acc1, num1, acc2, num2, accuracy_threshold=accuracy_threshold)
+    losses = compare(acc2, num2, acc1, num1, accuracy_threshold=accuracy_threshold)
+    ties = ~wins & ~losses
+    return {"Win Rate": wins + 0.5 * ties, "Win": wins, "Tie": ties, "Loss": losses}
 
 
 def get_model_stats(merged_results: pd.DataFrame, suffix: str) -> pd.Series:
@@ -102,32 +220,12 @@ def get_model_stats(merged_results: pd.DataFrame, suffix: str) -> pd.Series:
         merged_results: The dataframe with the final merged results
         suffix: Suffix label for columns corresonding to the given model assigned at the merge stage.
     """
-    lens = np.array([len(row["text"].split()) for _, row in merged_results.iterrows()])
-    return pd.Series(
-        {
-            "Accuracy >=3": np.mean(
-                merged_results[f"{DataSchema.ACCURACY}{suffix}"] >= 3
-            ),
-            "Accuracy >=4": np.mean(
-                merged_results[f"{DataSchema.ACCURACY}{suffix}"] >= 4
-            ),
-            "Median Compression": np.median(
-                merged_results[f"{DataSchema.NUM_WORDS}{suffix}"] / lens
-            ),
-            "Mean Compression": np.mean(
-                merged_results[f"{DataSchema.NUM_WORDS}{suffix}"] / lens
-            ),
-            "Summary Too Long": np.mean(
-                merged_results[
-                    f"{DataSchema.SUMMARY_GENERATION_RAW_OUTPUT}{suffix}"
-                ].str.len()
-                >= merged_results["text"].str.len()
-            ),
-            "Contains Invalid Characters": np.mean(
-                merged_results[f"num_bad_chars{suffix}"] > 0
-            ),
-        }
-    )
+    stats = {
+        stat: np.mean(values)
+        for stat, values in get_model_row_values(merged_results, suffix).items()
+    }
+    stats["Median Compression"] = np.median(get_compression(merged_results, suffix))
+    return pd.Series(stats)[MODEL_STATS]
 
 
 def get_win_rate(
@@ -143,85 +241,254 @@ def get_win_rate(
         suffix2:  Suffix label for columns corresonding to the second model
         accuracy_threshold: Score threshold to classify chosen and rejected samples.
     """
-    wins = [
-        compare(*vals, accuracy_threshold=accuracy_threshold)
-        for vals in zip(
-            merged_results[f"{DataSchema.ACCURACY}{suffix1}"],
-            merged_results[f"{DataSchema.NUM_WORDS}{suffix1}"],
-            merged_results[f"{DataSchema.ACCURACY}{suffix2}"],
-            merged_results[f"{DataSchema.NUM_WORDS}{suffix2}"],
+    win_tie_loss = get_win_tie_loss(
+        merged_results, suffix1, suffix2, accuracy_threshold
+    )
+    return 100 * np.mean(win_tie_loss["Win Rate"])
+
+
+def merge_results(results_by_suffix: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """Matches the evaluated rows of several models by article.
+
+    Columns of each model are labelled with its suffix. Like an inner join on the article, every combination of rows
+    for the same article is kept.
+    """
+    merged_results = None
+    for suffix, results in results_by_suffix.items():
+        results = results[MERGE_KEYS + EVAL_COLUMNS].rename(
+            columns={col: f"{col}{suffix}" for col in EVAL_COLUMNS}
         )
-    ]
+        merged_results = (
+            results
+            if merged_results is None
+            else pd.merge(merged_results, results, on=MERGE_KEYS)
+        )
+    return merged_results
 
-    losses = [
-        compare(*vals, accuracy_threshold=accuracy_threshold)
-        for vals in zip(
-            merged_results[f"{DataSchema.ACCURACY}{suffix2}"],
-            merged_results[f"{DataSchema.NUM_WORDS}{suffix2}"],
-            merged_results[f"{DataSchema.ACCURACY}{suffix1}"],
-            merged_results[f"{DataSchema.NUM_WORDS}{suffix1}"],
+
+def _tag_results(batch: pd.DataFrame, suffix: str) -> pd.DataFrame:
+    batch = batch[MERGE_KEYS + EVAL_COLUMNS].copy()
+    batch[SOURCE_COL] = suffix
+    return batch
+
+
+def _merge_article_results(group: pd.DataFrame, suffixes: List[str]) -> pd.DataFrame:
+    return merge_results(
+        {suffix: group[group[SOURCE_COL] == suffix] for suffix in suffixes}
+    )
+
+
+def merge_results_ds(
+    results_by_suffix: Dict[str, ray.data.Dataset],
+) -> ray.data.Dataset:
+    """Distributed version of `merge_results`. Rows for the same article are brought together with a shuffle."""
+    tagged = [
+        ds.map_batches(
+            _tag_results, fn_kwargs=dict(suffix=suffix), batch_format="pandas"
         )
+        for suffix, ds in results_by_suffix.items()
     ]
-
-    win_rate = np.mean(wins) + 0.5 * (1 - np.mean(wins) - np.mean(losses))
-    return 100 * win_rate
+    return (
+        tagged[0]
+        .union(*tagged[1:])
+        .groupby(ARTICLE_HASH)
+        .map_groups(
+            _merge_article_results,
+            fn_kwargs=dict(suffixes=list(results_by_suffix)),
+            batch_format="pandas",
+        )
+    )
 
 
-def calculate_statistics(
-    results: pd.DataFrame,
-    baseline_results: pd.DataFrame,
-    gpt_4o_results: Optional[pd.DataFrame],
+def _get_block_sums(
+    batch: pd.DataFrame,
+    models: Dict[str, str],
+    pairs: Dict[str, Tuple[str, str]],
     accuracy_threshold: int,
-) -> Tuple[pd.DataFrame, Dict[str, float]]:
-    """Calculates the evaluation statistics for the given models"""
-    merge_col = DataSchema.ARTICLE
-    merged_results = pd.merge(
-        results, baseline_results, on=merge_col, suffixes=("_x", "_y")
+    num_bootstrap: int,
+    seed: int,
+) -> pd.DataFrame:
+    """Reduces a block of merged results to the sums needed for all statistics and their bootstrap resamples.
+
+    Each bootstrap resample weights the rows with Poisson(1) counts, which approximates resampling with replacement
+    and can be drawn independently per block. The weights of all resamples are drawn for `BOOTSTRAP_CHUNK_ROWS` rows
+    at a time, so memory use does not grow with the block size.
+    """
+    columns = [
+        values
+        for suffix in models.values()
+        for values in get_model_row_values(batch, suffix).values()
+    ] + [
+        values
+        for suffix1, suffix2 in pairs.values()
+        for values in get_win_tie_loss(
+            batch, suffix1, suffix2, accuracy_threshold
+        ).values()
+    ]
+    values = np.stack(columns, axis=1).astype(np.float64)
+    histograms = np.stack(
+        [
+            np.histogram(
+                np.clip(get_compression(batch, suffix), 0, COMPRESSION_BINS[-1]),
+                bins=COMPRESSION_BINS,
+            )[0]
+            for suffix in models.values()
+        ]
     )
-    if gpt_4o_results is not None:
-        gpt_4o_results = gpt_4o_results.rename(
-            columns={
-                col: f"{col}_z" for col in gpt_4o_results.columns if col != merge_col
-            }
-        )
-        merged_results = pd.merge(
-            merged_results, gpt_4o_results, on=merge_col, suffixes=(None, "_")
+
+    # Seed with the block contents, so the resamples do not depend on scheduling
+    block_seed = int(batch[ARTICLE_HASH].to_numpy().sum(dtype=np.uint64))
+    rng = np.random.default_rng([seed, block_seed])
+    bootstrap_counts = np.zeros(num_bootstrap)
+    bootstrap_sums = np.zeros((num_bootstrap, values.shape[1]))
+    for start in range(0, len(batch), BOOTSTRAP_CHUNK_ROWS):
+        chunk = values[start : start + BOOTSTRAP_CHUNK_ROWS]
+        weights = rng.poisson(1.0, size=(num_bootstrap, len(chunk))).astype(np.float64)
+        bootstrap_counts += weights.sum(axis=1)
+        bootstrap_sums += weights @ chunk
+    sums = dict(
+        count=len(batch),
+        sums=values.sum(axis=0).tolist(),
+        histograms=histograms.tolist(),
+        bootstrap_counts=bootstrap_counts.tolist(),
+        bootstrap_sums=bootstrap_sums.tolist(),
+    )
+    return pd.DataFrame({"sums": [json.dumps(sums)]})
+
+
+def _get_compression_in_range(
+    batch: pd.DataFrame, suffix: str, low: float, high: float
+) -> pd.DataFrame:
+    compression = get_compression(batch, suffix)
+    return pd.DataFrame(
+        {"compression": compression[(compression >= low) & (compression < high)]}
+    )
+
+
+def _get_median_ds(
+    merged_ds: ray.data.Dataset, suffix: str, histogram: np.ndarray
+) -> float:
+    """Returns the exact median compression, reading back only the rows in the buckets that contain the median"""
+    count = histogram.sum()
+    cumulative = np.cumsum(histogram)
+    # 0-indexed order statistics averaged by `np.median`
+    ranks = sorted({(count - 1) // 2, count // 2})
+    buckets = np.searchsorted(cumulative, np.array(ranks), side="right")
+    low = COMPRESSION_BINS[buckets.min()] if buckets.min() > 0 else -np.inf
+    high = (
+        COMPRESSION_BINS[buckets.max() + 1]
+        if buckets.max() + 1 < len(COMPRESSION_BINS) - 1
+        else np.inf
+    )
+    num_below = cumulative[buckets.min() - 1] if buckets.min() > 0 else 0
+    values = np.sort(
+        merged_ds.map_batches(
+            _get_compression_in_range,
+            fn_kwargs=dict(suffix=suffix, low=low, high=high),
+            batch_format="pandas",
         )
+        .to_pandas()["compression"]
+        .to_numpy()
+    )
+    return float(np.mean(values[np.array(ranks) - num_below]))
+
 
+def calculate_statistics(
+    results: ray.data.Dataset,
+    baseline_results: ray.data.Dataset,
+    gpt_4o_results: Optional[ray.data.Dataset],
+    accuracy_threshold: int,
+    num_bootstrap: int = 1000,
+    confidence: float = 0.95,
+    seed: int = 0,
+) -> Tuple[pd.DataFrame, pd.DataFrame, Optional[pd.DataFrame]]:
+    """Calculates the evaluation statistics for the given models with a distributed reduction.
+
+    Evaluated rows are matched by article with a shuffle, and every block of matched rows is reduced to a handful of
+    sums that are added up on the driver, so the results never need to fit in driver memory.
+
+    Returns:
+        stats_df: Statistics for each model, with a column per model
+        win_rates_df: Win, tie and loss rates against the baseline model, with a row per model
+        ci_df: Bootstrap confidence intervals for all statistics except the median compression, indexed by model and
+            statistic. None if `num_bootstrap` is 0.
+    """
+    results_by_suffix = {"_x": results, "_y": baseline_results}
+    models = {"Model": "_x", "Baseline": "_y"}
     # stores win rates against the baseline model
-    win_rates = {
-        "Model": get_win_rate(
-            merged_results,
-            suffix1="_x",
-            suffix2="_y",
+    pairs = {"Model": ("_x", "_y")}
+    if gpt_4o_results is not None:
+        results_by_suffix["_z"] = gpt_4o_results
+        models["GPT-4o"] = "_z"
+        pairs["GPT-4o"] = ("_z", "_y")
+
+    merged_ds = merge_results_ds(results_by_suffix).materialize()
+    block_sums = merged_ds.map_batches(
+        _get_block_sums,
+        fn_kwargs=dict(
+            models=models,
+            pairs=pairs,
             accuracy_threshold=accuracy_threshold,
+            num_bootstrap=num_bootstrap,
+            seed=seed,
+        ),
+        batch_size=None,
+        batch_format="pandas",
+    )
+    count, sums, histograms = 0, 0, 0
+    bootstrap_counts, bootstrap_sums = 0, 0
+    for row in block_sums.iter_rows():
+        block = json.loads(row["sums"])
+        count += block["count"]
+        sums += np.array(block["sums"])
+        histograms += np.array(block["histograms"])
+        bootstrap_counts += np.array(block["bootstrap_counts"])
+        bootstrap_sums += np.array(block["bootstrap_sums"]).reshape(
+            num_bootstrap, len(block["sums"])
+        )
+    if count == 0:
+        raise ValueError("No articles with valid results for all models")
+
+    index = [
+        (name, stat)
+        for name in models
+        for stat in MODEL_STATS
+        if stat != "Median Compression"
+    ] + [(name, stat) for name in pairs for stat in WIN_RATE_STATS]
+    index = pd.MultiIndex.from_tuples(index)
+    means = pd.Series(sums / count, index=index)
+    for name, histogram in zip(models, histograms):
+        means[(name, "Median Compression")] = _get_median_ds(
+            merged_ds, models[name], histogram
         )
-    }
 
-    cols = {
-        "Model": get_model_stats(merged_results, "_x"),
-        "Baseline": get_model_stats(merged_results, "_y"),
-    }
-    if gpt_4o_results is not None:
-        cols.update({"GPT-4o": get_model_stats(merged_results, "_z")})
-        win_rates.update(
+    stats_df = pd.DataFrame({name: means[name][MODEL_STATS] for name in models})
+    win_rates_df = pd.DataFrame({name: means[name][WIN_RATE_STATS] for name in pairs}).T
+
+    ci_df = None
+    if num_bootstrap > 0:
+        bootstrap_means = bootstrap_sums / bootstrap_counts[:, None]
+        alpha = (1 - confidence) / 2
+        ci_df = pd.DataFrame(
             {
-                "GPT-4o": get_win_rate(
-                    merged_results,
-                    suffix1="_z",
-                    suffix2="_y",
-                    accuracy_threshold=accuracy_threshold,
-                )
-            }
+                "ci_low": np.quantile(bootstrap_means, alpha, axis=0),
+                "ci_high": np.quantile(bootstrap_means, 1 - alpha, axis=0),
+            },
+            index=index,
         )
-    stats_df = pd.DataFrame(cols)
-    return stats_df, win_rates
+    return stats_df, win_rates_df, ci_df
 
 
-def format_dataframe(df: pd.DataFrame) -> str:
-    """Formats the dataframe into a string"""
+def format_dataframe(df: pd.DataFrame, ci_df: Optional[pd.DataFrame] = None) -> str:
+    """Formats the dataframe into a string, with confidence intervals if given"""
     # Format the float values to 4 decimal places
     formatted_df = df.applymap(lambda x: 100 * x).applymap(lambda x: f"{x:.4f} %")
+    if ci_df is not None:
+        for name in formatted_df.columns:
+            for stat in formatted_df.index:
+                if (name, stat) in ci_df.index:
+                    low, high = 100 * ci_df.loc[(name, stat)]
+                    formatted_df.loc[stat, name] += f"\n[{low:.2f}, {high:.2f}]"
     formatted_df.index.name = "Metric"
     # Create a table using tabulate
     table = tabulate(
@@ -231,12 +498,32 @@ def format_dataframe(df: pd.DataFrame) -> str:
     return table
 
 
-def preprocess_ray_ds_for_eval(ds: ray.data.Dataset) -> pd.DataFrame:
-    """Preprocess the input dataset into a dataframe for evaluation"""
-    ds = ds.filter(is_row_valid)
-    ds = ds.map(eval_row)
-    results = ds.to_pandas()
-    return results
+def preprocess_ray_ds_for_eval(ds: ray.data.Dataset) -> ray.data.Dataset:
+    """Preprocess the input dataset into a dataset of evaluated rows"""
+    return ds.map_batches(eval_batch, batch_format="pandas")
+
+
+def _filter_adapter(batch: pd.DataFrame, adapter: str) -> pd.DataFrame:
+    return batch[batch[DataSchema.ADAPTER] == adapter].drop(
+        columns=[DataSchema.ADAPTER]
+    )
+
+
+def split_results_by_adapter(
+    results: ray.data.Dataset,
+) -> Dict[Optional[str], ray.data.Dataset]:
+    """Splits results from a multi-adapter run into results per adapter.
+
+    Results without an adapter column are returned as is, with the key `None`.
+    """
+    if DataSchema.ADAPTER not in results.columns():
+        return {None: results}
+    return {
+        adapter: results.map_batches(
+            _filter_adapter, fn_kwargs=dict(adapter=adapter), batch_format="pandas"
+        )
+        for adapter in sorted(results.unique(DataSchema.ADAPTER))
+    }
 
 
 if __name__ == "__main__":
@@ -247,28 +534,45 @@ if __name__ == "__main__":
         args.baseline_outputs_path, file_extensions=["parquet"]
     )
 
-    results = preprocess_ray_ds_for_eval(ds)
+    # Evaluated rows are small, so they are materialized once and reused for every comparison
+    results = preprocess_ray_ds_for_eval(ds).materialize()
 
-    results_baseline = preprocess_ray_ds_for_eval(ds_baseline)
+    results_baseline = preprocess_ray_ds_for_eval(ds_baseline).materialize()
 
     results_ds_gpt4o = None
     if args.gpt4o_outputs_path:
         ds_gpt4o = ray.data.read_parquet(
             args.gpt4o_outputs_path, file_extensions=["parquet"]
         )
-        results_ds_gpt4o = preprocess_ray_ds_for_eval(ds_gpt4o)
+        results_ds_gpt4o = preprocess_ray_ds_for_eval(ds_gpt4o).materialize()
 
-    print("Num Results:", len(results))
-    print("Num Baseline Results:", len(results_baseline))
+    print("Num Results:", results.count())
+    print("Num Baseline Results:", results_baseline.count())
 
     accuracy_threshold = args.accuracy_threshold
-    stats_df, win_rates = calculate_statistics(
-        results=results,
-        baseline_results=results_baseline,
-        gpt_4o_results=results_ds_gpt4o,
-        accuracy_threshold=accuracy_threshold,
-    )
-    print(format_dataframe(stats_df))
-    print("\n")
-    for name, win_rate in win_rates.items():
-        print(f"{name} Win Rate against Baseline: {win_rate:.4f} %")
+    for adapter, adapter_results in split_results_by_adapter(results).items():
+        if adapter is not None:
+            print(f"\nAdapter: {adapter}")
+        stats_df, win_rates_df, ci_df = calculate_statistics(
+            results=adapter_results,
+            baseline_results=results_baseline,
+            gpt_4o_results=results_ds_gpt4o,
+            accuracy_threshold=accuracy_threshold,
+            num_bootstrap=args.num_bootstrap,
+            confidence=args.confidence,
+            seed=args.seed,
+        )
+        print(format_dataframe(stats_df, ci_df))
+        print("\n")
+        for name, rates in win_rates_df.iterrows():
+            win_rate = (
+                f"{name} Win Rate against Baseline: {100 * rates['Win Rate']:.4f} %"
+            )
+            if ci_df is not None:
+                low, high = 100 * ci_df.loc[(name, "Win Rate")]
+                win_rate += f" ({args.confidence:.0%} CI: [{low:.2f}, {high:.2f}] %)"
+            print(win_rate)
+            print(
+                f"  Win: {100 * rates['Win']:.2f} %, Tie: {100 * rates['Tie']:.2f} %, "
+                f"Loss: {100 * rates['Loss']:.2f} %"
+            )
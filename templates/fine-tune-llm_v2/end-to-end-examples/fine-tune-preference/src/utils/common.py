@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 import random
@@ -9,7 +10,7 @@ from typing import Any, Dict, List
 import textwrap
 
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
 MODEL_HOME = "/mnt/local_storage/.cache/huggingface/"
 HF_TOKEN_CACHE_PATH = "/mnt/local_storage/data/cache/huggingface/token"
@@ -19,6 +20,16 @@ NUM_RETRIES = 5
 SLEEP_INTERVAL_BETWEEN_RETRIES = 10
 ERROR_OUTPUT = "$$RUNTIME_ERROR$$"
 
+# Exponential backoff for transient errors in async requests
+INITIAL_BACKOFF_SECONDS = 1
+MAX_BACKOFF_SECONDS = 60
+TRANSIENT_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
 
 permitted_chars = (
     string.ascii_letters
@@ -93,6 +104,56 @@ def get_completion(
     # Error response
     return ERROR_OUTPUT
 
+
+async def get_completion_async(
+    client: AsyncOpenAI,
+    model: str,
+    messages: List[Dict[str, str]],
+    tools: List[Dict[str, Any]] = None,
+    temperature: float = 0.0,
+    max_tokens: int = 256,
+    num_retries: int = NUM_RETRIES,
+) -> "ChatCompletion":  # noqa: F821
+    """
+    Async version of `get_completion`.
+
+    Retries rate limiting, timeout, connection and server errors with exponential backoff and jitter. Other errors are raised.
+    """
+    backoff = INITIAL_BACKOFF_SECONDS
+    for _ in range(num_retries):
+        try:
+            return await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                tools=tools,
+                temperature=temperature,
+                max_tokens=max_tokens,
+            )
+        except TRANSIENT_ERRORS as e:
+            print(f"Error: {e}")
+            await asyncio.sleep(backoff * (1 + random.random()))
+            backoff = min(2 * backoff, MAX_BACKOFF_SECONDS)
+    # Error response
+    return ERROR_OUTPUT
+
+
+class AsyncRateLimiter:
+    """Spaces out requests to stay under a given number of requests per minute"""
+
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60 / requests_per_minute
+        self.next_request_time = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_request_time - now
+            self.next_request_time = max(now, self.next_request_time) + self.interval
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+
 def print_wrapped(label, content, width=80):
     """Simple utility to print `content` text-wrapped with label `label`"""
     print(f"{label}:")
@@ -1,14 +1,30 @@
+import fcntl
 import hashlib
+import json
 import os
-import subprocess
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 
-from filelock import FileLock
+import pyarrow.fs as pafs
+from filelock import FileLock, Timeout
 from huggingface_hub import repo_exists, snapshot_download
 
 from src.utils.common import MODEL_HOME, init_logger
 
+# Maximum total size of remote checkpoints cached under `MODEL_HOME`. Least recently used entries are evicted first.
+MODEL_CACHE_MAX_BYTES = int(os.environ.get("MODEL_CACHE_MAX_BYTES", 500 * 1024**3))
+# Files are downloaded with parallel ranged reads of this size
+DOWNLOAD_CHUNK_BYTES = 64 * 1024**2
+NUM_DOWNLOAD_THREADS = 32
+# A cache entry is complete once its manifest has been written
+CACHE_MANIFEST_FILE = ".cache_manifest.json"
+CACHE_ENTRY_PREFIX = "models--checkpoint--"
+
 
 class DownloadFailedError(Exception):
     pass
@@ -16,6 +32,10 @@ class DownloadFailedError(Exception):
 
 logger = init_logger()
 
+# File descriptors holding a shared lock on the in-use file of each cache entry loaded by this process. The locks are
+# held until the process exits, so that entries are not evicted while a predictor is using them.
+_IN_USE_FDS: Dict[str, int] = {}
+
 
 def is_remote_path(source_path: str) -> bool:
     scheme = urlparse(source_path).scheme
@@ -24,18 +44,21 @@ def is_remote_path(source_path: str) -> bool:
     return True
 
 
-def download_to_local(source_path: str):
-    """Thread-safe download from remote storage"""
+def download_to_local(
+    source_path: str, verify_cache: bool = False, mark_in_use: bool = False
+):
+    """Thread-safe download from remote storage
+
+    With `mark_in_use`, the cache entry is protected from eviction for the lifetime of the calling process.
+    """
     scheme = urlparse(source_path).scheme
     local_path = get_local_path(source_path)
     if not is_remote_path(source_path):
         logger.info(f"Found local path {source_path}, skipping downloading...")
         return source_path
 
-    elif scheme == "s3":
-        download_from_s3(source_path, local_path)
-    elif scheme == "gcs":
-        download_from_gcs(source_path, local_path)
+    elif scheme in ("s3", "gs", "gcs", "file"):
+        download_from_remote_storage(source_path, local_path, verify_cache, mark_in_use)
     else:
         raise DownloadFailedError(f"Invalid remote path: {source_path}")
     return local_path
@@ -48,31 +71,302 @@ def get_lock_path(local_path: str):
     return parent / (path.name + ".lock")
 
 
-def download_from_s3(remote_path: str, local_path: str):
-    lock_file = get_lock_path(local_path)
-    with FileLock(lock_file):
-        result = subprocess.run(["aws", "s3", "sync", remote_path, local_path])
-        if result.returncode != 0:
-            raise DownloadFailedError(
-                f"Download failed from remote storage {remote_path} with result: {result}"
+def _get_in_use_path(local_path: str) -> str:
+    return str(local_path) + ".inuse"
+
+
+def _mark_in_use(local_path: str):
+    """Marks a cache entry as in use by this process. Must be called while holding the entry's lock."""
+    if local_path in _IN_USE_FDS:
+        return
+    fd = os.open(_get_in_use_path(local_path), os.O_RDWR | os.O_CREAT)
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    _IN_USE_FDS[local_path] = fd
+
+
+def _is_in_use(local_path: str) -> bool:
+    """Checks whether a cache entry is marked as in use, by this or any other process"""
+    in_use_path = _get_in_use_path(local_path)
+    if not os.path.exists(in_use_path):
+        return False
+    fd = os.open(in_use_path, os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        # Closing the file releases the lock
+        os.close(fd)
+    return False
+
+
+def _get_filesystem(remote_path: str) -> Tuple[pafs.FileSystem, str]:
+    """Returns the pyarrow filesystem and the path within it for a remote path.
+
+    S3-compatible stand-ins such as minio can be used by setting `AWS_ENDPOINT_URL`.
+    """
+    if urlparse(remote_path).scheme == "gcs":
+        remote_path = "gs" + remote_path[len("gcs") :]
+    return pafs.FileSystem.from_uri(remote_path)
+
+
+def _list_remote_files(
+    remote_path: str,
+) -> Tuple[pafs.FileSystem, Dict[str, pafs.FileInfo]]:
+    """Lists the files under `remote_path`, keyed by their path relative to it"""
+    fs, base_path = _get_filesystem(remote_path)
+    remote_files = {
+        os.path.relpath(info.path, base_path): info
+        for info in fs.get_file_info(pafs.FileSelector(base_path, recursive=True))
+        if info.type == pafs.FileType.File
+    }
+    return fs, remote_files
+
+
+def _hash_file_chunks(path: str, chunk_bytes: int) -> List[str]:
+    """Returns the SHA-256 of each `chunk_bytes` chunk of a file"""
+    hashes = []
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b""):
+            hashes.append(hashlib.sha256(chunk).hexdigest())
+    return hashes
+
+
+def _read_range_into(
+    fs: pafs.FileSystem, remote_file: str, fd: int, offset: int, length: int
+) -> str:
+    """Copies a byte range of a remote file into `fd` and returns the SHA-256 of the bytes read from the source"""
+    with fs.open_input_file(remote_file) as f:
+        data = f.read_at(length, offset)
+    # A short read means the remote file changed during the download
+    if len(data) != length:
+        raise ValueError(
+            f"Expected {length} bytes at offset {offset} of {remote_file}, got {len(data)}"
+        )
+    os.pwrite(fd, data, offset)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _download_with_ranged_reads(
+    fs: pafs.FileSystem, remote_files: Dict[str, pafs.FileInfo], local_path: str
+) -> Dict[str, Dict]:
+    """Downloads the given remote files with parallel ranged reads.
+
+    Each chunk is hashed as it is read from the source, and the written files are checked against these hashes.
+    Returns the manifest entries (local size and modification time, remote modification time and chunk hashes) for
+    each file.
+    """
+    files = {}
+    with ThreadPoolExecutor(NUM_DOWNLOAD_THREADS) as executor:
+        for rel_path, info in remote_files.items():
+            part_path = os.path.join(local_path, rel_path + ".part")
+            os.makedirs(os.path.dirname(part_path), exist_ok=True)
+            fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            os.ftruncate(fd, info.size)
+            futures = [
+                executor.submit(
+                    _read_range_into,
+                    fs,
+                    info.path,
+                    fd,
+                    offset,
+                    min(DOWNLOAD_CHUNK_BYTES, info.size - offset),
+                )
+                for offset in range(0, info.size, DOWNLOAD_CHUNK_BYTES)
+            ]
+            files[rel_path] = (part_path, fd, futures)
+        try:
+            chunk_hashes = {
+                rel_path: [future.result() for future in futures]
+                for rel_path, (_, _, futures) in files.items()
+            }
+        finally:
+            for _, fd, _ in files.values():
+                os.close(fd)
+
+    manifest_files = {}
+    for rel_path, (part_path, _, _) in files.items():
+        if _hash_file_chunks(part_path, DOWNLOAD_CHUNK_BYTES) != chunk_hashes[rel_path]:
+            raise ValueError(
+                f"Downloaded {rel_path} does not match the content read from the source"
             )
+        file_path = os.path.join(local_path, rel_path)
+        os.replace(part_path, file_path)
+        manifest_files[rel_path] = {
+            "size": remote_files[rel_path].size,
+            "mtime_ns": os.stat(file_path).st_mtime_ns,
+            "remote_mtime_ns": remote_files[rel_path].mtime_ns,
+            "chunk_sha256": chunk_hashes[rel_path],
+        }
+    return manifest_files
 
 
-def download_from_gcs(remote_path: str, local_path: str):
+def _get_manifest_path(local_path: str) -> str:
+    return os.path.join(local_path, CACHE_MANIFEST_FILE)
+
+
+def is_cached(
+    local_path: str,
+    remote_files: Optional[Dict[str, pafs.FileInfo]],
+    verify_hashes: bool = False,
+) -> bool:
+    """Checks whether an up-to-date, complete copy of a remote checkpoint is cached at `local_path`.
+
+    The manifest must list the same files as `remote_files`, with the remote sizes and modification times recorded
+    at download time, so that a checkpoint re-uploaded to the same path is downloaded again. If `remote_files` is
+    None, only the local copy is checked. Local file sizes and
+    modification times are checked against the manifest as well. With `verify_hashes`, file contents are re-hashed
+    and compared with the hashes of the bytes read from the source, which reads the whole checkpoint.
+    """
+    manifest_path = _get_manifest_path(local_path)
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if remote_files is not None and set(manifest["files"]) != set(remote_files):
+        return False
+    for rel_path, entry in manifest["files"].items():
+        if remote_files is not None and (
+            remote_files[rel_path].size != entry["size"]
+            or remote_files[rel_path].mtime_ns != entry.get("remote_mtime_ns")
+        ):
+            return False
+        file_path = os.path.join(local_path, rel_path)
+        if not os.path.exists(file_path):
+            return False
+        stat = os.stat(file_path)
+        if stat.st_size != entry["size"] or stat.st_mtime_ns != entry.get("mtime_ns"):
+            return False
+        if verify_hashes and _hash_file_chunks(
+            file_path, manifest["chunk_bytes"]
+        ) != entry.get("chunk_sha256"):
+            return False
+    return True
+
+
+def _get_cache_entries() -> Dict[str, Tuple[float, int]]:
+    """Returns the last access time and size of each complete cache entry under `MODEL_HOME`"""
+    entries = {}
+    if not os.path.isdir(MODEL_HOME):
+        return entries
+    for name in os.listdir(MODEL_HOME):
+        manifest_path = _get_manifest_path(os.path.join(MODEL_HOME, name))
+        if not name.startswith(CACHE_ENTRY_PREFIX) or not os.path.exists(manifest_path):
+            continue
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        size = sum(entry["size"] for entry in manifest["files"].values())
+        entries[os.path.join(MODEL_HOME, name)] = (
+            os.path.getmtime(manifest_path),
+            size,
+        )
+    return entries
+
+
+def evict_cache_entries(required_bytes: int, keep_path: str):
+    """Evicts least recently used cache entries until `required_bytes` fit under `MODEL_CACHE_MAX_BYTES`"""
+    entries = _get_cache_entries()
+    total_bytes = sum(size for _, size in entries.values())
+    for path, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+        if total_bytes + required_bytes <= MODEL_CACHE_MAX_BYTES:
+            break
+        if path == keep_path:
+            continue
+        # Skip entries that are locked by a concurrent download, instead of waiting on them
+        try:
+            with FileLock(get_lock_path(path), timeout=0):
+                # Predictors may still be loading or memory-mapping the weights after the download returns
+                if _is_in_use(path):
+                    continue
+                logger.info(f"Evicting {path} from the model cache")
+                shutil.rmtree(path, ignore_errors=True)
+        except Timeout:
+            continue
+        total_bytes -= size
+
+
+def download_from_remote_storage(
+    remote_path: str,
+    local_path: str,
+    verify_cache: bool = False,
+    mark_in_use: bool = False,
+):
+    """Downloads a remote checkpoint into the node-local cache, unless an up-to-date copy is already cached.
+
+    Every call lists the remote files once, so that a checkpoint re-uploaded to the same path is not served stale.
+    With `verify_cache`, a cached copy is only reused if its content hashes match the manifest. An out-of-date copy
+    that is marked as in use is reused as well, since it cannot be replaced while predictors are loading it.
+    With `mark_in_use`, the entry is marked as in use by the calling process (see `download_to_local`).
+    """
     lock_file = get_lock_path(local_path)
+    manifest_path = _get_manifest_path(local_path)
     with FileLock(lock_file):
-        result = subprocess.run(
-            ["gcloud", "storage", "rsync", "--recursive", remote_path, local_path]
-        )
-        if result.returncode != 0:
+        try:
+            fs, remote_files = _list_remote_files(remote_path)
+        except (OSError, ValueError) as e:
             raise DownloadFailedError(
-                f"Download failed from remote storage with result: {result}"
+                f"Listing remote storage {remote_path} failed with error: {e}"
+            ) from e
+        if not remote_files:
+            raise DownloadFailedError(f"No files found at remote path {remote_path}")
+
+        if is_cached(local_path, remote_files, verify_hashes=verify_cache):
+            # Mark the entry as recently used
+            os.utime(manifest_path)
+            logger.info(f"Found {remote_path} in the model cache at {local_path}")
+            if mark_in_use:
+                _mark_in_use(local_path)
+            return
+        if _is_in_use(local_path) and is_cached(
+            local_path, None, verify_hashes=verify_cache
+        ):
+            logger.warning(
+                f"Cached copy of {remote_path} is out of date but in use, reusing it until it is released"
+            )
+            if mark_in_use:
+                _mark_in_use(local_path)
+            return
+        if os.path.exists(manifest_path):
+            logger.warning(
+                f"Cached copy of {remote_path} is out of date or corrupted, re-downloading"
+            )
+        # Remove stale files, which would otherwise be left next to the new checkpoint
+        shutil.rmtree(local_path, ignore_errors=True)
+
+        start_time = time.perf_counter()
+        try:
+            evict_cache_entries(
+                sum(info.size for info in remote_files.values()), keep_path=local_path
             )
+            files = _download_with_ranged_reads(fs, remote_files, local_path)
+        except (OSError, ValueError) as e:
+            raise DownloadFailedError(
+                f"Download failed from remote storage {remote_path} with error: {e}"
+            ) from e
+        download_time = time.perf_counter() - start_time
+
+        manifest = {
+            "source": remote_path,
+            "files": files,
+            "chunk_bytes": DOWNLOAD_CHUNK_BYTES,
+            "download_time_s": download_time,
+        }
+        with tempfile.NamedTemporaryFile(
+            "w", dir=local_path, suffix=".tmp", delete=False
+        ) as f:
+            json.dump(manifest, f)
+        os.replace(f.name, manifest_path)
+        num_bytes = sum(entry["size"] for entry in files.values())
+        logger.info(
+            f"Downloaded {num_bytes / 1024**3:.2f} GiB from {remote_path} in {download_time:.1f}s"
+        )
+        if mark_in_use:
+            _mark_in_use(local_path)
 
 
 def get_local_path(source_path: str):
     checkpoint_path_hash = hashlib.md5(source_path.encode()).hexdigest()
-    local_path = os.path.join(MODEL_HOME, f"models--checkpoint--{checkpoint_path_hash}")
+    local_path = os.path.join(MODEL_HOME, f"{CACHE_ENTRY_PREFIX}{checkpoint_path_hash}")
     return local_path
 
 
@@ -84,8 +378,15 @@ def safe_hf_download(model_id: str):
         model_path = snapshot_download(repo_id=model_id)
     return model_path
 
-def download_model(model_id_or_path: str):
-    """Helper function to download a model given the model id or remote path"""
+
+def download_model(
+    model_id_or_path: str, verify_cache: bool = False, mark_in_use: bool = False
+):
+    """Helper function to download a model given the model id or remote path
+
+    Predictors should pass `mark_in_use` so that the weights they load are not evicted by a later download on the
+    same node.
+    """
     if not is_remote_path(model_id_or_path):
         if not os.path.exists(model_id_or_path):
             # Make sure to download HF models in a thread-safe way explictly
@@ -93,4 +394,4 @@ def download_model(model_id_or_path: str):
             repo_exists(model_id_or_path)  # make sure it exists
             model_id_or_path = safe_hf_download(model_id_or_path)
         return model_id_or_path
-    return download_to_local(model_id_or_path)
+    return download_to_local(model_id_or_path, verify_cache, mark_in_use)
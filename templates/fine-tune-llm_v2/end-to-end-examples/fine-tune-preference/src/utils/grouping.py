@@ -0,0 +1,92 @@
+"""
+Group-by utilities for Ray Data that avoid a global shuffle when groups are already contiguous
+"""
+
+from typing import Any, Callable, Dict, Optional
+
+import pandas as pd
+import ray
+
+from src.utils.common import init_logger
+
+logger = init_logger()
+
+GROUP_COUNT_COLUMN = "count()"
+
+
+def _get_block_keys(batch: pd.DataFrame, key: str) -> pd.DataFrame:
+    """Returns the distinct keys in a block"""
+    return pd.DataFrame({key: batch[key].unique()})
+
+
+def _map_groups_in_block(
+    batch: pd.DataFrame,
+    key: str,
+    fn: Callable[..., pd.DataFrame],
+    fn_kwargs: Dict[str, Any],
+) -> pd.DataFrame:
+    """Applies `fn` to every group in a block, keeping the order of the groups"""
+    outputs = [fn(group, **fn_kwargs) for _, group in batch.groupby(key, sort=False)]
+    if not outputs:
+        return pd.DataFrame()
+    return pd.concat(outputs, ignore_index=True)
+
+
+def is_grouped_by_block(ds: ray.data.Dataset, key: str) -> bool:
+    """Checks whether all rows of every group are in the same block of the (materialized) dataset.
+
+    Only the distinct keys of each block are aggregated, so the check is cheap compared to shuffling the dataset.
+    """
+    block_keys = ds.map_batches(
+        _get_block_keys,
+        fn_kwargs=dict(key=key),
+        batch_size=None,
+        batch_format="pandas",
+        num_cpus=0,
+    )
+    if block_keys.count() == 0:
+        return True
+    max_blocks_per_key = block_keys.groupby(key).count().max(GROUP_COUNT_COLUMN)
+    return max_blocks_per_key == 1
+
+
+def map_groups_local(
+    ds: ray.data.Dataset,
+    key: str,
+    fn: Callable[..., pd.DataFrame],
+    fn_kwargs: Optional[Dict[str, Any]] = None,
+    num_cpus: float = 0,
+) -> ray.data.Dataset:
+    """Applies `fn` to each group of rows with the same `key`, like `ds.groupby(key).map_groups(fn)`.
+
+    If every group is contained in a single block, as is the case when generations for an article are produced by
+    `duplicate_rows` and stay together through `get_predictions_on_dataset`, groups are formed within each block and
+    the global shuffle is skipped. Otherwise, this falls back to the shuffle-based `map_groups`.
+
+    The dataset is materialized first, so that the locality check and the grouping see the same blocks.
+
+    Args:
+        ds: The input dataset
+        key: Column to group by
+        fn: Function mapping a pandas DataFrame with the rows of a group to an output DataFrame
+        fn_kwargs: Keyword arguments for `fn`
+        num_cpus: Number of CPUs to reserve per task
+    """
+    fn_kwargs = fn_kwargs or {}
+    ds = ds.materialize()
+    if not is_grouped_by_block(ds, key):
+        logger.warning(
+            f"Rows with the same `{key}` span multiple blocks, falling back to a shuffle-based group-by"
+        )
+        return ds.groupby(key).map_groups(
+            fn, fn_kwargs=fn_kwargs, num_cpus=num_cpus, batch_format="pandas"
+        )
+
+    logger.info(f"All groups for `{key}` are block-local, skipping the shuffle")
+    return ds.map_batches(
+        _map_groups_in_block,
+        fn_kwargs=dict(key=key, fn=fn, fn_kwargs=fn_kwargs),
+        batch_size=None,
+        batch_format="pandas",
+        num_cpus=num_cpus,
+    )
@@ -1,7 +1,7 @@
-from typing import Optional
+from typing import List, Optional
 
 import yaml
-from pydantic import BaseModel, ConfigDict, Field
+from pydantic import BaseModel, ConfigDict, Field, model_validator
 
 
 class DataSchema:
@@ -17,6 +17,9 @@ class DataSchema:
     JUDGE_MCQ_RAW_OUTPUT = "judge_mc_raw_model_output"
     JUDGE_MCQ_INPUT = "judge_mc_prompt"
     SUMMARY_GENERATION_INPUT = "summary_generation_prompt"
+    ADAPTER = "adapter_id_or_path"
+    QA_PARSE_FAILURE = "qa_generation_parse_failure"
+    JUDGE_PARSE_FAILURE = "judge_mc_parse_failure"
 
     @classmethod
     def get_all_items(cls):
@@ -80,7 +83,19 @@ class OnlineInferenceConfig(BaseModelExtended):
     temperature: float = Field(description="Temperature while sampling from the model")
     max_tokens: int = Field(default=4096, description="Max tokens for generation")
     concurrency: int = Field(
-        description="Number of concurrent requests to send to the server."
+        description="Number of Ray workers sending requests to the server. With the default `max_concurrent_requests_per_worker`, this is also the number of concurrent requests."
+    )
+    max_concurrent_requests_per_worker: int = Field(
+        default=1,
+        description="Maximum number of requests in flight per Ray worker. The total number of concurrent requests to the server is at most `concurrency * max_concurrent_requests_per_worker`.",
+    )
+    requests_per_minute: Optional[float] = Field(
+        default=None,
+        description="Global rate limit across all Ray workers, split evenly between them. If `None`, requests are not rate limited.",
+    )
+    batch_size: int = Field(
+        default=64,
+        description="Number of rows sent to a Ray worker at a time. All requests in a batch are issued concurrently, subject to the limits above.",
     )
 
 
@@ -98,9 +113,39 @@ class OfflineInferenceConfig(BaseModelExtended):
     adapter_id_or_path: Optional[str] = Field(
         default=None, description="HuggingFace model ID or local path to LoRA weights"
     )
+    adapter_ids_or_paths: Optional[List[str]] = Field(
+        default=None,
+        description="List of HuggingFace model IDs or local paths to LoRA weights, to evaluate several adapters in a single run. Every input row is generated with each adapter and outputs are written to per-adapter columns. Mutually exclusive with `adapter_id_or_path`.",
+    )
     temperature: float = Field(description="Temperature while sampling from the model")
     top_p: float = Field(
         default=1,
         description="`top_p` sampling parameter controlling diversity of tokens sampled",
     )
     max_tokens: int = Field(default=4096, description="Max tokens for generation")
+    pretokenize_prompts: bool = Field(
+        default=False,
+        description="Whether to tokenize prompts while formatting them on CPU, so that vLLM receives token IDs and skips tokenization.",
+    )
+
+    @model_validator(mode="after")
+    def validate_adapters(self):
+        assert not (
+            self.adapter_id_or_path and self.adapter_ids_or_paths
+        ), "Only one of `adapter_id_or_path` and `adapter_ids_or_paths` can be provided"
+        return self
+
+    def get_adapters(self) -> List[str]:
+        """Returns the list of LoRA adapters to generate with. Empty if only the base model is used."""
+        if self.adapter_ids_or_paths:
+            return list(self.adapter_ids_or_paths)
+        if self.adapter_id_or_path:
+            return [self.adapter_id_or_path]
+        return []
+
+    def get_tokenizer_id_or_path(self) -> str:
+        return (
+            self.tokenizer_id_or_path
+            if self.tokenizer_id_or_path
+            else self.model_id_or_path
+        )
@@ -2,16 +2,26 @@
 Ray Data Actors for online and offline inference
 """
 
+import asyncio
 import os
-from typing import TYPE_CHECKING, Union
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
 
-from openai import OpenAI
+import pandas as pd
+
+from openai import AsyncOpenAI
 from vllm import LLM, SamplingParams
 from vllm.lora.request import LoRARequest
 
-from src.utils.common import get_completion, init_logger
+from src.utils.common import (
+    ERROR_OUTPUT,
+    AsyncRateLimiter,
+    get_completion_async,
+    init_logger,
+)
 from src.utils.download import download_model
 from src.utils.models import OfflineInferenceConfig, OnlineInferenceConfig
+from src.utils.synthetic_data_utils import PromptFormatter, get_adapter_col
 
 if TYPE_CHECKING:
     from ray.data import Dataset
@@ -22,7 +32,42 @@ logger = init_logger()
 VLLM_MAX_MODEL_LEN = 8192
 
 
+def get_sampling_params(model_config: OfflineInferenceConfig) -> SamplingParams:
+    """Returns the vLLM sampling params for the given model config"""
+    return SamplingParams(
+        n=1,
+        temperature=model_config.temperature,
+        max_tokens=model_config.max_tokens,
+        top_p=model_config.top_p,
+        stop=["<|eot_id|>", "<|end_of_text|>", "<|im_end|>"],
+    )
+
+
+def to_vllm_prompts(prompts: List[Any]) -> List[Union[str, Dict[str, List[int]]]]:
+    """Converts a column of prompts into vLLM inputs. Prompts can be raw text or token IDs."""
+    prompts = list(prompts)
+    if len(prompts) and not isinstance(prompts[0], str):
+        # Prompts were pretokenized while formatting
+        prompts = [{"prompt_token_ids": list(map(int, ids))} for ids in prompts]
+    return prompts
+
+
+def log_cold_start(start_time: float, download_time: float):
+    """Logs the time from actor start until the engine is ready, and the part of it spent waiting for weights"""
+    cold_start_time = time.perf_counter() - start_time
+    logger.info(
+        f"Cold start took {cold_start_time:.1f}s, of which {download_time:.1f}s were spent waiting for weights"
+    )
+
+
 class OfflinePredictor:
+    """Batched inference with vLLM
+
+    If the model config has several adapters (`adapter_ids_or_paths`), each input row is generated with every adapter
+    in a single `generate` call, using vLLM's multi-LoRA batching. The output for the adapter at index `i` is written to
+    `get_adapter_col(col_out, i)`.
+    """
+
     def __init__(
         self,
         model_config: OfflineInferenceConfig,
@@ -31,16 +76,26 @@ class OfflinePredictor:
     ):
         logger = init_logger()
 
-        model_id_or_path = download_model(model_config.model_id_or_path)
+        start_time = time.perf_counter()
+        model_id_or_path = download_model(
+            model_config.model_id_or_path, mark_in_use=True
+        )
 
-        adapter_path = None
-        if model_config.adapter_id_or_path:
-            logger.info("Downloading LoRA:", model_config.adapter_id_or_path)
-            adapter_path = download_model(model_config.adapter_id_or_path)
+        adapters = model_config.get_adapters()
+        self.lora_requests = []
+        for adapter in adapters:
+            logger.info(f"Downloading LoRA: {adapter}")
+            adapter_path = download_model(adapter, mark_in_use=True)
+            if len(adapters) == 1:
+                lora_request = LoRARequest("lora", 1, adapter_path)
+            else:
+                lora_id = len(self.lora_requests) + 1
+                lora_request = LoRARequest(f"lora_{lora_id}", lora_id, adapter_path)
+            self.lora_requests.append(lora_request)
+        download_time = time.perf_counter() - start_time
 
         self.col_in = col_in
         self.col_out = col_out
-        self.lora_location = adapter_path
         self.vllm_settings = dict(
             tensor_parallel_size=model_config.scaling_config.num_gpus_per_instance,
             max_model_len=VLLM_MAX_MODEL_LEN,
@@ -48,21 +103,15 @@ class OfflinePredictor:
         )
 
         # Create a sampling params object.
-        self.sampling_params = SamplingParams(
-            n=1,
-            temperature=model_config.temperature,
-            max_tokens=model_config.max_tokens,
-            top_p=model_config.top_p,
-            stop=["<|eot_id|>", "<|end_of_text|>", "<|im_end|>"],
-        )
+        self.sampling_params = get_sampling_params(model_config)
 
         llm_args = dict(model=model_id_or_path)
 
-        if self.lora_location is not None:
+        if self.lora_requests:
             llm_args.update(
                 dict(
                     enable_lora=True,
-                    max_loras=1,
+                    max_loras=len(self.lora_requests),
                     max_lora_rank=64,
                 )
             )
@@ -72,31 +121,159 @@ class OfflinePredictor:
 
         # Create an LLM.
         self.llm = LLM(**llm_args)
+        log_cold_start(start_time, download_time)
 
     def __call__(self, batch):
+        prompts = to_vllm_prompts(batch[self.col_in])
         # Generate texts from the prompts.
         # The output is a list of RequestOutput objects that contain the prompt,
         # generated text, and other information.
-        if self.lora_location is not None:
+        if len(self.lora_requests) > 1:
+            # Fan out every prompt to all adapters in a single call
+            outputs = self.llm.generate(
+                prompts * len(self.lora_requests),
+                self.sampling_params,
+                lora_request=[
+                    lora_request
+                    for lora_request in self.lora_requests
+                    for _ in range(len(prompts))
+                ],
+            )
+        elif self.lora_requests:
             outputs = self.llm.generate(
-                list(batch[self.col_in]),
+                prompts,
                 self.sampling_params,
-                lora_request=LoRARequest("lora", 1, self.lora_location),
+                lora_request=self.lora_requests[0],
             )
         else:
-            outputs = self.llm.generate(list(batch[self.col_in]), self.sampling_params)
+            outputs = self.llm.generate(prompts, self.sampling_params)
 
         generated_text = []
         for i, output in enumerate(outputs):
             generated_text.append(output.outputs[0].text.strip())
 
+        if len(self.lora_requests) > 1:
+            return {
+                **batch,
+                **{
+                    get_adapter_col(self.col_out, adapter_idx): generated_text[
+                        adapter_idx * len(prompts) : (adapter_idx + 1) * len(prompts)
+                    ]
+                    for adapter_idx in range(len(self.lora_requests))
+                },
+            }
         return {
             **batch,
             self.col_out: generated_text,
         }
 
 
-class OnlinePredictor:
+class FusedOfflinePredictor:
+    """Runs two generation stages that share a base model on a single vLLM engine
+
+    The first stage (e.g. summary generation) and the second stage (e.g. the judge) can each use a different LoRA
+    adapter, or the base model. Requests are tagged with the adapter for their stage, and the second stage's prompts
+    are formatted inside the actor, so the intermediate outputs never go through the object store.
+
+    Args:
+        model_config: Inference config for the first stage
+        second_model_config: Inference config for the second stage. Must have the same base model as `model_config`.
+        second_template: Prompt template for the second stage, with keys from the dataset row and `col_out`
+        col_in: Input column for the first stage
+        col_out: Output column for the first stage
+        second_col_in: Column to write the formatted prompts for the second stage to
+        second_col_out: Output column for the second stage
+    """
+
+    def __init__(
+        self,
+        model_config: OfflineInferenceConfig,
+        second_model_config: OfflineInferenceConfig,
+        second_template: str,
+        col_in: str,
+        col_out: str,
+        second_col_in: str,
+        second_col_out: str,
+    ):
+        start_time = time.perf_counter()
+        model_id_or_path = download_model(
+            model_config.model_id_or_path, mark_in_use=True
+        )
+
+        self.lora_requests = []
+        for lora_id, config in enumerate((model_config, second_model_config), 1):
+            adapters = config.get_adapters()
+            assert len(adapters) <= 1, "Fused inference supports one adapter per stage"
+            lora_request = None
+            if adapters:
+                logger.info(f"Downloading LoRA: {adapters[0]}")
+                lora_request = LoRARequest(
+                    f"lora_{lora_id}",
+                    lora_id,
+                    download_model(adapters[0], mark_in_use=True),
+                )
+            self.lora_requests.append(lora_request)
+        download_time = time.perf_counter() - start_time
+
+        self.col_in = col_in
+        self.col_out = col_out
+        self.second_col_in = second_col_in
+        self.second_col_out = second_col_out
+        self.sampling_params = [
+            get_sampling_params(model_config),
+            get_sampling_params(second_model_config),
+        ]
+        self.formatter = PromptFormatter(
+            tokenizer_id_or_path=second_model_config.get_tokenizer_id_or_path(),
+            template=second_template,
+            col_name=second_col_in,
+            return_token_ids=second_model_config.pretokenize_prompts,
+        )
+
+        llm_args = dict(
+            model=model_id_or_path,
+            tensor_parallel_size=model_config.scaling_config.num_gpus_per_instance,
+            max_model_len=VLLM_MAX_MODEL_LEN,
+            dtype="bfloat16",
+        )
+        num_loras = sum(lora_request is not None for lora_request in self.lora_requests)
+        if num_loras:
+            llm_args.update(
+                dict(
+                    enable_lora=True,
+                    max_loras=num_loras,
+                    max_lora_rank=64,
+                )
+            )
+        self.llm = LLM(**llm_args)
+        log_cold_start(start_time, download_time)
+
+    def _generate(self, prompts, stage: int) -> List[str]:
+        outputs = self.llm.generate(
+            to_vllm_prompts(prompts),
+            self.sampling_params[stage],
+            lora_request=self.lora_requests[stage],
+        )
+        return [output.outputs[0].text.strip() for output in outputs]
+
+    def __call__(self, batch: pd.DataFrame) -> pd.DataFrame:
+        batch[self.col_out] = self._generate(batch[self.col_in], stage=0)
+        batch = self.formatter(batch)
+        batch[self.second_col_out] = self._generate(batch[self.second_col_in], stage=1)
+        return batch
+
+
+class AsyncOnlinePredictor:
+    """Batched inference against an OpenAI-compatible server
+
+    All requests in a batch are issued concurrently over a single async client per actor, with at most
+    `max_concurrent_requests_per_worker` requests in flight. If `requests_per_minute` is set, each of the
+    `concurrency` actors gets an equal share of the global rate limit. Transient errors are retried with backoff.
+
+    Besides `col_out`, per-request metrics are written to `{col_out}_latency_s`, `{col_out}_prompt_tokens` and
+    `{col_out}_completion_tokens`. Failed requests have `None` outputs and metrics.
+    """
+
     def __init__(
         self,
         model_config: OnlineInferenceConfig,
@@ -107,32 +284,79 @@ class OnlinePredictor:
             raise ValueError(
                 f"API Key must be set through {model_config.api_key_env_var}"
             )
-        self.client = OpenAI(
+        self.client = AsyncOpenAI(
             base_url=model_config.base_url,
             api_key=os.environ[model_config.api_key_env_var],
+            # Retries are handled in `get_completion_async`
+            max_retries=0,
         )
         self.model = model_config.model_id
         self.col_in = col_in
         self.col_out = col_out
         self.temperature = model_config.temperature
         self.max_tokens = model_config.max_tokens
-
-    def __call__(self, example):
-        try:
-            resp = get_completion(
-                client=self.client,
-                model=self.model,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                messages=list(example[self.col_in]),
+        self.max_concurrent_requests = model_config.max_concurrent_requests_per_worker
+        self.rate_limiter = None
+        if model_config.requests_per_minute:
+            self.rate_limiter = AsyncRateLimiter(
+                model_config.requests_per_minute / model_config.concurrency
             )
-            example[self.col_out] = resp.choices[0].message.content
-        except Exception as e:
-            logger.error(
-                f"Error generating response:  {e} for input {example[self.col_in]}"
+        # The client's connection pool is bound to the event loop, so the same loop is reused across batches
+        self.loop = asyncio.new_event_loop()
+
+    async def _predict(self, messages, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+            start_time = time.perf_counter()
+            try:
+                resp = await get_completion_async(
+                    client=self.client,
+                    model=self.model,
+                    temperature=self.temperature,
+                    max_tokens=self.max_tokens,
+                    messages=messages,
+                )
+                if resp == ERROR_OUTPUT:
+                    raise RuntimeError("Maximum number of retries reached")
+            except Exception as e:
+                logger.error(f"Error generating response:  {e} for input {messages}")
+                return None, None, None, None
+            latency = time.perf_counter() - start_time
+            usage = resp.usage
+            return (
+                resp.choices[0].message.content,
+                latency,
+                usage.prompt_tokens if usage else None,
+                usage.completion_tokens if usage else None,
             )
-            example[self.col_out] = None
-        return example
+
+    async def _predict_batch(self, batch_messages):
+        semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        return await asyncio.gather(
+            *[self._predict(messages, semaphore) for messages in batch_messages]
+        )
+
+    def __call__(self, batch: pd.DataFrame) -> pd.DataFrame:
+        batch_messages = [list(messages) for messages in batch[self.col_in]]
+        results = self.loop.run_until_complete(self._predict_batch(batch_messages))
+        outputs, latencies, prompt_tokens, completion_tokens = (
+            zip(*results) if results else ([], [], [], [])
+        )
+        batch[self.col_out] = list(outputs)
+        batch[f"{self.col_out}_latency_s"] = list(latencies)
+        batch[f"{self.col_out}_prompt_tokens"] = list(prompt_tokens)
+        batch[f"{self.col_out}_completion_tokens"] = list(completion_tokens)
+        return batch
+
+
+def get_group_aligned_batch_size(
+    batch_size: Optional[int], group_size: Optional[int]
+) -> Optional[int]:
+    """Rounds the batch size down to a multiple of `group_size`, so that batches never split a group of adjacent rows"""
+    if group_size is None or batch_size is None:
+        return batch_size
+    return max(batch_size // group_size, 1) * group_size
 
 
 def get_predictions_on_dataset(
@@ -140,6 +364,7 @@ def get_predictions_on_dataset(
     model_config: Union[OnlineInferenceConfig, OfflineInferenceConfig],
     col_in: str,
     col_out: str,
+    group_size: Optional[int] = None,
 ):
     """Get predictions for a model on the given dataset using Ray data
 
@@ -149,6 +374,8 @@ def get_predictions_on_dataset(
         model_config: Model inference config. Can be online/ offline.
         col_in: Input column in the dataset.
         col_out: Output column to write the results to.
+        group_size: Number of adjacent rows that belong together, e.g. the generations for an article from `duplicate_rows`.
+            If provided, the batch size is rounded down to a multiple of `group_size` so that batches never split a group.
     """
     if isinstance(model_config, OfflineInferenceConfig):
         ds = ds.map_batches(
@@ -160,19 +387,73 @@ def get_predictions_on_dataset(
             ),
             num_gpus=model_config.scaling_config.num_gpus_per_instance,
             concurrency=model_config.scaling_config.concurrency,
-            batch_size=model_config.scaling_config.batch_size,
+            batch_size=get_group_aligned_batch_size(
+                model_config.scaling_config.batch_size, group_size
+            ),
             accelerator_type=model_config.scaling_config.accelerator_type,
             zero_copy_batch=True,
             batch_format="numpy",
         )
     else:
-        ds = ds.map(
-            OnlinePredictor,
+        ds = ds.map_batches(
+            AsyncOnlinePredictor,
             fn_constructor_kwargs=dict(
                 col_in=col_in,
                 col_out=col_out,
                 model_config=model_config,
             ),
             concurrency=model_config.concurrency,
+            batch_size=get_group_aligned_batch_size(
+                model_config.batch_size, group_size
+            ),
+            batch_format="pandas",
         )
     return ds
+
+
+def get_fused_predictions_on_dataset(
+    ds: "Dataset",
+    model_config: OfflineInferenceConfig,
+    second_model_config: OfflineInferenceConfig,
+    second_template: str,
+    col_in: str,
+    col_out: str,
+    second_col_in: str,
+    second_col_out: str,
+    group_size: Optional[int] = None,
+):
+    """Get predictions for two chained generation stages that share a base model with a single vLLM engine per actor
+
+    See `FusedOfflinePredictor` for details. Resources are taken from the scaling config of the first stage.
+    Args:
+        ds: The input dataset
+        model_config: Inference config for the first stage
+        second_model_config: Inference config for the second stage
+        second_template: Prompt template for the second stage
+        col_in: Input column for the first stage
+        col_out: Output column for the first stage
+        second_col_in: Column for the formatted prompts of the second stage
+        second_col_out: Output column for the second stage
+        group_size: Number of adjacent rows that belong together. See `get_predictions_on_dataset`.
+    """
+    assert (
+        model_config.model_id_or_path == second_model_config.model_id_or_path
+    ), "Fused inference requires both stages to use the same base model"
+    scaling_config = model_config.scaling_config
+    return ds.map_batches(
+        FusedOfflinePredictor,
+        fn_constructor_kwargs=dict(
+            model_config=model_config,
+            second_model_config=second_model_config,
+            second_template=second_template,
+            col_in=col_in,
+            col_out=col_out,
+            second_col_in=second_col_in,
+            second_col_out=second_col_out,
+        ),
+        num_gpus=scaling_config.num_gpus_per_instance,
+        concurrency=scaling_config.concurrency,
+        batch_size=get_group_aligned_batch_size(scaling_config.batch_size, group_size),
+        accelerator_type=scaling_config.accelerator_type,
+        batch_format="pandas",
+    )
@@ -0,0 +1,93 @@
+"""
+Node-level prefetching of model and adapter weights, so that inference actors find their weights in the node-local cache
+"""
+
+import time
+from typing import Dict, List, Optional
+
+import ray
+from ray.util.scheduling_strategies import NodeAffinitySchedulingStrategy
+
+from src.utils.common import init_logger
+from src.utils.download import download_model
+from src.utils.models import OfflineInferenceConfig
+
+logger = init_logger()
+
+
+@ray.remote(num_cpus=0)
+def _prefetch_on_node(
+    model_ids_or_paths: List[str], verify_cache: bool
+) -> Dict[str, float]:
+    """Downloads the given models to the node-local cache and returns the time taken for each"""
+    download_times = {}
+    for model_id_or_path in model_ids_or_paths:
+        start_time = time.perf_counter()
+        download_model(model_id_or_path, verify_cache=verify_cache)
+        download_times[model_id_or_path] = time.perf_counter() - start_time
+    return download_times
+
+
+def get_model_ids_or_paths(*model_configs: OfflineInferenceConfig) -> List[str]:
+    """Returns the distinct base models and adapters used by the given model configs"""
+    model_ids_or_paths = []
+    for model_config in model_configs:
+        for model_id_or_path in [
+            model_config.model_id_or_path,
+            *model_config.get_adapters(),
+        ]:
+            if model_id_or_path not in model_ids_or_paths:
+                model_ids_or_paths.append(model_id_or_path)
+    return model_ids_or_paths
+
+
+def prefetch_models(
+    model_ids_or_paths: List[str],
+    node_ids: Optional[List[str]] = None,
+    verify_cache: bool = False,
+) -> Dict[str, ray.ObjectRef]:
+    """Starts downloading the given models on every node, without waiting for the downloads to finish.
+
+    Downloads hold the same per-model lock as `download_model`, so an actor scheduled while a prefetch is in progress
+    waits for it instead of downloading the weights again. Only nodes alive when this is called are covered; actors on
+    nodes added later by the autoscaler download the weights themselves.
+
+    Only remote paths go through the size-capped, manifest-checked cache. Hugging Face model IDs are downloaded with
+    `snapshot_download` into the Hugging Face cache, which has no size cap or manifest.
+
+    Args:
+        model_ids_or_paths: Hugging Face model IDs or remote paths of models and adapters
+        node_ids: Nodes to prefetch on. Defaults to all alive nodes with GPUs, or all alive nodes if there are none.
+        verify_cache: Whether to re-hash cached checkpoints against the hashes taken while downloading them. By
+            default, cached copies are trusted if the local and remote file sizes and modification times match the
+            manifest.
+
+    Returns:
+        A mapping from node ID to the object ref of the prefetch task on that node
+    """
+    if node_ids is None:
+        alive_nodes = [node for node in ray.nodes() if node["Alive"]]
+        gpu_nodes = [node for node in alive_nodes if node["Resources"].get("GPU", 0)]
+        node_ids = [node["NodeID"] for node in (gpu_nodes or alive_nodes)]
+
+    logger.info(f"Prefetching {model_ids_or_paths} on {len(node_ids)} nodes")
+    return {
+        node_id: _prefetch_on_node.options(
+            scheduling_strategy=NodeAffinitySchedulingStrategy(node_id, soft=False)
+        ).remote(model_ids_or_paths, verify_cache)
+        for node_id in node_ids
+    }
+
+
+def report_prefetch_times(prefetch_refs: Dict[str, ray.ObjectRef]):
+    """Waits for the prefetch tasks and logs the time taken to make each model available on each node"""
+    for node_id, ref in prefetch_refs.items():
+        try:
+            download_times = ray.get(ref)
+        except Exception as e:
+            logger.warning(f"Prefetching failed on node {node_id}: {e}")
+            continue
+        for model_id_or_path, download_time in download_times.items():
+            logger.info(
+                f"Node {node_id}: {model_id_or_path} available after {download_time:.1f}s"
+            )
@@ -2,22 +2,24 @@
 Utilities for synthetic data generation
 """
 
+import functools
 import json
-import random
 import re
 from enum import Enum
 from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
 import numpy as np
-from transformers import PreTrainedTokenizerBase
+import pandas as pd
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
 
 from src.utils.common import init_logger
 
 if TYPE_CHECKING:
-    pass
+    from ray.data import Dataset
 
 logger = init_logger()
 
+
 class InferenceType(Enum):
     ONLINE = "online"
     OFFLINE = "offline"
@@ -64,6 +66,117 @@ def format_into_prompt_rawtext(
     return row
 
 
+class PromptFormatter:
+    """Ray Data actor that formats whole batches into raw text prompts with a tokenizer's chat template
+
+    The tokenizer is loaded once per actor instead of being pickled into every task. The chat template is rendered
+    once with a placeholder message, and prompts are built by substituting the formatted text into the rendered
+    template. Templates that trim message contents (e.g. Llama 3) are supported by trimming the text before
+    substitution. If the template modifies message contents in any other way, this falls back to
+    `apply_chat_template` per row.
+
+    Args:
+        tokenizer_id_or_path: Model ID or local path for the tokenizer
+        template: Prompt template with keys from the dataset row
+        col_name: Output column for the formatted prompt
+        return_token_ids: If True, `col_name` contains token IDs instead of text so that vLLM can skip tokenization
+    """
+
+    PLACEHOLDER = "<<<PROMPT_PLACEHOLDER>>>"
+    PROBES = ("Probe content", "\n Probe  content \n\n", "  Probe\tcontent")
+
+    def __init__(
+        self,
+        tokenizer_id_or_path: str,
+        template: str,
+        col_name: str,
+        return_token_ids: bool = False,
+    ):
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_id_or_path)
+        self.template = template
+        self.col_name = col_name
+        self.return_token_ids = return_token_ids
+        self.prefix, self.suffix = self._render(self.PLACEHOLDER).split(
+            self.PLACEHOLDER
+        )
+        # Find how the chat template transforms message contents, if at all
+        self.transform = None
+        for transform in (lambda content: content, str.strip):
+            if all(
+                self.prefix + transform(probe) + self.suffix == self._render(probe)
+                for probe in self.PROBES
+            ):
+                self.transform = transform
+                break
+        if self.transform is None:
+            logger.warning(
+                "Chat template modifies message contents, formatting each prompt with `apply_chat_template`"
+            )
+
+    def _render(self, content: str) -> str:
+        return self.tokenizer.apply_chat_template(
+            [{"content": content, "role": "user"}],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+
+    def __call__(self, batch: pd.DataFrame) -> pd.DataFrame:
+        contents = [
+            self.template.format(**row) for row in batch.to_dict(orient="records")
+        ]
+        if self.transform is not None:
+            prompts = [
+                self.prefix + self.transform(content) + self.suffix
+                for content in contents
+            ]
+        else:
+            prompts = [self._render(content) for content in contents]
+
+        if self.return_token_ids:
+            # The chat template already contains special tokens such as BOS
+            batch[self.col_name] = self.tokenizer(prompts, add_special_tokens=False)[
+                "input_ids"
+            ]
+        else:
+            batch[self.col_name] = prompts
+        return batch
+
+
+def format_prompts_on_dataset(
+    ds: "Dataset",
+    tokenizer_id_or_path: str,
+    template: str,
+    col_name: str,
+    concurrency: int,
+    return_token_ids: bool = False,
+    batch_size: Optional[int] = None,
+) -> "Dataset":
+    """Formats the dataset rows into raw text prompts (or token IDs) in batches with `PromptFormatter` actors
+
+    Args:
+        ds: The input dataset
+        tokenizer_id_or_path: Model ID or local path for the tokenizer
+        template: Prompt template with keys from the dataset row
+        col_name: Output column for the formatted prompt
+        concurrency: Number of formatter actors
+        return_token_ids: Whether to emit token IDs instead of text
+        batch_size: Batch size for formatting. If `None`, each block is formatted as one batch, which keeps block boundaries (and hence groups of adjacent rows) intact.
+    """
+    return ds.map_batches(
+        PromptFormatter,
+        fn_constructor_kwargs=dict(
+            tokenizer_id_or_path=tokenizer_id_or_path,
+            template=template,
+            col_name=col_name,
+            return_token_ids=return_token_ids,
+        ),
+        batch_size=batch_size,
+        batch_format="pandas",
+        concurrency=concurrency,
+        num_cpus=1,
+    )
+
+
 def duplicate_rows(
     row: Dict[str, Any], count: int, id_col: str
 ) -> List[Dict[str, Any]]:
@@ -80,11 +193,66 @@ def duplicate_rows(
     return [{**row, id_col: i} for i in range(count)]
 
 
+def get_adapter_col(col_out: str, adapter_idx: int) -> str:
+    """Returns the output column for the adapter at the given index with a multi-adapter `OfflinePredictor`"""
+    return f"{col_out}_adapter_{adapter_idx}"
+
+
+def split_adapter_outputs(
+    row: Dict[str, Any], col_out: str, adapters: List[str], adapter_col: str
+) -> List[Dict[str, Any]]:
+    """Splits a row with per-adapter output columns into one row per adapter.
+
+    Each output row has the adapter's output in `col_out` and the adapter in `adapter_col`.
+    Args:
+        row: A dict representing a row with the outputs of a multi-adapter `OfflinePredictor`
+        col_out: Output column of the predictor
+        adapters: The list of adapters, in the order given to the predictor
+        adapter_col: Column name for the new column with the adapter
+    Returns:
+        The list of rows, one per adapter
+    """
+    adapter_cols = [get_adapter_col(col_out, i) for i in range(len(adapters))]
+    base_row = {key: value for key, value in row.items() if key not in adapter_cols}
+    return [
+        {**base_row, col_out: row[adapter_col_out], adapter_col: adapter}
+        for adapter, adapter_col_out in zip(adapters, adapter_cols)
+    ]
+
+
+class ParseFailure:
+    """Reason codes for raw LLM outputs that could not be parsed. An empty code means the output was parsed."""
+
+    NONE = ""
+    NO_OUTPUT = "no_output"
+    LINE_BEFORE_QUESTION = "line_before_question"
+    WRONG_NUM_QUESTIONS = "wrong_num_questions"
+    WRONG_NUM_CHOICES = "wrong_num_choices"
+    MISSING_ANSWER = "missing_answer"
+    INVALID_ANSWER = "invalid_answer"
+    INCOMPLETE_ANSWERS = "incomplete_answers"
+
+
+@functools.lru_cache()
+def get_qa_line_pattern(letter_choices: Tuple[str, ...]) -> "re.Pattern":
+    """Returns the compiled pattern for the question, choice and answer lines in generated questions"""
+    letters = "".join(re.escape(letter) for letter in letter_choices)
+    return re.compile(
+        r"^(?:Q\d\) (?P<question>.*)"
+        rf"|[^\S\n]*(?P<letter>[{letters}])\. (?P<choice>.*)"
+        r"|.*Answer: (?P<answer>.?).*)$",
+        re.MULTILINE,
+    )
+
+
+JUDGE_ANSWER_PATTERN = re.compile(r"^[^\S\n]*Q(\d)\) ([A-E])", re.MULTILINE)
+
+
 def process_question(
-    text: str,
+    text: Optional[str],
     num_questions: int = 5,
     letter_choices: Tuple[str, ...] = ("A", "B", "C", "D", "E"),
-) -> List[Dict[str, Any]]:
+) -> Tuple[Optional[List[Dict[str, Any]]], str]:
     """Parses raw text containing questions, options and answers into a list of dicionaries.
 
     Args:
@@ -92,75 +260,198 @@ def process_question(
         num_questions: Number of questions in the text
         letter_choices: The list of letter choices for each question.
     Returns:
-        questions: A list of dictionaries with keys "question", "answer" and "choices"
+        questions: A list of dictionaries with keys "question", "answer" and "choices", or None if parsing failed
+        failure: The `ParseFailure` reason code
     """
-    questions = []
     assert all(
         len(choice) == 1 for choice in letter_choices
     ), f"Letter choices must be single letters, got {letter_choices}"
-    separator = ". "
-    choice_prefixes = [
-        f"{letter_choice}{separator}" for letter_choice in letter_choices
-    ]
-    prefix_length = len(choice_prefixes[0])
-    for line in text.split("\n"):
-        if re.match(r"Q\d\) ", line[:4]):
-            questions.append({"question": line.split(") ")[1], "choices": {}})
-        elif any([line.lstrip().startswith(prefix) for prefix in choice_prefixes]):
-            questions[-1]["choices"][line[0]] = line.lstrip()[prefix_length:]
-        elif "Answer: " in line:
-            questions[-1]["answer"] = line.split("Answer: ")[-1][0]
-
-    assert len(questions) == num_questions
+    # Missing outputs can be None or NaN in pandas batches
+    if not isinstance(text, str):
+        return None, ParseFailure.NO_OUTPUT
+
+    questions = []
+    for match in get_qa_line_pattern(tuple(letter_choices)).finditer(text):
+        question, letter, choice, answer = match.group(
+            "question", "letter", "choice", "answer"
+        )
+        if question is not None:
+            questions.append({"question": question, "choices": {}})
+        elif not questions:
+            return None, ParseFailure.LINE_BEFORE_QUESTION
+        elif letter is not None:
+            questions[-1]["choices"][letter] = choice
+        else:
+            questions[-1]["answer"] = answer
+
+    if len(questions) != num_questions:
+        return None, ParseFailure.WRONG_NUM_QUESTIONS
     for question in questions:
-        assert len(question["choices"]) == len(letter_choices)
-        assert "answer" in question and question["answer"] in letter_choices
-    return questions
-
-
-def write_questions(questions, letter_choices=("A", "B", "C", "D", "E")):
-    random.shuffle(questions)
-    prompt = ""
-    answers = []
-    for i, question in enumerate(questions):
-        prompt += f"Q{i + 1}) " + question["question"] + "\n"
-        options = list(question["choices"].items())
-        random.shuffle(options)
-        for j in range(len(letter_choices)):
-            orig_letter, choice_text = options[j]
-
-            if orig_letter == question["answer"]:
-                answers.append(letter_choices[j])
-
-            prompt += f"{letter_choices[j]}. " + choice_text + "\n"
-        prompt += "\n"
-    return prompt, np.array(answers)
-
-
-def shuffle_qa(row, col_in, col_out_prompt, col_out_answers):
-    try:
-        row[col_out_prompt], row[col_out_answers] = write_questions(
-            process_question(row[col_in])
+        if len(question["choices"]) != len(letter_choices):
+            return None, ParseFailure.WRONG_NUM_CHOICES
+        if "answer" not in question:
+            return None, ParseFailure.MISSING_ANSWER
+        if question["answer"] not in letter_choices:
+            return None, ParseFailure.INVALID_ANSWER
+    return questions, ParseFailure.NONE
+
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    """SplitMix64 finalizer, mapping uint64 inputs to well-mixed uint64 outputs"""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def get_random_permutations(
+    row_hashes: np.ndarray, shape: Tuple[int, ...], seed: int
+) -> np.ndarray:
+    """Returns a random permutation along the last axis of `shape` for each row.
+
+    Sort keys are drawn by mixing a hash of the row with salts from a generator seeded with `seed`, so the result for a
+    row does not depend on the other rows in its batch.
+    """
+    salts = np.random.default_rng(seed).integers(
+        0, np.iinfo(np.uint64).max, size=shape, dtype=np.uint64, endpoint=True
+    )
+    row_hashes = row_hashes.astype(np.uint64).reshape(-1, *([1] * len(shape)))
+    return np.argsort(_mix64(row_hashes ^ salts), axis=-1)
+
+
+def write_questions_batch(
+    questions_batch: List[List[Dict[str, Any]]],
+    row_hashes: np.ndarray,
+    letter_choices: Tuple[str, ...] = ("A", "B", "C", "D", "E"),
+    seed: int = 0,
+) -> Tuple[List[str], np.ndarray]:
+    """Shuffles the questions and their choices for a batch of parsed outputs and writes them as prompts.
+
+    Args:
+        questions_batch: Parsed questions for each row, as returned by `process_question`
+        row_hashes: A hash of each row's content, used to shuffle reproducibly
+        letter_choices: The list of letter choices for each question.
+        seed: Seed for the shuffles
+    Returns:
+        prompts: The shuffled questions and choices for each row
+        answers: Array of shape (num_rows, num_questions) with the letter of the correct choice after shuffling
+    """
+    num_rows = len(questions_batch)
+    num_questions = len(questions_batch[0]) if num_rows else 0
+    num_choices = len(letter_choices)
+    letters = np.array(letter_choices)
+    question_order = get_random_permutations(row_hashes, (num_questions,), seed)
+    choice_order = get_random_permutations(
+        row_hashes, (num_questions, num_choices), seed + 1
+    )
+
+    # Index of the correct choice among the original choices
+    answer_idx = np.array(
+        [
+            [
+                list(question["choices"]).index(question["answer"])
+                for question in questions
+            ]
+            for questions in questions_batch
+        ]
+    ).reshape(num_rows, num_questions)
+    answer_idx = np.take_along_axis(answer_idx, question_order, axis=1)
+    answers = letters[np.argmax(choice_order == answer_idx[..., None], axis=-1)]
+
+    prompts = []
+    for questions, q_order, c_order in zip(
+        questions_batch, question_order, choice_order
+    ):
+        prompt = ""
+        for i, (q_idx, order) in enumerate(zip(q_order, c_order)):
+            question = questions[q_idx]
+            choices = list(question["choices"].values())
+            prompt += f"Q{i + 1}) " + question["question"] + "\n"
+            for letter, choice_idx in zip(letter_choices, order):
+                prompt += f"{letter}. " + choices[choice_idx] + "\n"
+            prompt += "\n"
+        prompts.append(prompt)
+    return prompts, answers
+
+
+def shuffle_qa_batch(
+    batch: pd.DataFrame,
+    col_in: str,
+    col_out_prompt: str,
+    col_out_answers: str,
+    col_out_failure: str,
+    num_questions: int = 5,
+    letter_choices: Tuple[str, ...] = ("A", "B", "C", "D", "E"),
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Parses generated questions in a batch and writes them with shuffled questions and choices.
+
+    Rows that fail to parse are kept, with the reason code in `col_out_failure` and null outputs, so that failures can
+    be counted before they are dropped.
+    """
+    parsed = [
+        process_question(text, num_questions, letter_choices) for text in batch[col_in]
+    ]
+    failures = np.array([failure for _, failure in parsed], dtype=object)
+    is_parsed = failures == ParseFailure.NONE
+    row_hashes = pd.util.hash_pandas_object(
+        batch[col_in].fillna(""), index=False
+    ).to_numpy()
+    prompts, answers = write_questions_batch(
+        [questions for questions, _ in parsed if questions is not None],
+        row_hashes[is_parsed],
+        letter_choices,
+        seed,
+    )
+
+    batch[col_out_prompt] = None
+    batch[col_out_answers] = None
+    batch.loc[is_parsed, col_out_prompt] = pd.Series(
+        prompts, index=batch.index[is_parsed], dtype=object
+    )
+    batch.loc[is_parsed, col_out_answers] = pd.Series(
+        list(answers), index=batch.index[is_parsed], dtype=object
+    )
+    batch[col_out_failure] = failures
+    return batch
+
+
+def extract_answers_batch(
+    batch: pd.DataFrame,
+    col_in: str,
+    col_out: str,
+    col_out_failure: str,
+    num_questions: int,
+) -> pd.DataFrame:
+    """Extracts answers from the raw judge outputs in a batch
+
+    Questions without an answer line are answered "Unsure", with the reason code `incomplete_answers`. A missing
+    output is answered ["No Judge Output"].
+    """
+    answers, failures = [], []
+    for text in batch[col_in]:
+        if not isinstance(text, str):
+            answers.append(["No Judge Output"])
+            failures.append(ParseFailure.NO_OUTPUT)
+            continue
+        row_answers = ["Unsure"] * num_questions
+        for question_num, letter in JUDGE_ANSWER_PATTERN.findall(text):
+            if 1 <= int(question_num) <= num_questions:
+                row_answers[int(question_num) - 1] = letter
+        answers.append(row_answers)
+        failures.append(
+            ParseFailure.INCOMPLETE_ANSWERS
+            if "Unsure" in row_answers
+            else ParseFailure.NONE
         )
-        return [row]
-    except Exception:
-        return []
-
-
-def extract_answers(row: Dict[str, Any], col_in: str, col_out: str, num_questions: int):
-    """Extracts answers from the raw text column in the row"""
-    text = row[col_in]
-    if text is None:
-        row[col_out] = ["No Judge Output"]
-        return row
-    answers = ["Unsure"] * num_questions
-    for line in text.split("\n"):
-        if m := re.match(r"Q(\d)\) ([A-E])", line.strip()):
-            if 1 <= int(m.group(1)) <= num_questions:
-                answers[int(m.group(1)) - 1] = m.group(2)
-
-    row[col_out] = answers
-    return row
+    batch[col_out] = answers
+    batch[col_out_failure] = failures
+    return batch
+
+
+def count_parse_failures(ds: "Dataset", col: str) -> Dict[str, int]:
+    """Counts the rows of a dataset per parse failure reason code, with a distributed aggregation"""
+    counts = ds.groupby(col).count().to_pandas()
+    return dict(zip(counts[col].tolist(), counts["count()"].tolist()))
 
 
 def dump_jsonl_to_string(row: Dict[str, Any], col: str) -> Dict[str, Any]:
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import ray
+from typing import Dict, Optional
+from .utils import JUDGE_SCORE_PATTERN, prepare_ft_messages
+
+
+def parse_judge_responses_batch(
+    batch: pd.DataFrame,
+    response_key: str = "judge_response",
+    label_key: str = "mixtral_score",
+    explanation_key: str = "judge_explanation",
+) -> pd.DataFrame:
+    """
+    Vectorized version of `parse_judge_responses` over a block of judge responses.
+    """
+    extracted = batch[response_key].fillna("").str.extract(JUDGE_SCORE_PATTERN)
+    batch[label_key] = (
+        pd.to_numeric(extracted[0], errors="coerce").fillna(-1).astype(int)
+    )
+    batch[explanation_key] = extracted[1].fillna("")
+    return batch
+
+
+def parse_judge_responses_ds(
+    ds: ray.data.Dataset,
+    response_key: str = "judge_response",
+    label_key: str = "mixtral_score",
+    explanation_key: str = "judge_explanation",
+) -> ray.data.Dataset:
+    """
+    Parse llm-judge responses into labels and explanations on blocks in parallel.
+    """
+    return ds.map_batches(
+        parse_judge_responses_batch,
+        batch_format="pandas",
+        fn_kwargs=dict(
+            response_key=response_key,
+            label_key=label_key,
+            explanation_key=explanation_key,
+        ),
+    )
+
+
+def label_distribution_ds(ds: ray.data.Dataset, key: str) -> Dict[int, int]:
+    """
+    Count the number of rows per label with a distributed aggregation.
+    """
+    counts = ds.groupby(key).count().to_pandas()
+    return dict(zip(counts[key].tolist(), counts["count()"].tolist()))
+
+
+def _sample_by_label(
+    batch: pd.DataFrame,
+    key: str,
+    hash_key: str,
+    sample_fractions: Dict[int, float],
+    random_state: int,
+) -> pd.DataFrame:
+    # Derive a uniform draw from a hash of the row content, so the sample does not
+    # depend on how rows are split into blocks.
+    hashes = pd.util.hash_pandas_object(
+        batch[hash_key], index=False, hash_key=f"{random_state:016d}"[-16:]
+    ).to_numpy()
+    draws = hashes / np.float64(np.iinfo(np.uint64).max)
+    fractions = batch[key].map(sample_fractions).fillna(0.0).to_numpy()
+    return batch[draws < fractions]
+
+
+def balance_dataset_ds(
+    ds: ray.data.Dataset,
+    key: str,
+    hash_key: str = "prompt",
+    random_state: int = 42,
+    label_counts: Optional[Dict[int, int]] = None,
+) -> ray.data.Dataset:
+    """
+    Balance the dataset by downsampling every label to the size of the minority class.
+
+    Unlike `balance_dataset`, each label is sampled with a per-row Bernoulli draw on
+    blocks in parallel, so label counts match the minority class in expectation rather
+    than exactly.
+    """
+    if label_counts is None:
+        label_counts = label_distribution_ds(ds, key)
+    min_count = min(label_counts.values())
+    sample_fractions = {
+        label: min_count / count for label, count in label_counts.items()
+    }
+
+    return ds.map_batches(
+        _sample_by_label,
+        batch_format="pandas",
+        fn_kwargs=dict(
+            key=key,
+            hash_key=hash_key,
+            sample_fractions=sample_fractions,
+            random_state=random_state,
+        ),
+    )
+
+
+def _add_ft_messages(batch: pd.DataFrame, label_key: str) -> pd.DataFrame:
+    batch["messages"] = prepare_ft_messages(batch, label_key)
+    return batch[["messages"]]
+
+
+def write_ft_messages_ds(
+    ds: ray.data.Dataset, label_key: str, output_path: str
+) -> None:
+    """
+    Stream fine-tuning messages to sharded JSONL files without collecting the dataset on the driver.
+    """
+    ds.map_batches(
+        _add_ft_messages, batch_format="pandas", fn_kwargs=dict(label_key=label_key)
+    ).write_json(output_path)
@@ -0,0 +1,167 @@
+import time
+import numpy as np
+import pandas as pd
+from typing import Dict, Any, List, Optional, Callable
+from sklearn.linear_model import LogisticRegression
+from sklearn.neighbors import KNeighborsClassifier
+
+
+class EmbeddingRouter:
+    """
+    Lightweight first-stage router: a sentence embedding model with a logistic
+    regression or kNN head, trained on the same judge scores as the causal LLM router.
+
+    `binary_prob` follows the causal LLM router convention, i.e. the probability that
+    Mixtral-8x7B's response scores at least `score_threshold`.
+    """
+
+    def __init__(
+        self,
+        embedding_model_id: str = "sentence-transformers/all-MiniLM-L6-v2",
+        head: str = "logistic",
+        score_threshold: int = 4,
+        confidence_threshold: float = 0.8,
+        n_neighbors: int = 25,
+        device: str = "cpu",
+    ):
+        if head not in ("logistic", "knn"):
+            raise ValueError(f"Unknown head {head}, expected 'logistic' or 'knn'")
+
+        from sentence_transformers import SentenceTransformer
+
+        self.encoder = SentenceTransformer(embedding_model_id, device=device)
+        self.score_threshold = score_threshold
+        self.confidence_threshold = confidence_threshold
+        if head == "logistic":
+            self.classifier = LogisticRegression(max_iter=1000)
+        else:
+            self.classifier = KNeighborsClassifier(
+                n_neighbors=n_neighbors, weights="distance", metric="cosine"
+            )
+
+    def embed(self, prompts: List[str], batch_size: int = 256) -> np.ndarray:
+        """Embed prompts into L2-normalized vectors."""
+        return self.encoder.encode(
+            prompts,
+            batch_size=batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+
+    def fit(
+        self,
+        dataset_df: pd.DataFrame,
+        prompt_key: str = "prompt",
+        label_key: str = "mixtral_score",
+    ) -> "EmbeddingRouter":
+        """
+        Train the classifier head on judge-labeled data. Rows that failed judge parsing (label -1) are dropped.
+
+        Both routing labels must be present in the remaining rows.
+        """
+        labeled_df = dataset_df[dataset_df[label_key] > 0]
+        routing_labels = (labeled_df[label_key] >= self.score_threshold).astype(int)
+        if routing_labels.nunique() < 2:
+            raise ValueError(
+                f"Training data must contain prompts with {label_key} both below and at least {self.score_threshold}, "
+                f"got {len(labeled_df)} labeled rows with routing labels {sorted(routing_labels.unique().tolist())}"
+            )
+        embeddings = self.embed(labeled_df[prompt_key].tolist())
+        self.classifier.fit(embeddings, routing_labels.to_numpy())
+        return self
+
+    def predict_proba(self, prompts: List[str]) -> np.ndarray:
+        """Return `binary_prob` for each prompt."""
+        probs = self.classifier.predict_proba(self.embed(prompts))
+        return probs[:, list(self.classifier.classes_).index(1)]
+
+    def is_confident(self, binary_probs: np.ndarray) -> np.ndarray:
+        """A prediction is confident if either routing label exceeds the confidence threshold."""
+        return np.maximum(binary_probs, 1 - binary_probs) >= self.confidence_threshold
+
+
+def cascade_route(
+    inputs: List[Dict[str, Any]],
+    fast_router: EmbeddingRouter,
+    llm_router: Callable[[Dict[str, Any]], Dict[str, Any]],
+    prompt_key: str = "prompt",
+) -> pd.DataFrame:
+    """
+    Route queries with the embedding router and escalate low-confidence queries to the causal LLM router.
+
+    Each input must contain `prompt_key` for the embedding router and the `messages` field expected by `CausalLLMClassifier`.
+    """
+    binary_probs = fast_router.predict_proba([row[prompt_key] for row in inputs])
+    escalated = ~fast_router.is_confident(binary_probs)
+
+    for idx in np.flatnonzero(escalated):
+        binary_probs[idx] = llm_router(inputs[idx])["binary_prob"]
+
+    return pd.DataFrame({"binary_prob": binary_probs, "escalated": escalated})
+
+
+def _timed_route(
+    row: Dict[str, Any], route_fn: Callable[[Dict[str, Any]], float]
+) -> Dict[str, float]:
+    start_time = time.perf_counter()
+    binary_prob = route_fn(row)
+    return {"binary_prob": binary_prob, "latency": time.perf_counter() - start_time}
+
+
+def evaluate_cascade(
+    dataset_df: pd.DataFrame,
+    fast_router: EmbeddingRouter,
+    llm_router: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+    prompt_key: str = "prompt",
+    label_key: str = "mixtral_score",
+) -> pd.DataFrame:
+    """
+    Compare the cascaded router against the LLM-only router on routing accuracy, escalation rate and per-query latency.
+
+    Queries are routed one at a time, as they would be in an online setting. If `llm_router` is None, only the
+    embedding router is evaluated, and its escalation rate is the fraction of queries the cascade would escalate.
+    """
+    dataset_df = dataset_df[dataset_df[label_key] > 0]
+    rows = dataset_df.to_dict(orient="records")
+    routing_labels = (dataset_df[label_key] >= fast_router.score_threshold).to_numpy()
+
+    def fast_route(row):
+        return fast_router.predict_proba([row[prompt_key]])[0]
+
+    def llm_route(row):
+        return llm_router(row)["binary_prob"]
+
+    def cascaded_route(row):
+        binary_prob = fast_route(row)
+        if not fast_router.is_confident(np.array([binary_prob]))[0]:
+            binary_prob = llm_route(row)
+        return binary_prob
+
+    routers = {"embedding": fast_route}
+    if llm_router is not None:
+        routers.update({"cascade": cascaded_route, "llm": llm_route})
+
+    report = {}
+    for name, route_fn in routers.items():
+        results = pd.DataFrame([_timed_route(row, route_fn) for row in rows])
+        latencies_ms = results["latency"].to_numpy() * 1000
+        predictions = results["binary_prob"].to_numpy() >= 0.5
+        report[name] = {
+            "accuracy": (predictions == routing_labels).mean(),
+            "mean_latency_ms": latencies_ms.mean(),
+            "p50_latency_ms": np.percentile(latencies_ms, 50),
+            "p99_latency_ms": np.percentile(latencies_ms, 99),
+            "total_latency_s": latencies_ms.sum() / 1000,
+        }
+
+    binary_probs = fast_router.predict_proba(dataset_df[prompt_key].tolist())
+    escalation_rate = 1 - fast_router.is_confident(binary_probs).mean()
+    if llm_router is not None:
+        report["embedding"]["escalation_rate"] = 0.0
+        report["cascade"]["escalation_rate"] = escalation_rate
+        report["llm"]["escalation_rate"] = 1.0
+    else:
+        report["embedding"]["escalation_rate"] = escalation_rate
+
+    return pd.DataFrame(report).T
@@ -5,9 +5,12 @@ from routellm.routers.causal_llm.llm_utils import load_prompt_format
 from routellm.routers.causal_llm.model import CausalLLMClassifier
 
 
-def single_example_inference(input):
+def load_causal_llm_router(
+    ckpt_local_path: str = "routellm/causal_llm_gpt4_augmented",
+    score_threshold: int = 4,
+) -> CausalLLMClassifier:
     """
-    Perform inference on a single example using a finetuned Causal LLM model.
+    Load a finetuned Causal LLM router model.
     """
     # Load configs
     model_config = RouterModelConfig(
@@ -20,16 +23,23 @@ def single_example_inference(input):
     prompt_format = load_prompt_format(model_config.model_id)
 
     # Load model
-    model = CausalLLMClassifier(
+    return CausalLLMClassifier(
         config=model_config,
-        ckpt_local_path="routellm/causal_llm_gpt4_augmented",
-        score_threshold=4,
+        ckpt_local_path=ckpt_local_path,
+        score_threshold=score_threshold,
         prompt_format=prompt_format,
         prompt_field="messages",
         additional_fields=[],
         use_last_turn=False,
     )
 
+
+def single_example_inference(input):
+    """
+    Perform inference on a single example using a finetuned Causal LLM model.
+    """
+    model = load_causal_llm_router()
+
     # Inference
     model_output = model(input)
     return model_output
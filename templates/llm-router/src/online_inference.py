@@ -1,12 +1,17 @@
 import pandas as pd
-import json
+import numpy as np
 import ray
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 import copy
 import openai
 import time
 import ray
-from .utils import prepare_llm_queries, prepare_llm_judge_queries, parse_judge_responses
+from .utils import (
+    load_judge_template,
+    prepare_llm_queries,
+    prepare_llm_judge_queries,
+    parse_judge_responses,
+)
 
 
 @ray.remote(num_cpus=0)
@@ -20,6 +25,7 @@ def get_llm_response(
     messages: List[Dict[str, str]],
     max_retries=1,
     retry_interval=60,
+    timeout: Optional[float] = None,
 ) -> Dict[int, str]:
     """
     Use OpenAI's API to request completions from a specified LLM and manages request retries upon failures.
@@ -34,6 +40,7 @@ def get_llm_response(
                 messages=messages,
                 temperature=temperature,
                 max_tokens=max_tokens,
+                timeout=timeout,
             )
             return (pidx, response.choices[0].message.content)
         except Exception as e:
@@ -43,6 +50,20 @@ def get_llm_response(
     return (pidx, "")
 
 
+def print_latency_histogram(latencies: List[float], num_bins: int = 10) -> None:
+    """
+    Print a text histogram and percentiles of per-query latencies.
+    """
+    if not latencies:
+        return
+    counts, edges = np.histogram(latencies, bins=num_bins)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    print(f"Latency p50: {p50:.2f}sec, p90: {p90:.2f}sec, p99: {p99:.2f}sec")
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        bar = "#" * int(np.ceil(50 * count / counts.max()))
+        print(f"{low:8.2f} - {high:8.2f}sec | {bar} {count}")
+
+
 def generate_batch_responses(
     base_url: str,
     api_key: str,
@@ -52,33 +73,81 @@ def generate_batch_responses(
     temperature: float,
     max_tokens: int,
     verbose: bool = False,
+    hedge_percentile: Optional[float] = None,
+    min_latency_samples: int = 20,
+    request_timeout: Optional[float] = None,
 ) -> Dict[int, str]:
     """
     This function manages online batch inference of queries using a specified LLM, tracking progress and handling responses.
+
+    If `hedge_percentile` is set, a duplicate request is issued for any query that has been in flight longer than
+    that percentile of the latencies observed so far (once `min_latency_samples` queries have finished), and the
+    first response to arrive wins. Duplicates count towards `max_concurrent_queries` and are only issued when there is
+    spare capacity, i.e. mostly once the queue has drained. `request_timeout` bounds each individual endpoint call.
     """
     print(f"Starting batch inference on {len(queries)} queries...")
     queue = copy.copy(queries)
-    in_progress, responses = [], []
+    # Map each in-flight request to (pidx, messages, submit time)
+    in_progress: Dict[ray.ObjectRef, Tuple[int, Any, float]] = {}
+    attempts: Dict[int, List[ray.ObjectRef]] = {}
+    first_submit_time: Dict[int, float] = {}
+    responses, latencies = {}, []
+    num_hedged = 0
+
+    def submit(pidx, messages):
+        ref = get_llm_response.remote(
+            base_url,
+            api_key,
+            llm,
+            temperature,
+            max_tokens,
+            pidx,
+            messages,
+            timeout=request_timeout,
+        )
+        in_progress[ref] = (pidx, messages, time.time())
+        attempts.setdefault(pidx, []).append(ref)
+        first_submit_time.setdefault(pidx, time.time())
 
     start_time = time.time()
     while queue or in_progress:
-        if len(in_progress) < max_concurrent_queries and queue:
-            pidx, messages = queue.popitem()
-            in_progress.append(
-                get_llm_response.remote(
-                    base_url, api_key, llm, temperature, max_tokens, pidx, messages
-                )
-            )
-        ready, in_progress = ray.wait(in_progress, timeout=0.5)
+        while len(in_progress) < max_concurrent_queries and queue:
+            submit(*queue.popitem())
+
+        if hedge_percentile is not None and len(latencies) >= min_latency_samples:
+            hedge_after = np.percentile(latencies, hedge_percentile)
+            now = time.time()
+            for pidx, messages, submit_time in list(in_progress.values()):
+                # Hedges share the concurrency limit, so they only use capacity left over by the queue
+                if len(in_progress) >= max_concurrent_queries:
+                    break
+                if len(attempts[pidx]) == 1 and now - submit_time > hedge_after:
+                    submit(pidx, messages)
+                    num_hedged += 1
+
+        ready, _ = ray.wait(list(in_progress), timeout=0.5)
         if verbose:
             print(
                 f"# queries un-processed: {len(queue)}, in-progress: {len(in_progress)}, ready: {len(ready)}"
             )
-        if ready:
-            responses.extend(ray.get(ready))
+        for ref in ready:
+            pidx, _, _ = in_progress.pop(ref)
+            _, response = ray.get(ref)
+            pending = [other for other in attempts[pidx] if other in in_progress]
+            # Prefer a successful response from a pending duplicate over a failed one
+            if pidx in responses or (not response and pending):
+                continue
+            responses[pidx] = response
+            latencies.append(time.time() - first_submit_time[pidx])
+            for other in pending:
+                in_progress.pop(other)
+                ray.cancel(other)
 
     print(f"Done in {time.time() - start_time:.2f}sec.")
-    return dict(responses)
+    if hedge_percentile is not None:
+        print(f"Hedged {num_hedged} of {len(queries)} queries.")
+    print_latency_histogram(latencies)
+    return responses
 
 
 def generate_mixtral_responses(
@@ -122,8 +191,7 @@ def generate_llm_judge_labels(
     """
     Generate LLM-as-a-judge labels with OpenAI's API
     """
-    with open("assets/judge_template.json") as f:
-        judge_template = json.load(f)
+    judge_template = load_judge_template()
 
     # Preprocess LLM-judge queries
     judge_queries = prepare_llm_judge_queries(
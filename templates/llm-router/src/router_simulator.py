@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from typing import Optional, Tuple
+
+
+def _sorted_routing_arrays(
+    router_scores: np.ndarray,
+    mixtral_quality: np.ndarray,
+    gpt4_quality: np.ndarray,
+    mixtral_cost: np.ndarray,
+    gpt4_cost: np.ndarray,
+) -> Tuple[np.ndarray, ...]:
+    order = np.argsort(router_scores, kind="stable")
+    return tuple(
+        arr[order]
+        for arr in (
+            router_scores,
+            mixtral_quality,
+            gpt4_quality,
+            mixtral_cost,
+            gpt4_cost,
+        )
+    )
+
+
+def _routing_totals(
+    num_gpt4: np.ndarray,
+    mixtral_values: np.ndarray,
+    gpt4_values: np.ndarray,
+    weights: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Total value when the `num_gpt4` lowest-scored queries go to GPT-4 and the rest to Mixtral.
+
+    `weights` of shape (num_resamples, num_queries) evaluates all bootstrap resamples at once.
+    """
+    if weights is None:
+        weights = np.ones((1, len(mixtral_values)))
+    zeros = np.zeros((len(weights), 1))
+    gpt4_cumsum = np.concatenate(
+        [zeros, np.cumsum(weights * gpt4_values, axis=1)], axis=1
+    )
+    mixtral_cumsum = np.concatenate(
+        [zeros, np.cumsum(weights * mixtral_values, axis=1)], axis=1
+    )
+    return (
+        gpt4_cumsum[:, num_gpt4] + mixtral_cumsum[:, -1:] - mixtral_cumsum[:, num_gpt4]
+    )
+
+
+def simulate_routing(
+    dataset_df: pd.DataFrame,
+    router_scores: np.ndarray,
+    thresholds: Optional[np.ndarray] = None,
+    label_key: str = "mixtral_score",
+    gpt4_score: float = 5.0,
+    mixtral_cost: float = 0.24,
+    gpt4_cost: float = 10.0,
+    num_bootstrap: int = 0,
+    confidence: float = 0.95,
+    bootstrap_batch_size: int = 16,
+    random_state: int = 42,
+) -> pd.DataFrame:
+    """
+    Sweep routing thresholds over cached judge scores without re-running any model.
+
+    A query is routed to Mixtral-8x7B if its router score (`binary_prob`) is at least the threshold, and
+    to GPT-4 otherwise. Quality is the average judge score of the routed responses, where GPT-4 responses
+    are the judge's reference and get `gpt4_score`. Costs are per query, in arbitrary units.
+
+    With `num_bootstrap > 0`, confidence intervals for quality and cost are computed by resampling queries
+    with multinomial weights, evaluating `bootstrap_batch_size` resamples per vectorized pass.
+    """
+    valid = dataset_df[label_key].to_numpy() > 0
+    num_queries = int(valid.sum())
+    scores, mixtral_quality, gpt4_quality, mixtral_costs, gpt4_costs = (
+        _sorted_routing_arrays(
+            np.asarray(router_scores, dtype=np.float64)[valid],
+            dataset_df[label_key].to_numpy(dtype=np.float64)[valid],
+            np.full(num_queries, gpt4_score),
+            np.full(num_queries, mixtral_cost),
+            np.full(num_queries, gpt4_cost),
+        )
+    )
+    if thresholds is None:
+        thresholds = np.linspace(0, 1, 101)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    # Number of queries routed to GPT-4 for each threshold
+    num_gpt4 = np.searchsorted(scores, thresholds, side="left")
+
+    results = pd.DataFrame(
+        {
+            "threshold": thresholds,
+            "gpt4_pct": num_gpt4 / num_queries,
+            "quality": _routing_totals(num_gpt4, mixtral_quality, gpt4_quality)[0]
+            / num_queries,
+            "cost": _routing_totals(num_gpt4, mixtral_costs, gpt4_costs)[0]
+            / num_queries,
+        }
+    )
+
+    if num_bootstrap > 0:
+        rng = np.random.default_rng(random_state)
+        quality_samples, cost_samples = [], []
+        for start in range(0, num_bootstrap, bootstrap_batch_size):
+            batch_size = min(bootstrap_batch_size, num_bootstrap - start)
+            weights = rng.multinomial(
+                num_queries, np.full(num_queries, 1 / num_queries), size=batch_size
+            )
+            quality_samples.append(
+                _routing_totals(num_gpt4, mixtral_quality, gpt4_quality, weights)
+            )
+            cost_samples.append(
+                _routing_totals(num_gpt4, mixtral_costs, gpt4_costs, weights)
+            )
+
+        alpha = (1 - confidence) / 2
+        for name, samples in (("quality", quality_samples), ("cost", cost_samples)):
+            samples = np.concatenate(samples) / num_queries
+            results[f"{name}_ci_low"] = np.quantile(samples, alpha, axis=0)
+            results[f"{name}_ci_high"] = np.quantile(samples, 1 - alpha, axis=0)
+
+    return results
+
+
+def threshold_for_quality(results: pd.DataFrame, target_quality: float) -> pd.Series:
+    """
+    Return the cheapest simulated operating point that reaches the target quality.
+    """
+    eligible = results[results["quality"] >= target_quality]
+    if eligible.empty:
+        raise ValueError(f"No threshold reaches quality {target_quality}")
+    return eligible.loc[eligible["cost"].idxmin()]
+
+
+def plot_routing_curves(results: pd.DataFrame) -> None:
+    """
+    Plot the quality and cost curves against the percentage of GPT-4 calls.
+    """
+    fig, (ax_quality, ax_cost) = plt.subplots(1, 2, figsize=(12, 4))
+    for ax, name in ((ax_quality, "quality"), (ax_cost, "cost")):
+        ax.plot(results["gpt4_pct"] * 100, results[name])
+        if f"{name}_ci_low" in results:
+            ax.fill_between(
+                results["gpt4_pct"] * 100,
+                results[f"{name}_ci_low"],
+                results[f"{name}_ci_high"],
+                alpha=0.3,
+            )
+        ax.set_xlabel("GPT-4 calls (%)")
+        ax.set_ylabel(name.capitalize())
+        ax.set_title(f"{name.capitalize()} vs. GPT-4 calls")
+    plt.show()
@@ -1,4 +1,5 @@
 import re
+import functools
 import matplotlib.pyplot as plt
 from collections import Counter
 import pandas as pd
@@ -11,6 +12,34 @@ import yaml
 
 pd.options.mode.chained_assignment = None
 
+JUDGE_SCORE_PATTERN = re.compile(r"\[\[([\d\.]+)\]\]\n(.+)")
+
+
+@functools.lru_cache(maxsize=None)
+def load_text_asset(path: str) -> str:
+    """Load a text asset once and cache it for subsequent calls."""
+    with open(path, "r") as f:
+        return f.read()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_json_asset(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_judge_template(path: str = "assets/judge_template.json") -> Dict[str, Any]:
+    """Load the LLM judge template, cached across calls. Returns a copy that is safe to modify."""
+    return dict(_load_json_asset(path))
+
+
+def load_ft_instructions(
+    system_path: str = "assets/system_ft.txt",
+    classifier_path: str = "assets/classifier_ft.txt",
+) -> Tuple[str, str]:
+    """Load the system and classifier messages used for instruction fine-tuning."""
+    return load_text_asset(system_path), load_text_asset(classifier_path)
+
 
 def load_and_display_nectar(subset: str = "train") -> pd.DataFrame:
     """
@@ -97,12 +126,10 @@ def prepare_llm_queries(
 ) -> Dict[int, List[Dict[str, str]]]:
     """Prepare queries for using LLM endpoints"""
     queries = {}
-    for pidx, row in dataset_df.to_dict(orient="index").items():
-        prompt = row["prompt"]
+    for pidx, prompt in zip(dataset_df.index, dataset_df["prompt"]):
         if type(prompt) == str:
             prompt = [prompt]
-        messages = to_openai_api_messages(prompt, system_message)
-        queries[pidx] = messages
+        queries[pidx] = to_openai_api_messages(prompt, system_message)
     return queries
 
 
@@ -118,6 +145,30 @@ def format_judge_prompt(
     )
 
 
+def build_judge_messages(
+    dataset_df: pd.DataFrame,
+    judge_template: Dict[str, Any],
+    answer_key: str,
+    reference_key: str,
+) -> List[List[Dict[str, str]]]:
+    """
+    Build LLM judge messages for all rows directly from the column arrays.
+    """
+    # Fill in the instruction once instead of once per row
+    instruction = judge_template["instruction"].replace("{", "{{").replace("}", "}}")
+    prompt_template = judge_template["prompt_template"].replace(
+        "{instruction}", instruction
+    )
+    return [
+        to_openai_api_messages(
+            [prompt_template.format(question=q, answer=a, ref_answer_1=r)]
+        )
+        for q, a, r in zip(
+            dataset_df["prompt"], dataset_df[answer_key], dataset_df[reference_key]
+        )
+    ]
+
+
 def prepare_llm_judge_queries(
     dataset_df: pd.DataFrame,
     judge_template: Dict[str, Any],
@@ -125,14 +176,10 @@ def prepare_llm_judge_queries(
     reference_key: str,
 ) -> Dict[int, List[Dict[str, str]]]:
     """Prepare queries for using LLM judge endpoint"""
-    queries = {}
-    for pidx, row in dataset_df.to_dict(orient="index").items():
-        prompt = format_judge_prompt(
-            judge_template, row["prompt"], row[answer_key], row[reference_key]
-        )
-        messages = to_openai_api_messages([prompt])
-        queries[pidx] = messages
-    return queries
+    messages = build_judge_messages(
+        dataset_df, judge_template, answer_key, reference_key
+    )
+    return dict(zip(dataset_df.index, messages))
 
 
 def inspect_llm_judge_queries(
@@ -142,8 +189,7 @@ def inspect_llm_judge_queries(
     reference_key="gpt4_response",
 ):
     """Inspect one prompt from the prepared LLM judge queries"""
-    with open(template_path) as f:
-        judge_template = json.load(f)
+    judge_template = load_judge_template(template_path)
 
     example_row = dataset_df.iloc[4]
     prompt = format_judge_prompt(
@@ -163,7 +209,7 @@ def parse_judge_responses(
     """
     labels, explanations = {}, {}
     for pidx, response in judge_responses.items():
-        match = re.search(r"\[\[([\d\.]+)\]\]\n(.+)", response)
+        match = JUDGE_SCORE_PATTERN.search(response)
         if match:
             score, explanation = int(float(match.group(1))), match.group(2)
         else:
@@ -215,22 +261,19 @@ def prepare_ft_messages(dataset_df: pd.DataFrame, label_key: str) -> pd.DataFram
     """
     Add messages for fine-tuning using the dataset dataframe, system message, and classifier message.
     """
-    with open(f"assets/system_ft.txt", "r") as f1, open(
-        f"assets/classifier_ft.txt", "r"
-    ) as f2:
-        system_message = f1.read()
-        classifier_message = f2.read()
+    system_message, classifier_message = load_ft_instructions()
 
     # Create API formatted 'messages' column for each row in the dataset dataframe
-    return dataset_df.apply(
-        lambda row: to_openai_api_messages(
-            [
-                classifier_message.format(question=row["prompt"]),
-                f"[[{row[label_key]}]]",
-            ],
-            system_message,
-        ),
-        axis=1,
+    return pd.Series(
+        [
+            to_openai_api_messages(
+                [classifier_message.format(question=prompt), f"[[{label}]]"],
+                system_message,
+            )
+            for prompt, label in zip(dataset_df["prompt"], dataset_df[label_key])
+        ],
+        index=dataset_df.index,
+        dtype=object,
     )
 
 
@@ -238,11 +281,7 @@ def inspect_instructions() -> None:
     """
     Inspect the instructions used for instruction fine-tuning.
     """
-    with open(f"assets/system_ft.txt", "r") as f1, open(
-        f"assets/classifier_ft.txt", "r"
-    ) as f2:
-        system_message = f1.read()
-        classifier_message = f2.read()
+    system_message, classifier_message = load_ft_instructions()
 
     print("\n".join([system_message, classifier_message]))
 